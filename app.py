@@ -1,26 +1,473 @@
 # Import necessary libraries
-from flask import Flask, jsonify, request, redirect, url_for, session, render_template_string, flash
+from flask import Flask, jsonify, request, redirect, url_for, session, render_template, flash, g, stream_with_context, send_file
+from jinja2 import meta as jinja2_meta
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declared_attr
+from sqlalchemy.pool import QueuePool
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
+import sys
 import secrets
+import click
+import hashlib
+import base64
+import json
+import collections
+import contextlib
+import contextvars
+import gzip
+import math
+import bisect
+import atexit
+import queue
+import threading
+import time
+import random
+import csv
+import io
+import socketserver
+import struct
+import smtplib
+import urllib.request
+from email.message import EmailMessage
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps # Import wraps
+from sensor_protocol import (ACK_DUPLICATE, ACK_INVALID, ACK_OK, ACK_RETRY, ACK_UNKNOWN_DEVICE, FRAME_HEADER,
+                             decode_ack, decode_frame, encode_ack, frame_length)
+import numpy as np
+
+try:
+    import brotli # Optional: Brotli-compressed dashboard
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl # Optional: cross-process locking of the recent-readings file (POSIX only)
+except ImportError:
+    fcntl = None
+
+try:
+    import pyarrow # Optional: Parquet / Arrow history export
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import pandas as pd # Optional: background reports (aggregation)
+except ImportError:
+    pd = None
+
+try:
+    from reportlab.lib import colors as pdf_colors # Optional: PDF reports
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import LongTable, Paragraph, SimpleDocTemplate, Spacer, TableStyle
+except ImportError:
+    SimpleDocTemplate = None
+
+try:
+    import openpyxl # Optional: Excel reports (pandas' xlsx engine)
+except ImportError:
+    openpyxl = None
 
 # Initialize Flask app
 app = Flask(__name__, static_folder='static', static_url_path='/static') # Ensure static folder is configured
 
+def load_secret_key():
+    """Session signing key shared by every worker process.
+
+    SMART_TRASH_SECRET_KEY wins; otherwise the key is read from a file
+    (instance/secret_key by default), generated by whichever process starts
+    first. A per-process random key would log users out whenever a request
+    lands on another worker.
+    """
+    key = os.environ.get('SMART_TRASH_SECRET_KEY')
+    if key:
+        return key
+    path = os.environ.get('SMART_TRASH_SECRET_KEY_FILE', os.path.join(app.instance_path, 'secret_key'))
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write a private temp file, then link it in place: link() fails if
+        # another worker won the race, and nobody ever reads a partial key
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp_path)
+    with open(path, encoding='utf-8') as f:
+        return f.read().strip()
+
 # Configuration
-app.secret_key = secrets.token_hex(16)
+app.secret_key = load_secret_key()
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)
 # Configure SQLite database URI
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'database.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SMART_TRASH_DATABASE_URI', 'sqlite:///' + os.path.join(basedir, 'database.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# SQLite storage profiles, applied by PRAGMA on every new connection.
+# 'default' keeps SQLite's stock settings (rollback journal, synchronous=FULL):
+# every commit is durable even on power loss, but readers block the writer.
+# 'production' switches to WAL so /level readers never wait on /update
+# writers. With synchronous=NORMAL a commit survives an application crash,
+# but the last transactions before a power loss or OS crash may be rolled
+# back (the WAL is only fsynced at checkpoints). The database is never
+# corrupted either way.
+SQLITE_PROFILES = {
+    'default': {},
+    'production': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000, # Negative means KiB: ~64 MB page cache per connection
+        'mmap_size': 268435456, # 256 MB of the file memory-mapped for reads
+        'busy_timeout': 5000, # Wait up to 5 s for the write lock instead of failing
+        'temp_store': 'MEMORY',
+    },
+}
+app.config['STORAGE_PROFILE'] = os.environ.get('SMART_TRASH_STORAGE_PROFILE', 'default')
+if app.config['STORAGE_PROFILE'] not in SQLITE_PROFILES:
+    raise RuntimeError(f"Unknown storage profile: {app.config['STORAGE_PROFILE']}")
+if app.config['STORAGE_PROFILE'] == 'production' and app.config['SQLALCHEMY_DATABASE_URI'] not in ('sqlite://', 'sqlite:///:memory:'):
+    # Explicit pool: connections (and their page cache / mmap) are reused
+    # across requests; check_same_thread is off because the pool hands a
+    # connection to whichever worker thread checks it out.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': QueuePool,
+        'pool_size': int(os.environ.get('SMART_TRASH_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('SMART_TRASH_POOL_MAX_OVERFLOW', 10)),
+        'pool_timeout': 30,
+        'connect_args': {'check_same_thread': False, 'timeout': 5},
+    }
+# Writes that hit "database is locked" (another worker holds the write lock)
+# are retried this many times with exponential backoff starting at DB_LOCK_BACKOFF_MS
+app.config['DB_LOCK_RETRIES'] = int(os.environ.get('SMART_TRASH_DB_LOCK_RETRIES', 5))
+app.config['DB_LOCK_BACKOFF_MS'] = 20
+# Bin state cache lifetime in seconds. Unset (no expiry) is right for a single
+# process, which sees every write; with several workers, or a separate
+# `flask sensor-listener`, set it to bound how stale another process's writes
+# can look on /level and /stats (writers detect stale state by its revision).
+app.config['BIN_CACHE_TTL_SECONDS'] = float(os.environ['SMART_TRASH_BIN_CACHE_TTL_SECONDS']) if os.environ.get('SMART_TRASH_BIN_CACHE_TTL_SECONDS') else None
+# Maximum number of readings accepted by one /update/batch request
+app.config['BATCH_MAX_READINGS'] = 5000
+# Readings stamped further ahead of the server clock than this (sensor clock
+# skew) are rejected, in /update/batch and in sensor frames
+app.config['READING_MAX_FUTURE_SECONDS'] = float(os.environ.get('SMART_TRASH_READING_MAX_FUTURE_SECONDS', 300))
+# Ingestion mode: 'sync' commits inside /update, 'queued' hands readings to a
+# background writer that commits in groups (write-behind)
+app.config['INGEST_MODE'] = os.environ.get('SMART_TRASH_INGEST_MODE', 'sync')
+app.config['INGEST_QUEUE_MAXSIZE'] = int(os.environ.get('SMART_TRASH_INGEST_QUEUE_MAXSIZE', 10000))
+app.config['INGEST_FLUSH_SIZE'] = int(os.environ.get('SMART_TRASH_INGEST_FLUSH_SIZE', 200))
+app.config['INGEST_FLUSH_INTERVAL_MS'] = int(os.environ.get('SMART_TRASH_INGEST_FLUSH_INTERVAL_MS', 250))
+# A bin without any update for this long is reported as stale by /bins
+app.config['BIN_STALE_HOURS'] = float(os.environ.get('SMART_TRASH_BIN_STALE_HOURS', 2))
+# Brotli quality for the precompressed dashboard (11 is smallest but slow)
+app.config['PAGE_BROTLI_QUALITY'] = 9
+# Server-Sent Events: heartbeat period, client reconnect delay, number of
+# events kept for Last-Event-ID resume and per-subscriber backlog
+app.config['SSE_HEARTBEAT_SECONDS'] = 15
+app.config['SSE_RETRY_MS'] = 3000
+app.config['SSE_REPLAY_SIZE'] = 1000
+app.config['SSE_SUBSCRIBER_QUEUE_SIZE'] = 256
+# Fill-rate forecasting: EWMA smoothing factor and how far ahead to look
+app.config['FORECAST_EWMA_ALPHA'] = 0.2
+app.config['FORECAST_HORIZON_HOURS'] = 24 * 14
+app.config['FORECAST_MIN_INTERVAL_MINUTES'] = 15 # Shortest interval turned into a rate sample
+# Spatial index cell size (~1 km) and route planner tuning
+app.config['SPATIAL_CELL_DEGREES'] = 0.01
+app.config['ROUTE_NEIGHBOURS'] = 8
+app.config['ROUTE_TIME_BUDGET_MS'] = int(os.environ.get('SMART_TRASH_ROUTE_TIME_BUDGET_MS', 2000))
+# History rollups: level counted as "above threshold" and retention windows
+# used by `flask compact-history`
+app.config['ROLLUP_THRESHOLD'] = 80
+app.config['HISTORY_RETENTION_DAYS'] = int(os.environ.get('SMART_TRASH_HISTORY_RETENTION_DAYS', 90))
+app.config['ROLLUP_HOURLY_RETENTION_DAYS'] = int(os.environ.get('SMART_TRASH_ROLLUP_HOURLY_RETENTION_DAYS', 730))
+# History compression: 'swinging-door' stores the points needed to redraw the
+# fill curve by linear interpolation within HISTORY_DEVIATION level points,
+# 'deadband' stores a reading when it moves more than HISTORY_DEVIATION away
+# from the last stored one (step curve), 'off' stores every reading
+app.config['HISTORY_COMPRESSION'] = os.environ.get('SMART_TRASH_HISTORY_COMPRESSION', 'swinging-door')
+app.config['HISTORY_DEVIATION'] = float(os.environ.get('SMART_TRASH_HISTORY_DEVIATION', 2))
+# Reading filters applied per bin before ingestion, as a comma-separated list
+# of stage:argument (see FILTER_STAGES), e.g. 'median:3,confirm-emptying:2'.
+# FILTER_PIPELINE_BINS overrides it for some bins: a JSON object of
+# {bin_number: pipeline}. Empty means readings are applied as received.
+# Filter state lives in each process: with several workers (or a separate
+# `flask sensor-listener`) a bin's readings are only filtered together if
+# they reach the same process, so send each device to one of them.
+app.config['FILTER_PIPELINE'] = os.environ.get('SMART_TRASH_FILTER_PIPELINE', '')
+app.config['FILTER_PIPELINE_BINS'] = json.loads(os.environ.get('SMART_TRASH_FILTER_PIPELINE_BINS', '{}'))
+# Alerts: who gets notified ('mailto:...' addresses and/or http(s) webhook
+# URLs, comma-separated), on which events, how often per bin, and retries
+app.config['ALERT_RECIPIENTS'] = [r.strip() for r in os.environ.get('SMART_TRASH_ALERT_RECIPIENTS', '').split(',') if r.strip()]
+app.config['ALERT_KINDS'] = os.environ.get('SMART_TRASH_ALERT_KINDS', 'critical,emptied').split(',')
+app.config['ALERT_LEVEL'] = 80
+app.config['ALERT_COOLDOWN_MINUTES'] = int(os.environ.get('SMART_TRASH_ALERT_COOLDOWN_MINUTES', 60))
+app.config['ALERT_BATCH_SECONDS'] = float(os.environ.get('SMART_TRASH_ALERT_BATCH_SECONDS', 30)) # Collection window per delivery
+app.config['ALERT_MAX_ATTEMPTS'] = 8
+app.config['ALERT_RETRY_BASE_SECONDS'] = 30 # Doubled after each failure, capped at an hour
+# 'thread' runs the dispatcher inside the web process; 'off' leaves it to
+# `flask alert-dispatcher` (one dispatcher for several workers)
+app.config['ALERT_DISPATCHER'] = os.environ.get('SMART_TRASH_ALERT_DISPATCHER', 'thread')
+app.config['ALERT_SMTP_HOST'] = os.environ.get('SMART_TRASH_SMTP_HOST', 'localhost')
+app.config['ALERT_SMTP_PORT'] = int(os.environ.get('SMART_TRASH_SMTP_PORT', 25))
+app.config['ALERT_SMTP_USER'] = os.environ.get('SMART_TRASH_SMTP_USER')
+app.config['ALERT_SMTP_PASSWORD'] = os.environ.get('SMART_TRASH_SMTP_PASSWORD')
+app.config['ALERT_SMTP_STARTTLS'] = os.environ.get('SMART_TRASH_SMTP_STARTTLS', '') == '1'
+app.config['ALERT_SMTP_FROM'] = os.environ.get('SMART_TRASH_SMTP_FROM', 'smart-trash@localhost')
+app.config['ALERT_WEBHOOK_TIMEOUT'] = 10
+# Recent-readings ring buffer: a memory-mapped file keeping the last
+# RECENT_BUFFER_READINGS History points of up to RECENT_BUFFER_BINS bins, read
+# by /level and /bins/<bin_number>/recent. Disabled unless a path is given.
+app.config['RECENT_BUFFER_PATH'] = os.environ.get('SMART_TRASH_RECENT_BUFFER_PATH')
+app.config['RECENT_BUFFER_BINS'] = int(os.environ.get('SMART_TRASH_RECENT_BUFFER_BINS', 16384))
+app.config['RECENT_BUFFER_READINGS'] = int(os.environ.get('SMART_TRASH_RECENT_BUFFER_READINGS', 64))
+# History export: rows fetched per keyset page (and written out) per chunk
+app.config['EXPORT_CHUNK_SIZE'] = int(os.environ.get('SMART_TRASH_EXPORT_CHUNK_SIZE', 5000))
+# Bulk bin import: rows upserted per statement (all chunks share one transaction)
+app.config['IMPORT_CHUNK_SIZE'] = int(os.environ.get('SMART_TRASH_IMPORT_CHUNK_SIZE', 5000))
+# Background reports: worker threads per process, where the files go, bins
+# aggregated per query, longest period, and how long a queued or running job
+# is trusted before it is considered lost (its process died)
+app.config['REPORT_WORKERS'] = int(os.environ.get('SMART_TRASH_REPORT_WORKERS', 2))
+app.config['REPORT_DIR'] = os.environ.get('SMART_TRASH_REPORT_DIR', os.path.join(app.instance_path, 'reports'))
+app.config['REPORT_CHUNK_BINS'] = 1000
+app.config['REPORT_MAX_DAYS'] = 92
+app.config['REPORT_TIMEOUT_MINUTES'] = 30
+# Binary sensor listener (`flask sensor-listener`): UDP and TCP port, and how
+# long a (device, sequence number) pair is remembered for deduplication
+app.config['SENSOR_LISTENER_HOST'] = os.environ.get('SMART_TRASH_SENSOR_LISTENER_HOST', '0.0.0.0')
+app.config['SENSOR_LISTENER_PORT'] = int(os.environ.get('SMART_TRASH_SENSOR_LISTENER_PORT', 5001))
+app.config['SENSOR_DEDUP_SECONDS'] = 600
+
 # Initialize SQLAlchemy
 db = SQLAlchemy(app)
 
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Applies the active storage profile to a freshly opened SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PROFILES[app.config['STORAGE_PROFILE']].items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', apply_sqlite_pragmas)
+
+def log_storage_settings():
+    """Logs the storage profile and the settings SQLite actually reports."""
+    with app.app_context():
+        settings = {}
+        if db.engine.dialect.name == 'sqlite':
+            with db.engine.connect() as conn:
+                for pragma in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'busy_timeout'):
+                    settings[pragma] = conn.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+        pool = db.engine.pool
+        message = (f"Storage profile '{app.config['STORAGE_PROFILE']}': {settings}, "
+                   f"pool={type(pool).__name__}(size={pool.size() if hasattr(pool, 'size') else 'n/a'})")
+    app.logger.info(message)
+
+# --- Metrics ---
+
+# Latency buckets in seconds, from sub-millisecond cache hits to slow commits
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """Process-wide counters, histograms and gauges rendered in Prometheus text format.
+
+    Updates are a dict lookup and an addition under one lock, cheap enough to
+    stay enabled in production.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {} # name -> (type, help)
+        self._counters = collections.defaultdict(float) # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> Histogram
+        self._gauges = {} # name -> callable returning a number
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help_text, buckets)
+
+    def gauge(self, name, help_text, read):
+        self._meta[name] = ('gauge', help_text)
+        self._gauges[name] = read
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self._meta[name][2])
+            histogram.observe(value)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    @staticmethod
+    def _number(value):
+        """Exact sample value: whole counts as integers, other floats with every digit."""
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h.counts), h.sum, h.count, h.buckets) for key, h in self._histograms.items()}
+        lines = []
+        for name, meta in sorted(self._meta.items()):
+            kind = meta[0]
+            lines.append(f"# HELP {name} {meta[1]}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'gauge':
+                try:
+                    lines.append(f"{name} {float(self._gauges[name]())}")
+                except Exception:
+                    pass # A gauge that can't be read right now is simply omitted
+            elif kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {self._number(value)}")
+            else:
+                for (metric, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.counter('smarttrash_http_requests_total', 'HTTP requests by route, method and status.')
+metrics.histogram('smarttrash_http_request_duration_seconds', 'HTTP request latency by route.')
+metrics.histogram('smarttrash_sql_queries_per_request', 'SQL statements executed per HTTP request.', COUNT_BUCKETS)
+metrics.histogram('smarttrash_sql_time_per_request_seconds', 'Time spent in SQL per HTTP request.')
+metrics.counter('smarttrash_sql_queries_total', 'SQL statements executed.')
+metrics.counter('smarttrash_sql_query_seconds_total', 'Time spent executing SQL statements.')
+metrics.histogram('smarttrash_db_commit_duration_seconds', 'Duration of session commits (flush + COMMIT).')
+metrics.counter('smarttrash_readings_ingested_total', 'Readings applied by status (ok, late).')
+metrics.counter('smarttrash_emptyings_detected_total', 'Emptying events detected during ingestion.')
+metrics.counter('smarttrash_history_rows_written_total', 'History rows inserted.')
+metrics.counter('smarttrash_db_lock_retries_total', 'Writes retried after "database is locked".')
+metrics.counter('smarttrash_bin_state_conflicts_total', 'Ingestions restarted because a cached bin state was stale.')
+
+class RequestSqlUsage:
+    """SQL statements and time spent by the request being served."""
+    __slots__ = ('statements', 'seconds')
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+# Set per request by the Flask hooks and by asgi.py; a context variable
+# rather than flask.g so the ASGI routes, which run their database work in
+# a thread pool without a request context, are counted as well
+request_sql_usage = contextvars.ContextVar('request_sql_usage', default=None)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, which dies with the statement whether it
+    # succeeds or raises
+    if context is not None:
+        context.query_start = time.perf_counter()
+
+def _record_query_time(context):
+    started = getattr(context, 'query_start', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    metrics.inc('smarttrash_sql_queries_total')
+    metrics.inc('smarttrash_sql_query_seconds_total', elapsed)
+    usage = request_sql_usage.get()
+    if usage is not None:
+        usage.statements += 1
+        usage.seconds += elapsed
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    _record_query_time(context)
+
+@event.listens_for(Engine, 'handle_error')
+def _stop_failed_query_timer(exception_context):
+    # Failed statements count too: a "database is locked" one may have
+    # waited the whole busy timeout
+    _record_query_time(exception_context.execution_context)
+
+@event.listens_for(db.session, 'before_commit')
+def _start_commit_timer(session):
+    session.info['commit_start'] = time.perf_counter()
+
+@event.listens_for(db.session, 'after_commit')
+def _stop_commit_timer(session):
+    started = session.info.pop('commit_start', None)
+    if started is not None:
+        metrics.observe('smarttrash_db_commit_duration_seconds', time.perf_counter() - started)
+
+def record_request_metrics(route, method, status, duration, usage):
+    """Per-route request metrics, shared by the Flask hooks and asgi.py."""
+    metrics.inc('smarttrash_http_requests_total', route=route, method=method, status=status)
+    metrics.observe('smarttrash_http_request_duration_seconds', duration, route=route)
+    metrics.observe('smarttrash_sql_queries_per_request', usage.statements, route=route)
+    metrics.observe('smarttrash_sql_time_per_request_seconds', usage.seconds, route=route)
+
+@app.before_request
+def _start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.sql_usage_token = request_sql_usage.set(RequestSqlUsage())
+
+@app.after_request
+def _record_request_metrics(response):
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        record_request_metrics(route, request.method, response.status_code, time.perf_counter() - g.request_start,
+                               request_sql_usage.get())
+    return response
+
+@app.teardown_request
+def _stop_request_metrics(exc):
+    if 'sql_usage_token' in g:
+        request_sql_usage.reset(g.pop('sql_usage_token'))
+
 # --- Database Models ---
 
 class User(db.Model):
@@ -41,6 +488,15 @@ class Bin(db.Model):
     current_level = db.Column(db.Integer, nullable=False, default=0)
     last_updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     last_emptied_timestamp = db.Column(db.DateTime, nullable=True) # <-- NOUVEAU CHAMP
+    # Optional WGS84 coordinates, used by the spatial index and /route
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    # Bumped in the same statement as every write to the row, so sum(revision)
+    # tells that some bin changed, whatever the timestamps (ETag of /bins)
+    revision = db.Column(db.Integer, nullable=False, server_default='0') # Server-side: INSERTs never name it
+    # Bumped only when the number, address or coordinates change (/config and
+    # bin imports), so report cache keys survive the readings
+    config_revision = db.Column(db.Integer, nullable=False, server_default='0')
     # Relationship to History
     history_entries = db.relationship('History', backref='bin', lazy=True, cascade="all, delete-orphan")
 
@@ -49,6 +505,246 @@ class History(db.Model):
     bin_id = db.Column(db.Integer, db.ForeignKey('bin.id'), nullable=False)
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     level = db.Column(db.Integer, nullable=False)
+    # Covers every per-bin read (/level, /bins/<n>/history, curves): rows of a
+    # bin in (timestamp, id) order, with the level, straight from the index
+    __table_args__ = (db.Index('ix_history_bin_timestamp', 'bin_id', 'timestamp', 'id', 'level'),)
+
+class RollupMixin:
+    """Per-bin aggregate of the readings received during one time bucket."""
+    id = db.Column(db.Integer, primary_key=True)
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    min_level = db.Column(db.Integer, nullable=True) # NULL when the bucket only carries time above threshold
+    max_level = db.Column(db.Integer, nullable=True)
+    level_sum = db.Column(db.Integer, nullable=False, default=0)
+    reading_count = db.Column(db.Integer, nullable=False, default=0)
+    seconds_above_threshold = db.Column(db.Float, nullable=False, default=0.0)
+    emptied_count = db.Column(db.Integer, nullable=False, default=0)
+
+    @declared_attr
+    def bin_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('bin.id'), nullable=False)
+
+    @declared_attr
+    def __table_args__(cls):
+        return (db.UniqueConstraint('bin_id', 'bucket_start', name=f'uq_{cls.__tablename__}_bin_bucket'),)
+
+    def to_dict(self):
+        return {
+            "bucket": self.bucket_start.isoformat(),
+            "min": self.min_level,
+            "max": self.max_level,
+            "mean": round(self.level_sum / self.reading_count, 2) if self.reading_count else None,
+            "count": self.reading_count,
+            "seconds_above_threshold": round(self.seconds_above_threshold, 1),
+            "emptied": self.emptied_count
+        }
+
+class HistoryHourly(RollupMixin, db.Model):
+    __tablename__ = 'history_hourly'
+
+class HistoryDaily(RollupMixin, db.Model):
+    __tablename__ = 'history_daily'
+
+class AlertJob(db.Model):
+    """A notification waiting for (or done with) delivery to one recipient."""
+    __tablename__ = 'alert_job'
+    id = db.Column(db.Integer, primary_key=True)
+    bin_id = db.Column(db.Integer, db.ForeignKey('bin.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False) # 'critical' or 'emptied'
+    recipient = db.Column(db.String(300), nullable=False)
+    level = db.Column(db.Integer, nullable=False)
+    event_time = db.Column(db.DateTime, nullable=False) # Latest reading coalesced into this alert
+    occurrences = db.Column(db.Integer, nullable=False, default=1)
+    status = db.Column(db.String(20), nullable=False, default='pending') # pending, sending, sent, failed, cancelled
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claim = db.Column(db.String(32), nullable=True) # Dispatcher run currently delivering it
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_alert_job_status_next', 'status', 'next_attempt_at'),
+                      db.Index('ix_alert_job_bin_kind', 'bin_id', 'kind', 'recipient', 'status'))
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "bin_id": self.bin_id,
+            "kind": self.kind,
+            "recipient": self.recipient,
+            "level": self.level,
+            "event_time": self.event_time.isoformat(),
+            "occurrences": self.occurrences,
+            "status": self.status,
+            "attempts": self.attempts,
+            "next_attempt_at": self.next_attempt_at.isoformat() if self.status == 'pending' else None,
+            "sent_at": self.sent_at.isoformat() if self.sent_at else None,
+            "last_error": self.last_error,
+        }
+
+class FleetStat(db.Model):
+    """Incrementally maintained fleet aggregate: bins, level sum and critical bins per (dimension, key).
+
+    Dimensions: 'band' (fill band), 'zone' (last part of the location),
+    'updated_hour' (hour of last_updated, for staleness) and 'emptied_day'
+    (bin_count holds the number of emptyings that day).
+    """
+    __tablename__ = 'fleet_stat'
+    id = db.Column(db.Integer, primary_key=True)
+    dimension = db.Column(db.String(20), nullable=False)
+    key = db.Column(db.String(200), nullable=False)
+    bin_count = db.Column(db.Integer, nullable=False, default=0)
+    level_sum = db.Column(db.Integer, nullable=False, default=0)
+    critical_count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('dimension', 'key', name='uq_fleet_stat_dimension_key'),)
+
+class ReportJob(db.Model):
+    """A fill and emptying report over a period, queued, being built or stored on disk."""
+    __tablename__ = 'report_job'
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), nullable=False) # Format, period and data watermark
+    format = db.Column(db.String(10), nullable=False) # 'pdf' or 'xlsx'
+    period_start = db.Column(db.DateTime, nullable=False)
+    period_end = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued, running, done, failed
+    file_name = db.Column(db.String(200), nullable=True)
+    size = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (db.Index('ix_report_job_cache_key', 'cache_key', 'status'),)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "format": self.format,
+            "start": self.period_start.isoformat(),
+            "end": self.period_end.isoformat(),
+            "status": self.status,
+            "size": self.size,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "download": url_for('download_report', report_id=self.id) if self.status == 'done' else None,
+        }
+
+class SchemaVersion(db.Model):
+    """One row per applied schema migration; the highest version is the schema's."""
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# --- Bin State Cache ---
+
+class BinState:
+    """Snapshot of the hot columns of a Bin row, shared by /update and /level."""
+    __slots__ = ('id', 'bin_number', 'location', 'current_level', 'last_updated', 'last_emptied_timestamp', 'revision')
+
+    def __init__(self, id, bin_number, location, current_level, last_updated, last_emptied_timestamp, revision=0):
+        self.id = id
+        self.bin_number = bin_number
+        self.location = location
+        self.current_level = current_level
+        self.last_updated = last_updated
+        self.last_emptied_timestamp = last_emptied_timestamp
+        self.revision = revision # Bin.revision the snapshot was taken at
+
+    @classmethod
+    def from_bin(cls, bin_row):
+        return cls(bin_row.id, bin_row.bin_number, bin_row.location, bin_row.current_level,
+                   bin_row.last_updated, bin_row.last_emptied_timestamp, bin_row.revision)
+
+    def copy(self):
+        return BinState(self.id, self.bin_number, self.location, self.current_level,
+                        self.last_updated, self.last_emptied_timestamp, self.revision)
+
+class BinStateCache:
+    """Process-wide cache of bin state keyed by both id and bin_number.
+
+    Entries are immutable snapshots: writers build a modified copy and swap it
+    in with put() once their transaction has committed (write-through), so
+    readers never see uncommitted or half-updated state. Misses fall back to
+    one query and populate the cache; unknown bins are not cached.
+
+    Other processes (web workers, the sensor listener) write behind this
+    cache's back: `ttl` (seconds) then bounds how stale a read can be.
+    Writers still start from the cached state, but their UPDATE only matches
+    the revision they read, and a miss makes them start over with fresh=True.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._by_id = {}
+        self._by_number = {}
+        self._loaded_at = {} # bin id -> time.monotonic() of the snapshot
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, state):
+        with self._lock:
+            previous = self._by_id.get(state.id)
+            if previous is not None and previous.bin_number != state.bin_number:
+                self._by_number.pop(previous.bin_number, None)
+            self._by_id[state.id] = state
+            self._by_number[state.bin_number] = state
+            self._loaded_at[state.id] = time.monotonic()
+
+    def _usable(self, state, fresh):
+        if state is None or fresh:
+            return False
+        return self.ttl is None or time.monotonic() - self._loaded_at.get(state.id, 0) < self.ttl
+
+    def invalidate(self, bin_id=None):
+        """Drops one bin (or everything when bin_id is None)."""
+        with self._lock:
+            if bin_id is None:
+                self._by_id.clear()
+                self._by_number.clear()
+                return
+            previous = self._by_id.pop(bin_id, None)
+            if previous is not None:
+                self._by_number.pop(previous.bin_number, None)
+
+    def get(self, bin_id, fresh=False):
+        state = self._by_id.get(bin_id)
+        if self._usable(state, fresh):
+            self.hits += 1
+            return state
+        self.misses += 1
+        bin_row = db.session.get(Bin, bin_id, populate_existing=fresh) # fresh: not the session's copy either
+        if bin_row is None:
+            return None
+        state = BinState.from_bin(bin_row)
+        self.put(state)
+        return state
+
+    def get_many_by_number(self, bin_numbers, fresh=False):
+        """Returns {bin_number: state}, loading every miss with a single query."""
+        found = {}
+        missing = []
+        for bin_number in bin_numbers:
+            state = self._by_number.get(bin_number)
+            if self._usable(state, fresh):
+                found[bin_number] = state
+            else:
+                missing.append(bin_number)
+        self.hits += len(found)
+        if missing:
+            self.misses += len(missing)
+            query = Bin.query.filter(Bin.bin_number.in_(missing))
+            for bin_row in (query.populate_existing() if fresh else query).all():
+                state = BinState.from_bin(bin_row)
+                self.put(state)
+                found[state.bin_number] = state
+        return found
+
+    def get_by_number(self, bin_number):
+        return self.get_many_by_number([bin_number]).get(bin_number)
+
+bin_cache = BinStateCache(app.config['BIN_CACHE_TTL_SECONDS'])
 
 # --- Helper Functions ---
 
@@ -57,43 +753,2876 @@ def get_default_bin():
     # Use db.session.get for primary key lookup (more efficient)
     return db.session.get(Bin, 1)
 
-# --- Routes ---
+def get_default_bin_state():
+    """Cached state of the default bin (ID=1), without a query on cache hits."""
+    return bin_cache.get(1)
 
-# Middleware for authentication
-def login_required(f):
-    @wraps(f) # Use wraps from functools
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('Veuillez vous connecter pour accéder à cette page.', 'warning')
-            return redirect(url_for('login', next=request.url))
-        return f(*args, **kwargs)
-    return decorated_function
+def parse_reading_timestamp(value, default):
+    """Parses a reading timestamp (ISO 8601 string or UNIX epoch) into naive UTC."""
+    if value is None or value == '':
+        return default
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.utcfromtimestamp(value)
+    if isinstance(value, str):
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo is not None:
+            # Store everything as naive UTC, like datetime.utcnow()
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+    raise ValueError(f"timestamp invalide: {value!r}")
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    """Handles the login page."""
-    if 'user_id' in session:
-        return redirect(url_for('index')) # Redirect if already logged in
+def is_future_reading(timestamp, now):
+    """True when a reading is stamped further ahead of `now` than the allowed clock skew.
 
-    error = None
-    if request.method == 'POST':
-        username = request.form.get('username')
-        password = request.form.get('password')
-        # Use case-insensitive query for username
-        user = User.query.filter(User.username.ilike(username)).first()
+    Such a reading would become the bin's last_updated, and every real reading
+    after it would then be treated as late.
+    """
+    return timestamp - now > timedelta(seconds=app.config['READING_MAX_FUTURE_SECONDS'])
 
-        if user and user.check_password(password):
-            session.permanent = True
-            session['user_id'] = user.id
-            session['username'] = user.username
-            flash('Connexion réussie !', 'success')
-            next_page = request.args.get('next')
-            return redirect(next_page or url_for('index'))
-        else:
-            error = "Identifiants incorrects. Veuillez réessayer."
+def apply_level_reading(target_bin, new_level, now):
+    """Applies one reading to a bin (Bin row or BinState).
+
+    Returns True when the reading is detected as an emptying of the bin.
+    Which readings reach History is decided by the HistoryCompressor.
+    """
+    # Get the level *before* updating
+    old_level = target_bin.current_level
+
+    # Update bin level and last updated time
+    target_bin.current_level = new_level
+    target_bin.last_updated = now
+
+    # Check for emptying condition: old level >= 80 and new level <= 20
+    emptied = old_level >= 80 and new_level <= 20
+    if emptied:
+        target_bin.last_emptied_timestamp = now
+        app.logger.info(f"Bin {target_bin.bin_number} emptied detected at {now}. Old level: {old_level}, New level: {new_level}")
+
+    return emptied
+
+def compute_etag(*parts):
+    """Builds a strong ETag value from the parts that determine a response."""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+def is_not_modified(etag, last_modified=None, if_none_match=None, if_modified_since=None):
+    """True when the client's cached copy (If-None-Match / If-Modified-Since) is current.
+
+    The conditional headers default to those of the current Flask request.
+    """
+    if if_none_match is None and if_modified_since is None:
+        if_none_match, if_modified_since = request.if_none_match, request.if_modified_since
+    if if_none_match:
+        return if_none_match.contains(etag)
+    if if_modified_since and last_modified:
+        # HTTP dates have second precision; our timestamps are naive UTC
+        return last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= if_modified_since
+    return False
+
+def conditional_json(build_payload, etag, last_modified=None):
+    """Returns 304 when the client is current, else the JSON built by `build_payload`.
+
+    The payload is only built (and its queries only run) on a cache miss.
+    """
+    if is_not_modified(etag, last_modified):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    # Let clients cache but always revalidate
+    response.cache_control.no_cache = True
+    return response
+
+def is_database_locked(error):
+    """True for SQLITE_BUSY / SQLITE_LOCKED (and their extended codes), the errors worth retrying."""
+    error = getattr(error, 'orig', error)
+    error_name = getattr(error, 'sqlite_errorname', None) # Python 3.11+
+    if error_name is not None:
+        return error_name.startswith(('SQLITE_BUSY', 'SQLITE_LOCKED'))
+    return str(error) in ('database is locked', 'database table is locked')
+
+def run_with_lock_retry(operation):
+    """Runs operation() (a unit of work ending in a commit), retrying while SQLite reports a lock.
+
+    busy_timeout already waits for the lock, but a WAL transaction that read
+    before another worker's commit gets SQLITE_BUSY at once when it tries to
+    write: rolling back and starting over is the only way out.
+    """
+    retries = app.config['DB_LOCK_RETRIES']
+    for attempt in range(retries + 1):
+        try:
+            return operation()
+        except OperationalError as e:
+            db.session.rollback()
+            if attempt == retries or not is_database_locked(e):
+                raise
+            metrics.inc('smarttrash_db_lock_retries_total')
+            delay = app.config['DB_LOCK_BACKOFF_MS'] / 1000 * 2 ** attempt
+            time.sleep(delay * random.uniform(0.5, 1.5)) # Jitter so workers don't retry in lockstep
+
+# UPDATE of a bin's reading state by id, only if nobody wrote it since it was
+# read (bind names can't be the column names)
+bin_state_update = Bin.__table__.update().where(Bin.__table__.c.id == db.bindparam('bin_id'),
+                                                Bin.__table__.c.revision == db.bindparam('read_revision')).values(
+    current_level=db.bindparam('level'), last_updated=db.bindparam('updated'),
+    last_emptied_timestamp=db.bindparam('emptied'), revision=Bin.__table__.c.revision + 1)
+
+class StaleBinState(Exception):
+    """Raised when a bin's revision moved between the read and the UPDATE."""
+
+def save_history_rows(history_rows):
+    """Inserts the collected History rows in a single executemany statement."""
+    if history_rows:
+        db.session.execute(db.insert(History), history_rows)
+
+# One applied reading, handed to the listeners after commit. Late readings
+# (older than the bin's state) have late=True and no previous reading.
+AppliedReading = collections.namedtuple('AppliedReading', [
+    'bin_id', 'bin_number', 'location', 'level', 'timestamp',
+    'previous_level', 'previous_timestamp', 'emptied', 'last_emptied_timestamp', 'late'
+])
+
+# Callbacks run with the list of AppliedReading after every committed
+# ingestion transaction (SSE, forecasting, ...). Their errors are only
+# logged: anything that must not be lost (alerts) is written before the commit.
+reading_listeners = []
+
+def on_readings_committed(listener):
+    """Registers a callback run after every committed ingestion transaction."""
+    reading_listeners.append(listener)
+    return listener
+
+@on_readings_committed
+def count_ingested_readings(applied):
+    late = sum(1 for r in applied if r.late)
+    metrics.inc('smarttrash_readings_ingested_total', len(applied) - late, status='ok')
+    if late:
+        metrics.inc('smarttrash_readings_ingested_total', late, status='late')
+    emptied = sum(1 for r in applied if r.emptied)
+    if emptied:
+        metrics.inc('smarttrash_emptyings_detected_total', emptied)
+
+def ingest_readings(readings):
+    """Applies many readings in one transaction and returns one outcome per reading.
+
+    `readings` is a list of (bin_number or None, level, timestamp) tuples; a
+    None bin_number targets the default bin. Bins are resolved with one
+    query, readings are applied per bin in timestamp order (input order breaks
+    ties) and everything is committed once. Returns (outcomes, history_written);
+    on commit failure the session is rolled back and the exception re-raised.
+
+    Bins come from the cache (misses: one query). Another process (web
+    worker, sensor listener, CLI) may have written since, with or without a
+    TTL: the UPDATE then matches no row for its revision, and the whole unit
+    of work starts over from the committed rows.
+    """
+    def unit_of_work(fresh):
+        """Read, compute and write in one transaction: a retry starts over from scratch."""
+        outcomes = [None] * len(readings)
+
+        # Resolve every referenced bin with at most one query. Readings are
+        # applied to private copies so a failed commit leaves the cache untouched.
+        bin_numbers = {bin_number for bin_number, _, _ in readings if bin_number is not None}
+        states_by_number = bin_cache.get_many_by_number(bin_numbers, fresh=fresh) if bin_numbers else {}
+        default_state = bin_cache.get(1, fresh=fresh) if any(bin_number is None for bin_number, _, _ in readings) else None
+
+        # Group readings per bin, then apply them in timestamp order
+        per_bin = {}
+        states_by_id = {} # Committed state of each bin, before this batch
+        for index, (bin_number, level, timestamp) in enumerate(readings):
+            state = states_by_number.get(bin_number) if bin_number is not None else default_state
+            if state is None:
+                error = f"Poubelle {bin_number} non trouvée" if bin_number is not None else "Aucune poubelle par défaut trouvée (ID=1)"
+                outcomes[index] = {"status": "error", "error": error}
+                continue
+            if state.id not in per_bin:
+                per_bin[state.id] = (state.copy(), [])
+                states_by_id[state.id] = state
+            per_bin[state.id][1].append((timestamp, index, level))
+
+        history_rows = []
+        bin_updates = []
+        rollups = RollupAccumulator(app.config['ROLLUP_THRESHOLD'])
+        compressor_states = {}
+        filter_states = {}
+        stats_delta = FleetStatsDelta()
+        applied = []
+        for target_bin, bin_readings in per_bin.values():
+            bin_readings.sort(key=lambda r: (r[0], r[1]))
+            changed = False
+            compression = compressor_states[target_bin.id] = history_compressor.state_for(target_bin)
+            filter_state = filter_states[target_bin.id] = reading_filters.state_for(target_bin)
+            for timestamp, index, level in bin_readings:
+                if target_bin.last_updated and timestamp < target_bin.last_updated:
+                    # Late reading from a buffered device: keep it in History
+                    # (uncompressed, the curve has moved on) but don't move the
+                    # bin's current state backwards.
+                    history_rows.append({"bin_id": target_bin.id, "level": level, "timestamp": timestamp})
+                    rollups.add_reading(target_bin.id, level, timestamp)
+                    applied.append(AppliedReading(target_bin.id, target_bin.bin_number, target_bin.location, level, timestamp,
+                                                  None, None, False, target_bin.last_emptied_timestamp, True))
+                    outcomes[index] = {"status": "late", "bin_number": target_bin.bin_number, "last_emptied_detected": False}
+                    continue
+                raw_level = level
+                level = reading_filters.apply(target_bin, filter_state, level, timestamp)
+                if level is None:
+                    outcomes[index] = {"status": "filtered", "bin_number": target_bin.bin_number, "last_emptied_detected": False}
+                    continue
+                previous_level, previous_timestamp = target_bin.current_level, target_bin.last_updated
+                emptied = apply_level_reading(target_bin, level, timestamp)
+                if emptied:
+                    stats_delta.emptied(timestamp)
+                for point_time, point_level in history_compressor.add(compression, timestamp, level, emptied):
+                    history_rows.append({"bin_id": target_bin.id, "level": point_level, "timestamp": point_time})
+                rollups.add_reading(target_bin.id, level, timestamp, previous_level, previous_timestamp, emptied)
+                applied.append(AppliedReading(target_bin.id, target_bin.bin_number, target_bin.location, level, timestamp,
+                                              previous_level, previous_timestamp, emptied, target_bin.last_emptied_timestamp, False))
+                changed = True
+                outcomes[index] = {"status": "ok", "bin_number": target_bin.bin_number, "last_emptied_detected": emptied}
+                if level != raw_level:
+                    outcomes[index]["applied_level"] = level
+            if changed:
+                stats_delta.move(states_by_id[target_bin.id], target_bin)
+                bin_updates.append({
+                    "bin_id": target_bin.id,
+                    "read_revision": target_bin.revision,
+                    "level": target_bin.current_level,
+                    "updated": target_bin.last_updated,
+                    "emptied": target_bin.last_emptied_timestamp
+                })
+                target_bin.revision += 1
+
+        if bin_updates:
+            # One executemany UPDATE by primary key: no SELECT of the Bin rows needed
+            if db.session.execute(bin_state_update, bin_updates).rowcount != len(bin_updates):
+                raise StaleBinState()
+        save_history_rows(history_rows)
+        rollups.flush()
+        stats_delta.flush()
+        alert_counts = queue_alerts(applied, datetime.utcnow())
+        db.session.commit()
+        return outcomes, per_bin, compressor_states, filter_states, stats_delta, applied, history_rows, alert_counts
+
+    try:
+        try:
+            result = run_with_lock_retry(lambda: unit_of_work(fresh=False))
+        except StaleBinState:
+            db.session.rollback()
+            metrics.inc('smarttrash_bin_state_conflicts_total')
+            result = run_with_lock_retry(lambda: unit_of_work(fresh=True))
+        outcomes, per_bin, compressor_states, filter_states, stats_delta, applied, history_rows, alert_counts = result
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error applying batch update: {e}")
+        raise
+
+    # Write-through: publish the committed state to the cache
+    for target_bin, _ in per_bin.values():
+        bin_cache.put(target_bin)
+    history_compressor.commit(compressor_states)
+    reading_filters.commit(filter_states)
+    buffer_history_rows(history_rows)
+    fleet_stats.apply(stats_delta)
+    metrics.inc('smarttrash_history_rows_written_total', len(history_rows))
+    for (kind, outcome), count in alert_counts.items():
+        metrics.inc('smarttrash_alerts_total', count, kind=kind, outcome=outcome)
+    if alert_counts and app.config['ALERT_DISPATCHER'] == 'thread':
+        alert_dispatcher.start()
+    for listener in reading_listeners:
+        try:
+            listener(applied)
+        except Exception as e:
+            # The readings are committed: a failing consumer must not fail ingestion
+            app.logger.error(f"Reading listener {listener.__name__} failed: {e}", exc_info=True)
+
+    return outcomes, len(history_rows)
+
+# --- History Rollups ---
+
+def floor_to_hour(ts):
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+def floor_to_day(ts):
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+# (model, bucket floor function, bucket length)
+ROLLUP_GRANULARITIES = {
+    'hour': (HistoryHourly, floor_to_hour, timedelta(hours=1)),
+    'day': (HistoryDaily, floor_to_day, timedelta(days=1)),
+}
+
+ROLLUP_COLUMNS = ('min_level', 'max_level', 'level_sum', 'reading_count', 'seconds_above_threshold', 'emptied_count')
+
+def rollup_merge(table, excluded):
+    """SET clause adding a rollup delta (`excluded`) to an existing row."""
+    # min()/max() of SQLite return NULL if either side is NULL
+    return {
+        "min_level": func.min(func.coalesce(table.c.min_level, excluded.min_level), func.coalesce(excluded.min_level, table.c.min_level)),
+        "max_level": func.max(func.coalesce(table.c.max_level, excluded.max_level), func.coalesce(excluded.max_level, table.c.max_level)),
+        **{column: table.c[column] + excluded[column] for column in ROLLUP_COLUMNS[2:]}
+    }
+
+def rollup_daily_trigger(event):
+    """DDL of the trigger folding each INSERT or UPDATE of an hourly row into its daily row.
+
+    Ingestion only upserts history_hourly; SQLite adds the same delta to
+    history_daily within that statement (NEW - OLD for an updated hour), so
+    the daily table costs no statement of its own. bucket_start is stored as
+    text by SQLAlchemy ('YYYY-MM-DD HH:MM:SS.ffffff'): the day is a prefix.
+    """
+    delta = (lambda column: f"NEW.{column} - OLD.{column}") if event == 'UPDATE' else (lambda column: f"NEW.{column}")
+    additive = ROLLUP_COLUMNS[2:]
+    return f"""
+        CREATE TRIGGER IF NOT EXISTS history_hourly_{event.lower()}_daily AFTER {event} ON history_hourly
+        BEGIN
+            INSERT INTO history_daily (bin_id, bucket_start, {', '.join(ROLLUP_COLUMNS)})
+            VALUES (NEW.bin_id, substr(NEW.bucket_start, 1, 10) || ' 00:00:00.000000', NEW.min_level, NEW.max_level,
+                    {', '.join(delta(column) for column in additive)})
+            ON CONFLICT (bin_id, bucket_start) DO UPDATE SET
+                min_level = min(coalesce(min_level, excluded.min_level), coalesce(excluded.min_level, min_level)),
+                max_level = max(coalesce(max_level, excluded.max_level), coalesce(excluded.max_level, max_level)),
+                {', '.join(f"{column} = {column} + excluded.{column}" for column in additive)};
+        END"""
+
+class RollupAccumulator:
+    """Collects hourly rollup deltas during one ingestion transaction.
+
+    Deltas are merged in memory per (bin, hour) and written with one upsert
+    statement in flush(), so a batch of readings costs one extra statement
+    whatever its size. The daily rows follow through rollup_daily_trigger().
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.deltas = {} # (bin_id, hour_start) -> [min, max, sum, count, seconds, emptied]
+
+    def _delta(self, bin_id, bucket_start):
+        key = (bin_id, bucket_start)
+        delta = self.deltas.get(key)
+        if delta is None:
+            delta = self.deltas[key] = [None, None, 0, 0, 0.0, 0]
+        return delta
+
+    def add_reading(self, bin_id, level, timestamp, previous_level=None, previous_timestamp=None, emptied=False):
+        """Accounts one reading; the previous reading gives the time spent above threshold."""
+        delta = self._delta(bin_id, floor_to_hour(timestamp))
+        delta[0] = level if delta[0] is None else min(delta[0], level)
+        delta[1] = level if delta[1] is None else max(delta[1], level)
+        delta[2] += level
+        delta[3] += 1
+        delta[5] += int(emptied)
+
+        if previous_level is None or previous_timestamp is None or previous_level < self.threshold:
+            return
+        # The bin stayed above threshold from the previous reading until
+        # this one: spread that interval over every hour it covers.
+        start = previous_timestamp
+        while start < timestamp:
+            bucket_start = floor_to_hour(start)
+            end = min(bucket_start + timedelta(hours=1), timestamp)
+            self._delta(bin_id, bucket_start)[4] += (end - start).total_seconds()
+            start = end
+
+    def flush(self):
+        if not self.deltas:
+            return
+        rows = [{"bin_id": bin_id, "bucket_start": bucket_start, **dict(zip(ROLLUP_COLUMNS, d))}
+                for (bin_id, bucket_start), d in self.deltas.items()]
+        db.session.execute(hourly_rollup_upsert, rows)
+
+def build_hourly_rollup_upsert():
+    table = HistoryHourly.__table__
+    stmt = sqlite_insert(table)
+    return stmt.on_conflict_do_update(index_elements=[table.c.bin_id, table.c.bucket_start],
+                                      set_=rollup_merge(table, stmt.excluded))
+
+# Built once: constructing an upsert costs more than running it on a few rows
+hourly_rollup_upsert = build_hourly_rollup_upsert()
+
+# --- Fleet Statistics ---
+#
+# Ingestion turns every bin state change into +1/-1 deltas on a handful of
+# FleetStat rows (old band/zone/hour out, new ones in) and upserts them in
+# the same transaction, so the table stays exact across worker processes.
+# /stats reads that small table, cached in memory, and never scans Bin.
+
+FLEET_BANDS = (('0-25', 25), ('25-50', 50), ('50-80', 80), ('80-100', None))
+NEVER_UPDATED = 'never'
+
+def fleet_band(level):
+    for name, upper in FLEET_BANDS:
+        if upper is None or level < upper:
+            return name
+
+def zone_of(location):
+    """Zone of a bin: the last comma-separated part of its address (postcode and city)."""
+    return location.rsplit(',', 1)[-1].strip() or location
+
+def hour_key(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H') if timestamp else NEVER_UPDATED
+
+class FleetStatsDelta:
+    """Pending changes to FleetStat rows: (dimension, key) -> [bins, level sum, critical bins]."""
+
+    def __init__(self):
+        self.changes = collections.defaultdict(lambda: [0, 0, 0])
+
+    def add(self, dimension, key, bins, level_sum=0, critical=0):
+        change = self.changes[(dimension, key)]
+        change[0] += bins
+        change[1] += level_sum
+        change[2] += critical
+
+    def move(self, old, new):
+        """Accounts for a bin going from state `old` to `new` (None for a created or deleted bin)."""
+        for state, sign in ((old, -1), (new, 1)):
+            if state is None:
+                continue
+            critical = sign if state.current_level >= 80 else 0
+            self.add('band', fleet_band(state.current_level), sign, sign * state.current_level, critical)
+            self.add('zone', zone_of(state.location), sign, sign * state.current_level, critical)
+            self.add('updated_hour', hour_key(state.last_updated), sign)
+
+    def emptied(self, timestamp):
+        self.add('emptied_day', timestamp.date().isoformat(), 1)
+
+    def rows(self):
+        return [{"dimension": dimension, "key": key, "bin_count": c[0], "level_sum": c[1], "critical_count": c[2]}
+                for (dimension, key), c in self.changes.items() if any(c)]
+
+    def flush(self):
+        """Adds the deltas to the table, inside the caller's transaction."""
+        rows = self.rows()
+        if not rows:
+            return
+        db.session.execute(fleet_stat_upsert, rows)
+        # Hours nobody is left in keep a zero row until compact-history
+        # prunes them: deleting them here would cost a statement per write
+
+def build_fleet_stat_upsert():
+    table = FleetStat.__table__
+    stmt = sqlite_insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.dimension, table.c.key],
+        set_={
+            "bin_count": table.c.bin_count + stmt.excluded.bin_count,
+            "level_sum": table.c.level_sum + stmt.excluded.level_sum,
+            "critical_count": table.c.critical_count + stmt.excluded.critical_count,
+        }
+    )
+
+fleet_stat_upsert = build_fleet_stat_upsert()
+
+class FleetStats:
+    """In-memory copy of the FleetStat table, kept current with the deltas this process commits.
+
+    With several workers (bin cache TTL set) it is reloaded once older than
+    the TTL, since other workers' deltas only reach the table.
+    """
+
+    def __init__(self):
+        self._values = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        self.version = 0 # Bumped on every change, for ETags
+
+    def ensure_loaded(self):
+        """Loads the table on first use, and again once older than the cache TTL."""
+        ttl = bin_cache.ttl
+        if self._values is None or (ttl is not None and time.monotonic() - self._loaded_at >= ttl):
+            rows = db.session.query(FleetStat.dimension, FleetStat.key, FleetStat.bin_count,
+                                    FleetStat.level_sum, FleetStat.critical_count).all()
+            values = {(r.dimension, r.key): [r.bin_count, r.level_sum, r.critical_count] for r in rows}
+            with self._lock:
+                if values != self._values:
+                    self.version += 1
+                self._values, self._loaded_at = values, time.monotonic()
+
+    def apply(self, delta):
+        with self._lock:
+            if self._values is None:
+                return # Not loaded yet: the first read gets the committed table
+            for key, change in delta.changes.items():
+                value = self._values.setdefault(key, [0, 0, 0])
+                for i in range(3):
+                    value[i] += change[i]
+            self.version += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+            self.version += 1
+
+    def snapshot(self, now, stale_hours, days):
+        """The /stats payload: bands, zones, staleness and emptyings per day."""
+        self.ensure_loaded()
+        with self._lock:
+            values = {key: list(value) for key, value in self._values.items()}
+        by_dimension = collections.defaultdict(dict)
+        for (dimension, key), value in values.items():
+            by_dimension[dimension][key] = value
+
+        bands = {name: by_dimension['band'].get(name, [0, 0, 0])[0] for name, _ in FLEET_BANDS}
+        total = sum(bands.values())
+        level_sum = sum(v[1] for v in by_dimension['band'].values())
+        cutoff = hour_key(now - timedelta(hours=stale_hours))
+        # Hour granularity: a bin counts as stale once its whole hour is past the cutoff
+        stale = sum(v[0] for key, v in by_dimension['updated_hour'].items() if key == NEVER_UPDATED or key < cutoff)
+        zones = [{
+            "zone": zone,
+            "bins": v[0],
+            "average_level": round(v[1] / v[0], 1) if v[0] else None,
+            "critical": v[2]
+        } for zone, v in sorted(by_dimension['zone'].items()) if v[0]]
+        first_day = (now - timedelta(days=days - 1)).date()
+        emptyings = {(first_day + timedelta(days=i)).isoformat(): 0 for i in range(days)}
+        for day, v in by_dimension['emptied_day'].items():
+            if day in emptyings:
+                emptyings[day] = v[0]
+        return {
+            "bins": total,
+            "average_level": round(level_sum / total, 1) if total else None,
+            "bands": bands,
+            "critical": bands['80-100'],
+            "stale": stale,
+            "stale_hours": stale_hours,
+            "zones": zones,
+            "emptyings_per_day": emptyings,
+            "generated_at": now.isoformat()
+        }
+
+fleet_stats = FleetStats()
+
+def rebuild_fleet_stats():
+    """Recomputes the FleetStat table from Bin and the daily rollups (caller commits)."""
+    delta = FleetStatsDelta()
+    for row in db.session.query(Bin.id, Bin.bin_number, Bin.location, Bin.current_level,
+                                Bin.last_updated, Bin.last_emptied_timestamp).yield_per(5000):
+        delta.move(None, row)
+    emptied = db.session.query(HistoryDaily.bucket_start, func.sum(HistoryDaily.emptied_count))\
+                        .group_by(HistoryDaily.bucket_start).having(func.sum(HistoryDaily.emptied_count) > 0).all()
+    for day, count in emptied:
+        delta.add('emptied_day', day.date().isoformat(), int(count))
+    db.session.execute(db.delete(FleetStat))
+    if delta.rows():
+        db.session.execute(db.insert(FleetStat), delta.rows())
+    fleet_stats.invalidate()
+    return delta
+
+# --- History Compression ---
+
+class CompressionState:
+    """Per-bin compressor state: last stored point, pending reading and slope corridor."""
+    __slots__ = ('stored_time', 'stored_level', 'held_time', 'held_level', 'slope_low', 'slope_high')
+
+    def __init__(self, stored_time=None, stored_level=None):
+        self.stored_time = stored_time
+        self.stored_level = stored_level
+        self.held_time = None
+        self.held_level = None
+        self.slope_low = -math.inf
+        self.slope_high = math.inf
+
+    def copy(self):
+        other = CompressionState(self.stored_time, self.stored_level)
+        other.held_time, other.held_level = self.held_time, self.held_level
+        other.slope_low, other.slope_high = self.slope_low, self.slope_high
+        return other
+
+class HistoryCompressor:
+    """Decides which readings are stored in History.
+
+    Swinging door: a reading is held back as long as the straight line from
+    the last stored point to it passes within `deviation` of every reading
+    since; when a new reading breaks that, the held reading is stored and
+    becomes the new origin. Deadband: a reading is stored when it differs from the
+    last stored level by more than `deviation`. Emptyings always store the
+    last reading before the drop and the drop itself.
+
+    The last reading of a bin is its current state (Bin.current_level /
+    last_updated), which completes the curve; see reconstruct_level_curve().
+    State is per process: a bin first seen by this process (or last written
+    by another worker) stores its previous state again, so the curve stays
+    bounded across restarts and workers at the cost of a duplicate point.
+    """
+
+    def __init__(self, mode, deviation):
+        if mode not in ('swinging-door', 'deadband', 'off'):
+            raise RuntimeError(f"Unknown history compression: {mode}")
+        self.mode = mode
+        self.deviation = deviation
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def state_for(self, target_bin):
+        """Private copy of a bin's state, published by commit() once the rows are stored."""
+        with self._lock:
+            state = self._states.get(target_bin.id)
+        if state is not None:
+            last_seen = state.held_time if state.held_time is not None else state.stored_time
+            if last_seen == target_bin.last_updated:
+                return state.copy()
+        # New bin for this process, or another worker wrote since: restart
+        # from the bin's current state
+        state = CompressionState()
+        if target_bin.last_updated is not None:
+            state.held_time, state.held_level = target_bin.last_updated, target_bin.current_level
+        return state
+
+    def commit(self, states):
+        with self._lock:
+            self._states.update(states)
+
+    def _store(self, state, timestamp, level, points):
+        points.append((timestamp, level))
+        state.stored_time, state.stored_level = timestamp, level
+        state.held_time = state.held_level = None
+        state.slope_low, state.slope_high = -math.inf, math.inf
+
+    def _store_held(self, state, points):
+        if state.held_time is not None:
+            self._store(state, state.held_time, state.held_level, points)
+
+    def add(self, state, timestamp, level, emptied=False):
+        """Feeds one in-order reading; returns the (timestamp, level) points to store."""
+        points = []
+        if self.mode == 'off':
+            points.append((timestamp, level))
+            return points
+        if state.stored_time is None:
+            # First reading seen for this bin: the previous state (if any) is the origin
+            if state.held_time is not None:
+                self._store_held(state, points)
+            else:
+                self._store(state, timestamp, level, points)
+                return points
+        if emptied:
+            self._store_held(state, points)
+            self._store(state, timestamp, level, points)
+            return points
+
+        if self.mode == 'deadband':
+            if abs(level - state.stored_level) > self.deviation:
+                self._store(state, timestamp, level, points)
+            else:
+                state.held_time, state.held_level = timestamp, level
+            return points
+
+        elapsed = (timestamp - state.stored_time).total_seconds()
+        if elapsed <= 0:
+            # Same instant as the stored point: keep it only if it moved
+            if level != state.stored_level:
+                self._store(state, timestamp, level, points)
+            return points
+        low = max(state.slope_low, (level - self.deviation - state.stored_level) / elapsed)
+        high = min(state.slope_high, (level + self.deviation - state.stored_level) / elapsed)
+        if not low <= (level - state.stored_level) / elapsed <= high:
+            # Door closed: the segment to this reading would miss an earlier
+            # one by more than the deviation, so the held reading ends the
+            # segment and starts the next one
+            self._store_held(state, points)
+            elapsed = (timestamp - state.stored_time).total_seconds()
+            if elapsed <= 0:
+                return points
+            low = (level - self.deviation - state.stored_level) / elapsed
+            high = (level + self.deviation - state.stored_level) / elapsed
+        state.slope_low, state.slope_high = low, high
+        state.held_time, state.held_level = timestamp, level
+        return points
+
+history_compressor = HistoryCompressor(app.config['HISTORY_COMPRESSION'], app.config['HISTORY_DEVIATION'])
+
+def reconstruct_level_curve(target_bin, times):
+    """Levels of a bin (BinState or Bin) at the given naive-UTC datetimes, as a float array.
+
+    Interpolates the stored History points plus the bin's current state:
+    linearly for swinging door and uncompressed history, holding the last
+    stored level for deadband. Within HISTORY_DEVIATION of the readings
+    received, except across late readings stored out of order. NaN before
+    the first known point and after the last reading.
+    """
+    if not times:
+        return np.array([])
+    start, end = min(times), max(times)
+    base = History.query.with_entities(History.timestamp, History.level).filter(History.bin_id == target_bin.id)
+    before = base.filter(History.timestamp < start).order_by(History.timestamp.desc(), History.id.desc()).first()
+    points = base.filter(History.timestamp >= start, History.timestamp <= end)\
+                 .order_by(History.timestamp, History.id).all()
+    after = base.filter(History.timestamp > end).order_by(History.timestamp, History.id).first()
+    points = ([before] if before else []) + points + ([after] if after else [])
+    if target_bin.last_updated is not None and (not points or target_bin.last_updated > points[-1][0]):
+        points.append((target_bin.last_updated, target_bin.current_level))
+    if not points:
+        return np.full(len(times), np.nan)
+
+    known_times = np.array([utc_epoch(t) for t, _ in points])
+    known_levels = np.array([level for _, level in points], dtype=np.float64)
+    wanted = np.array([utc_epoch(t) for t in times])
+    if history_compressor.mode == 'deadband':
+        levels = known_levels[np.clip(np.searchsorted(known_times, wanted, side='right') - 1, 0, None)]
+    else:
+        levels = np.interp(wanted, known_times, known_levels)
+    return np.where((wanted < known_times[0]) | (wanted > known_times[-1]), np.nan, levels)
+
+# --- Reading Filters ---
+#
+# Stages see the in-order readings of one bin before they are applied. Each
+# stage gets (state, level, timestamp, current_level, current_time), where
+# current_* is what the bin shows now, and returns (state, level): the level
+# unchanged (pass), a different level (smooth), current_level (hold: the
+# bin keeps its level but its last_updated still moves, so it doesn't look
+# stale) or None (drop the reading). Late readings are not filtered.
+
+FILTER_STAGES = {}
+
+def filter_stage(name):
+    """Registers a filter stage class under the name used in FILTER_PIPELINE."""
+    def register(cls):
+        FILTER_STAGES[name] = cls
+        cls.name = name
+        return cls
+    return register
+
+@filter_stage('median')
+class MedianFilter:
+    """Median of the last `window` raw readings: removes isolated 0/100 echo spikes.
+
+    A fresh window (new bin, restarted process) is filled with the bin's
+    current level, so the first reading after a restart can't pass a spike.
+    """
+
+    def __init__(self, window=3):
+        self.window = int(window)
+
+    def initial_state(self):
+        return ()
+
+    def process(self, state, level, timestamp, current_level, current_time):
+        state = ((state or (current_level,) * (self.window - 1)) + (level,))[-self.window:]
+        return state, sorted(state)[len(state) // 2]
+
+@filter_stage('hysteresis')
+class HysteresisFilter:
+    """Holds the current level until a reading moves more than `band` points away from it."""
+
+    def __init__(self, band=2):
+        self.band = float(band)
+
+    def initial_state(self):
+        return None
+
+    def process(self, state, level, timestamp, current_level, current_time):
+        return state, current_level if abs(level - current_level) <= self.band else level
+
+@filter_stage('rate')
+class RateLimitFilter:
+    """Caps rises at `max_per_hour` level points per hour; drops are left to confirm-emptying.
+
+    The state is the time the allowance accrues from. Held readings still
+    move last_updated, so it can't be measured from there: at 30/h and one
+    reading a minute the allowance would never reach a whole point.
+    """
+
+    def __init__(self, max_per_hour=30):
+        self.max_per_hour = float(max_per_hour)
+
+    def initial_state(self):
+        return None
+
+    def process(self, state, level, timestamp, current_level, current_time):
+        if current_time is None or level <= current_level:
+            return timestamp, level # Not rising: no allowance saved up
+        since = state or current_time
+        hours = max((timestamp - since).total_seconds(), 0) / 3600
+        allowed = int(self.max_per_hour * hours)
+        if current_level + allowed >= level:
+            return timestamp, level
+        # Only the time the granted points used up is spent; the rest carries over
+        return since + timedelta(hours=allowed / self.max_per_hour), current_level + allowed
+
+@filter_stage('confirm-emptying')
+class EmptyingConfirmationFilter:
+    """Only lets a full-to-empty drop through after `count` consecutive low readings."""
+
+    def __init__(self, count=2):
+        self.count = int(count)
+
+    def initial_state(self):
+        return 0
+
+    def process(self, state, level, timestamp, current_level, current_time):
+        if current_level >= 80 and level <= 20: # Same rule as apply_level_reading()
+            state += 1
+            if state < self.count:
+                return state, current_level # Hold until confirmed
+        return 0, level
+
+def parse_filter_pipeline(spec):
+    """Builds the stage list for a 'stage:argument,...' pipeline string."""
+    stages = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, argument = item.partition(':')
+        if name not in FILTER_STAGES:
+            raise RuntimeError(f"Unknown reading filter stage: {name}")
+        stages.append(FILTER_STAGES[name](argument) if argument else FILTER_STAGES[name]())
+    return stages
+
+class ReadingFilterPipeline:
+    """Per-bin filter stages and their state (one small window per stage and bin).
+
+    Like the history compressor, ingestion works on copies of the state and
+    publishes them with commit() once the transaction succeeded. State is per
+    process: with several workers each one filters the readings it receives.
+    """
+
+    def __init__(self, default_spec, bin_specs):
+        self.default = parse_filter_pipeline(default_spec)
+        self.per_bin = {bin_number: parse_filter_pipeline(spec) for bin_number, spec in bin_specs.items()}
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def stages_for(self, bin_number):
+        return self.per_bin.get(bin_number, self.default)
+
+    def state_for(self, target_bin):
+        stages = self.stages_for(target_bin.bin_number)
+        with self._lock:
+            state = self._states.get(target_bin.id)
+        if state is None or len(state) != len(stages):
+            return [stage.initial_state() for stage in stages]
+        return list(state) # Stage states are immutable values
+
+    def commit(self, states):
+        with self._lock:
+            self._states.update(states)
+
+    def apply(self, target_bin, state, level, timestamp):
+        """Runs one reading through the bin's stages; returns the level to apply or None."""
+        for i, stage in enumerate(self.stages_for(target_bin.bin_number)):
+            state[i], filtered = stage.process(state[i], level, timestamp, target_bin.current_level, target_bin.last_updated)
+            if filtered != level:
+                metrics.inc('smarttrash_readings_filtered_total', stage=stage.name,
+                            action='drop' if filtered is None else 'hold' if filtered == target_bin.current_level else 'smooth')
+            if filtered is None:
+                return None
+            level = filtered
+        return level
+
+reading_filters = ReadingFilterPipeline(app.config['FILTER_PIPELINE'], app.config['FILTER_PIPELINE_BINS'])
+metrics.counter('smarttrash_readings_filtered_total', 'Readings changed or dropped by a filter stage.')
+
+# --- Server-Sent Events Broker ---
+
+class SseSubscriber:
+    """One open SSE connection: its pending events and optional bin filter.
+
+    `wakeup`, if given, is called (from the publishing thread) after every
+    event queued for this subscriber and when it is dropped, so an asyncio
+    consumer can wait for events without blocking a thread on the queue.
+    """
+    __slots__ = ('bin_id', 'events', 'dropped', 'wakeup')
+
+    def __init__(self, bin_id, queue_size, wakeup=None):
+        self.bin_id = bin_id
+        self.events = queue.Queue(maxsize=queue_size)
+        self.dropped = False
+        self.wakeup = wakeup
+
+class EventBroker:
+    """In-process fan-out of level events to SSE subscribers.
+
+    Every event gets a monotonically increasing id. The last `replay_size`
+    events are kept so a reconnecting client can resume from its
+    Last-Event-ID. Ids start from the boot time in milliseconds, so they keep
+    increasing across restarts and a stale id never replays the wrong events.
+    A subscriber that falls `queue_size` events behind is disconnected; its
+    browser reconnects and resumes from the replay buffer.
+    """
+
+    def __init__(self, replay_size, queue_size):
+        self._lock = threading.Lock()
+        self._next_id = int(time.time() * 1000)
+        self._recent = collections.deque(maxlen=replay_size)
+        self._subscribers = set()
+        self.queue_size = queue_size
+
+    def publish(self, event_type, data):
+        with self._lock:
+            event = (self._next_id, event_type, data)
+            self._next_id += 1
+            self._recent.append(event)
+            for subscriber in list(self._subscribers):
+                if subscriber.bin_id is not None and data.get("id") != subscriber.bin_id:
+                    continue
+                try:
+                    subscriber.events.put_nowait(event)
+                except queue.Full:
+                    # Too slow: drop it, the client will resume via Last-Event-ID
+                    subscriber.dropped = True
+                    self._subscribers.discard(subscriber)
+                if subscriber.wakeup is not None:
+                    subscriber.wakeup()
+
+    def subscribe(self, bin_id=None, last_event_id=None, wakeup=None):
+        """Registers a subscriber; returns (subscriber, events to replay, gap)."""
+        subscriber = SseSubscriber(bin_id, self.queue_size, wakeup)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            backlog, gap = [], False
+            if last_event_id is not None:
+                backlog = [e for e in self._recent if e[0] > last_event_id and (bin_id is None or e[2].get("id") == bin_id)]
+                oldest = self._recent[0][0] if self._recent else self._next_id
+                gap = last_event_id < oldest - 1
+        return subscriber, backlog, gap
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+event_broker = EventBroker(app.config['SSE_REPLAY_SIZE'], app.config['SSE_SUBSCRIBER_QUEUE_SIZE'])
+
+@on_readings_committed
+def publish_level_events(applied):
+    """Publishes a 'level' event per level change and an 'emptied' event per emptying."""
+    for reading in applied:
+        if reading.late or (reading.level == reading.previous_level and not reading.emptied):
+            continue
+        event_broker.publish("emptied" if reading.emptied else "level", {
+            "id": reading.bin_id,
+            "numero": reading.bin_number,
+            "level": reading.level,
+            "previous_level": reading.previous_level,
+            "last_updated": reading.timestamp.isoformat(),
+            "last_emptied": reading.last_emptied_timestamp.isoformat() if reading.last_emptied_timestamp else None
+        })
+
+def format_sse(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+def parse_last_event_id(value):
+    """Last-Event-ID header (or lastEventId parameter) as an int, None if absent or invalid."""
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+def sse_preamble(backlog, gap):
+    """First chunks of every SSE stream: reconnect delay, resync marker and replayed events."""
+    yield f"retry: {app.config['SSE_RETRY_MS']}\n\n"
+    if gap:
+        # Events were missed beyond the replay buffer: the client
+        # should reload the full state (/level or /bins).
+        yield "event: resync\ndata: {}\n\n"
+    for pending in backlog:
+        yield format_sse(*pending)
+
+def sse_response(bin_id=None):
+    """Streams broker events as text/event-stream, with heartbeats and resume.
+
+    The WSGI stream holds a server thread for as long as the client stays
+    connected; asgi.py serves /stream natively on the event loop instead.
+    """
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('lastEventId'))
+    heartbeat = app.config['SSE_HEARTBEAT_SECONDS']
+    subscriber, backlog, gap = event_broker.subscribe(bin_id, last_event_id)
+
+    def generate():
+        try:
+            yield from sse_preamble(backlog, gap)
+            while not subscriber.dropped:
+                try:
+                    pending = subscriber.events.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                if subscriber.dropped:
+                    break
+                yield format_sse(*pending)
+        finally:
+            event_broker.unsubscribe(subscriber)
+
+    response = app.response_class(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Disable proxy buffering (nginx)
+    return response
+
+# --- Fill-rate Forecasting ---
+
+def utc_epoch(ts):
+    """Seconds since the epoch for a naive UTC datetime."""
+    return ts.replace(tzinfo=timezone.utc).timestamp()
+
+def sql_epoch(column):
+    """Seconds since the epoch for a naive UTC DateTime column, computed by SQLite."""
+    return (func.julianday(column, type_=db.Float) - 2440587.5) * 86400.0
+
+class FillRateForecaster:
+    """Per-bin fill-rate estimates (level points per hour) and time-to-full forecasts.
+
+    Each bin has one EWMA rate per hour of day plus an overall EWMA, kept in
+    NumPy arrays so the whole fleet is forecast with vectorized code. Rates
+    are updated online from committed readings and reset their fill cycle on
+    each detected emptying. The arrays are built from History once, by the
+    first request that needs them (ensure_loaded()).
+    """
+
+    def __init__(self, alpha, horizon_hours, min_interval_minutes):
+        self.alpha = alpha
+        self.horizon_hours = horizon_hours
+        self.min_interval = min_interval_minutes * 60
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock() # Held for the whole rebuild; _lock only guards the arrays
+        self._allocate(0)
+
+    def _allocate(self, capacity):
+        self._rows = {} # bin_id -> row index
+        self.size = 0
+        self.bin_ids = np.zeros(capacity, dtype=np.int64)
+        self.bin_numbers = [None] * capacity
+        # Rates are kept as EWMA(level increase) / EWMA(elapsed hours), which
+        # stays stable when readings are seconds apart
+        self.hourly_rise = np.full((capacity, 24), np.nan)
+        self.hourly_hours = np.full((capacity, 24), np.nan)
+        self.overall_rise = np.full(capacity, np.nan)
+        self.overall_hours = np.full(capacity, np.nan)
+        self.levels = np.zeros(capacity)
+        self.updated = np.full(capacity, np.nan) # Epoch seconds of the last reading
+        # Start of the interval not yet turned into a rate observation
+        self.anchor_levels = np.full(capacity, np.nan)
+        self.anchor_times = np.full(capacity, np.nan)
+
+    def _row(self, bin_id, bin_number):
+        row = self._rows.get(bin_id)
+        if row is None:
+            row = self.size
+            if row == len(self.bin_ids):
+                # Grow every array by doubling
+                capacity = max(16, 2 * row)
+                self.bin_ids = np.resize(self.bin_ids, capacity)
+                self.levels = np.resize(self.levels, capacity)
+                self.bin_numbers.extend([None] * (capacity - row))
+                for name in ('hourly_rise', 'hourly_hours', 'overall_rise', 'overall_hours',
+                             'updated', 'anchor_levels', 'anchor_times'):
+                    old = getattr(self, name)
+                    new = np.full((capacity,) + old.shape[1:], np.nan)
+                    new[:row] = old[:row]
+                    setattr(self, name, new)
+            self._rows[bin_id] = row
+            self.bin_ids[row] = bin_id
+            self.size += 1
+        self.bin_numbers[row] = bin_number
+        return row
+
+    def _ewma(self, current, value):
+        return value if np.isnan(current) else self.alpha * value + (1 - self.alpha) * current
+
+    def observe(self, applied):
+        """Updates the estimates with committed readings (no-op until loaded).
+
+        Readings are accumulated from an anchor until at least
+        `min_interval` has elapsed, then turned into one rate observation
+        credited to the hour of day the interval started in. An emptying or
+        any drop of the level resets the anchor.
+        """
+        if not self.loaded:
+            return
+        with self._lock:
+            for reading in applied:
+                if reading.late:
+                    continue
+                row = self._row(reading.bin_id, reading.bin_number)
+                seconds = utc_epoch(reading.timestamp)
+                anchor_level, anchor_time = self.anchor_levels[row], self.anchor_times[row]
+                if reading.emptied or np.isnan(anchor_time) or reading.level < anchor_level:
+                    self.anchor_levels[row], self.anchor_times[row] = reading.level, seconds
+                elif seconds - anchor_time >= self.min_interval:
+                    rise, hours = reading.level - anchor_level, (seconds - anchor_time) / 3600
+                    slot = int(anchor_time // 3600) % 24
+                    self.hourly_rise[row, slot] = self._ewma(self.hourly_rise[row, slot], rise)
+                    self.hourly_hours[row, slot] = self._ewma(self.hourly_hours[row, slot], hours)
+                    self.overall_rise[row] = self._ewma(self.overall_rise[row], rise)
+                    self.overall_hours[row] = self._ewma(self.overall_hours[row], hours)
+                    self.anchor_levels[row], self.anchor_times[row] = reading.level, seconds
+                self.levels[row] = reading.level
+                self.updated[row] = seconds
+
+    def add_bins(self, bins):
+        """Registers new (bin_id, bin_number, level) bins, without rates yet (no-op until loaded)."""
+        if not self.loaded:
+            return
+        with self._lock:
+            for bin_id, bin_number, level in bins:
+                row = self._row(bin_id, bin_number) # May grow (replace) the arrays
+                self.levels[row] = level
+
+    def ensure_loaded(self):
+        """Builds the estimates on first use; concurrent first requests wait for one rebuild."""
+        if self.loaded:
+            return
+        with self._build_lock:
+            if not self.loaded:
+                self.rebuild()
+
+    def rebuild(self):
+        """Recomputes every estimate from History and Bin with vectorized NumPy."""
+        bins = db.session.query(Bin.id, Bin.bin_number, Bin.current_level, sql_epoch(Bin.last_updated)).all()
+        # Core rows with epoch seconds computed by SQLite: no ORM or datetime
+        # conversion per row, only numbers for one float array
+        history = History.__table__.c
+        rows = db.session.connection().execute(
+            db.select(history.bin_id, sql_epoch(history.timestamp), history.level)
+            .order_by(history.bin_id, history.timestamp, history.id)).all()
+        # History is compressed: each bin's current state is the last point of its curve
+        current = [(bin_id, last_updated, level) for bin_id, _, level, last_updated in bins if last_updated is not None]
+        with self._lock:
+            self._allocate(len(bins))
+            for bin_id, bin_number, level, last_updated in bins:
+                row = self._row(bin_id, bin_number)
+                self.levels[row] = level
+                self.updated[row] = np.nan if last_updated is None else last_updated
+
+            points = rows + current
+            columns = np.fromiter((value for point in points for value in point), dtype=np.float64,
+                                  count=3 * len(points)).reshape(-1, 3)
+            if len(columns) > 1:
+                columns = columns[np.lexsort((columns[:, 1], columns[:, 0]))] # Stable: ties keep History first
+                history_bins = columns[:, 0].astype(np.int64)
+                seconds, levels = columns[:, 1], columns[:, 2]
+
+                # Consecutive readings of the same (known) bin where the level did not drop
+                hours = np.diff(seconds) / 3600
+                rises = np.diff(levels)
+                valid = (history_bins[1:] == history_bins[:-1]) & (hours > 0) & (rises >= 0)
+                valid &= np.isin(history_bins[1:], self.bin_ids[:self.size])
+                if valid.any():
+                    ids = self.bin_ids[:self.size]
+                    sorter = np.argsort(ids)
+                    bin_rows = sorter[np.searchsorted(ids, history_bins[1:][valid], sorter=sorter)]
+                    slots = ((seconds[:-1][valid] // 3600) % 24).astype(np.int64)
+                    groups = bin_rows * 24 + slots
+                    n = self.size
+                    self.hourly_rise[:n] = self._fit(groups, rises[valid], n * 24).reshape(n, 24)
+                    self.hourly_hours[:n] = self._fit(groups, hours[valid], n * 24).reshape(n, 24)
+                    self.overall_rise[:n] = self._fit(bin_rows, rises[valid], n)
+                    self.overall_hours[:n] = self._fit(bin_rows, hours[valid], n)
+            self.loaded = True
+
+    def _fit(self, groups, values, group_count):
+        """Bias-corrected EWMA of `values` (in time order) within each group.
+
+        The k-th most recent observation of a group weighs (1 - alpha)^k,
+        which is what the online update converges to.
+        """
+        order = np.argsort(groups, kind='stable')
+        sorted_groups = groups[order]
+        counts = np.bincount(sorted_groups, minlength=group_count)
+        ends = np.cumsum(counts)[sorted_groups]
+        age = ends - 1 - np.arange(len(sorted_groups))
+        weights = (1 - self.alpha) ** age
+        totals = np.bincount(sorted_groups, weights=weights, minlength=group_count)
+        sums = np.bincount(sorted_groups, weights=weights * values[order], minlength=group_count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(totals > 0, sums / totals, np.nan)
+
+    def forecast(self, now):
+        """Vectorized time-to-full for every bin: (bin_ids, numbers, levels, rates, hours_to_full)."""
+        with self._lock:
+            n = self.size
+            levels = self.levels[:n].copy()
+            updated = self.updated[:n].copy()
+            with np.errstate(invalid='ignore', divide='ignore'):
+                overall = np.where(self.overall_hours[:n] > 0, self.overall_rise[:n] / self.overall_hours[:n], np.nan)
+                hourly = np.where(self.hourly_hours[:n] > 0, self.hourly_rise[:n] / self.hourly_hours[:n], np.nan)
+            bin_ids = self.bin_ids[:n].copy()
+            numbers = list(self.bin_numbers[:n])
+
+        horizon = self.horizon_hours
+        # Hours without their own estimate fall back to the bin's overall rate
+        hourly = np.clip(np.where(np.isnan(hourly), overall[:, None], hourly), 0, None)
+        start = np.where(np.isnan(updated), utc_epoch(now), updated)
+        start_hour = ((start // 3600) % 24).astype(np.int64)
+        slots = (start_hour[:, None] + np.arange(horizon)[None, :]) % 24
+        per_hour = np.take_along_axis(hourly, slots, axis=1)
+        filled = np.cumsum(per_hour, axis=1)
+
+        remaining = np.clip(100 - levels, 0, None)
+        reached = filled >= remaining[:, None]
+        step = reached.argmax(axis=1)
+        rows = np.arange(n)
+        before = np.where(step > 0, filled[rows, np.maximum(step - 1, 0)], 0.0)
+        rate_at_step = per_hour[rows, step]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(rate_at_step > 0, (remaining - before) / rate_at_step, 0.0)
+        hours_from_reading = np.where(reached.any(axis=1), step + fraction, np.nan)
+        hours_from_reading = np.where(remaining <= 0, 0.0, hours_from_reading)
+        hours_from_reading = np.where(np.isnan(overall) & (remaining > 0), np.nan, hours_from_reading)
+        # Count from now rather than from the last reading; overdue bins are "full now"
+        hours_to_full = np.clip(hours_from_reading - (utc_epoch(now) - start) / 3600, 0, None)
+        return bin_ids, numbers, levels, overall, hours_to_full
+
+forecaster = FillRateForecaster(app.config['FORECAST_EWMA_ALPHA'], app.config['FORECAST_HORIZON_HOURS'],
+                                app.config['FORECAST_MIN_INTERVAL_MINUTES'])
+
+@on_readings_committed
+def update_fill_rates(applied):
+    forecaster.observe(applied)
+
+# --- Spatial Index and Route Planning ---
+
+EARTH_RADIUS_KM = 6371.0
+
+def project_km(lat, lon, origin_lat):
+    """Equirectangular projection to kilometres, accurate at city scale."""
+    return (math.radians(lon) * EARTH_RADIUS_KM * math.cos(math.radians(origin_lat)),
+            math.radians(lat) * EARTH_RADIUS_KM)
+
+class SpatialGridIndex:
+    """Uniform lat/lon grid of the bins that have coordinates.
+
+    Built from the database on first use and kept current by update() when
+    a bin's coordinates change, so radius queries only look at the cells
+    overlapping the search area.
+    """
+
+    def __init__(self, cell_degrees):
+        self.cell = cell_degrees
+        self.loaded = False
+        self._cells = collections.defaultdict(set) # (row, col) -> bin ids
+        self._positions = {} # bin_id -> (lat, lon)
+        self._lock = threading.Lock()
+
+    def _key(self, lat, lon):
+        return (int(math.floor(lat / self.cell)), int(math.floor(lon / self.cell)))
+
+    def _remove(self, bin_id):
+        position = self._positions.pop(bin_id, None)
+        if position is not None:
+            self._cells[self._key(*position)].discard(bin_id)
+
+    def rebuild(self):
+        rows = db.session.query(Bin.id, Bin.latitude, Bin.longitude)\
+                         .filter(Bin.latitude != None, Bin.longitude != None).all() # noqa: E711
+        with self._lock:
+            self._cells.clear()
+            self._positions.clear()
+            for bin_id, lat, lon in rows:
+                self._positions[bin_id] = (lat, lon)
+                self._cells[self._key(lat, lon)].add(bin_id)
+            self.loaded = True
+
+    def update(self, bin_id, lat, lon):
+        """Moves (or removes, when lat/lon is None) one bin."""
+        if not self.loaded:
+            return
+        with self._lock:
+            self._remove(bin_id)
+            if lat is not None and lon is not None:
+                self._positions[bin_id] = (lat, lon)
+                self._cells[self._key(lat, lon)].add(bin_id)
+
+    def within(self, lat, lon, radius_km):
+        """Returns {bin_id: distance_km} for the bins within radius_km of a point."""
+        if not self.loaded:
+            self.rebuild()
+        lat_span = math.degrees(radius_km / EARTH_RADIUS_KM)
+        lon_span = lat_span / max(math.cos(math.radians(lat)), 1e-6)
+        row_min, col_min = self._key(lat - lat_span, lon - lon_span)
+        row_max, col_max = self._key(lat + lat_span, lon + lon_span)
+        ox, oy = project_km(lat, lon, lat)
+        found = {}
+        with self._lock:
+            for row in range(row_min, row_max + 1):
+                for col in range(col_min, col_max + 1):
+                    for bin_id in self._cells.get((row, col), ()):
+                        x, y = project_km(*self._positions[bin_id], lat)
+                        distance = math.hypot(x - ox, y - oy)
+                        if distance <= radius_km:
+                            found[bin_id] = distance
+        return found
+
+spatial_index = SpatialGridIndex(app.config['SPATIAL_CELL_DEGREES'])
+
+class PointGrid:
+    """Bucket grid over projected points, for nearest-neighbour searches."""
+
+    def __init__(self, points):
+        self.points = points
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        self.x0, self.y0 = min(xs), min(ys)
+        area = max(max(xs) - self.x0, 1e-3) * max(max(ys) - self.y0, 1e-3)
+        # About two points per cell
+        self.cell = max(math.sqrt(2 * area / len(points)), 1e-3)
+        self.cells = collections.defaultdict(set)
+        for index, (x, y) in enumerate(points):
+            self.cells[self._key(x, y)].add(index)
+        self.max_ring = int(max(max(xs) - self.x0, max(ys) - self.y0) / self.cell) + 2
+
+    def _key(self, x, y):
+        return (int((x - self.x0) // self.cell), int((y - self.y0) // self.cell))
+
+    def _ring(self, key, r):
+        cx, cy = key
+        if r == 0:
+            yield key
+            return
+        for dx in range(-r, r + 1):
+            yield (cx + dx, cy - r)
+            yield (cx + dx, cy + r)
+        for dy in range(-r + 1, r):
+            yield (cx - r, cy + dy)
+            yield (cx + r, cy + dy)
+
+    def nearest(self, index, k=1):
+        """The k points closest to `index` (excluding it), nearest first."""
+        x, y = self.points[index]
+        key = self._key(x, y)
+        found = []
+        for r in range(self.max_ring + 1):
+            for cell in self._ring(key, r):
+                for other in self.cells.get(cell, ()):
+                    if other != index:
+                        ox, oy = self.points[other]
+                        found.append((math.hypot(ox - x, oy - y), other))
+            # Any point in ring r+1 or beyond is at least r * cell away
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= r * self.cell:
+                    break
+        found.sort()
+        return [other for _, other in found[:k]]
+
+    def remove(self, index):
+        self.cells[self._key(*self.points[index])].discard(index)
+
+def plan_route(points, neighbour_count, time_budget):
+    """Closed tour over projected points starting at points[0] (the depot).
+
+    Builds a nearest-neighbour tour with a grid search, then improves it
+    with 2-opt restricted to each point's nearest neighbours until no move
+    helps or the time budget (seconds) runs out. Returns (tour, nn_length,
+    length, improved_moves).
+    """
+    n = len(points)
+    if n <= 3:
+        tour = list(range(n))
+        return tour, tour_length(points, tour), tour_length(points, tour), 0
+    deadline = time.perf_counter() + time_budget
+
+    # Nearest-neighbour construction
+    grid = PointGrid(points)
+    tour = [0]
+    grid.remove(0)
+    current = 0
+    for _ in range(n - 1):
+        current = grid.nearest(current, 1)[0]
+        grid.remove(current)
+        tour.append(current)
+    nn_length = tour_length(points, tour)
+
+    # 2-opt with neighbour lists
+    grid = PointGrid(points)
+    neighbours = [grid.nearest(i, neighbour_count) for i in range(n)]
+    position = [0] * n
+    for i, city in enumerate(tour):
+        position[city] = i
+
+    def dist(a, b):
+        return math.hypot(points[a][0] - points[b][0], points[a][1] - points[b][1])
+
+    moves = 0
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for a in range(n):
+            i = position[a]
+            b = tour[(i + 1) % n]
+            d_ab = dist(a, b)
+            for c in neighbours[a]:
+                d_ac = dist(a, c)
+                if d_ac >= d_ab:
+                    break # Neighbours are sorted: no further candidate can gain
+                j = position[c]
+                d = tour[(j + 1) % n]
+                if c == b or d == a:
+                    continue
+                if d_ac + dist(b, d) < d_ab + dist(c, d) - 1e-9:
+                    # Replace edges a-b and c-d with a-c and b-d
+                    lo, hi = (i + 1, j) if i < j else (j + 1, i)
+                    tour[lo:hi + 1] = tour[lo:hi + 1][::-1]
+                    for k in range(lo, hi + 1):
+                        position[tour[k]] = k
+                    moves += 1
+                    improved = True
+                    break
+            if time.perf_counter() >= deadline:
+                break
+
+    # Rotate so the tour starts at the depot
+    start = position[0]
+    tour = tour[start:] + tour[:start]
+    return tour, nn_length, tour_length(points, tour), moves
+
+def tour_length(points, tour):
+    return sum(math.hypot(points[a][0] - points[b][0], points[a][1] - points[b][1])
+               for a, b in zip(tour, tour[1:] + tour[:1]))
+
+# --- Recent Readings Ring Buffer ---
+#
+# File layout: a 64-byte header (magic, version, bins, readings per bin) and
+# one fixed-size record per bin slot holding its last History points in a
+# circular array, and the time from which it holds all of them. Slots are
+# found by open addressing on the bin id. Writers take an exclusive flock, so
+# several processes can append; readers take no lock and use the per-slot
+# sequence number as a seqlock (odd while a write is in progress, re-read if
+# it changed). SQLite stays the system of record: a bin's slot is seeded from
+# History the first time it is read, then ingestion appends the rows it
+# commits to History. The file can be deleted while the app is stopped and
+# only costs a reseed. Every process must use the same RECENT_BUFFER_*
+# settings, since a mismatch reinitializes the file.
+
+RECENT_BUFFER_MAGIC = b'STRB'
+RECENT_BUFFER_VERSION = 2
+RECENT_BUFFER_HEADER = struct.Struct('<4sIII')
+RECENT_BUFFER_HEADER_SIZE = 64
+RECENT_BUFFER_MAX_PROBES = 64
+
+class RecentReadingsBuffer:
+    """Last History points of each bin in a memory-mapped ring buffer file."""
+
+    def __init__(self, path, bin_slots, capacity):
+        self.path = path
+        self.bin_slots = bin_slots
+        self.capacity = capacity
+        self.dtype = np.dtype([
+            ('bin_id', '<i8'), # 0 = free slot
+            ('sequence', '<u8'), # Seqlock: odd while being written
+            ('head', '<u4'), # Next position to write
+            ('count', '<u4'),
+            ('complete_from', '<f8'), # Every point at or after this time is held (-inf: all of them)
+            ('timestamps', '<f8', (capacity,)), # UNIX epoch seconds
+            ('levels', 'u1', (capacity,)),
+        ])
+        self._lock = threading.Lock()
+        self._full_warned = False
+        # Not 'a+b': O_APPEND would send the header write to the end of the file
+        self._file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        with self._file_lock():
+            fd = self._file.fileno()
+            expected = RECENT_BUFFER_HEADER_SIZE + bin_slots * self.dtype.itemsize
+            header = RECENT_BUFFER_HEADER.pack(RECENT_BUFFER_MAGIC, RECENT_BUFFER_VERSION, bin_slots, capacity)
+            if os.pread(fd, RECENT_BUFFER_HEADER.size, 0) != header:
+                # New file, or one written with other settings: start over
+                app.logger.info(f"Initializing recent readings buffer {path} ({bin_slots} bins x {capacity} readings)")
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, expected)
+                os.pwrite(fd, header, 0)
+            elif os.fstat(fd).st_size != expected:
+                os.ftruncate(fd, expected) # Valid header: keep the readings, only fix the length
+            self.slots = np.memmap(self._file, dtype=self.dtype, mode='r+',
+                                   offset=RECENT_BUFFER_HEADER_SIZE, shape=(bin_slots,))
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """Exclusive lock shared with the other processes (no-op without fcntl: one process only)."""
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _find(self, bin_id, allocate=False):
+        """Slot of a bin (or a free one when allocating, which requires the file lock); None if absent."""
+        ids = self.slots['bin_id']
+        for probe in range(min(RECENT_BUFFER_MAX_PROBES, self.bin_slots)):
+            slot = (bin_id + probe) % self.bin_slots
+            current = int(ids[slot])
+            if current == bin_id:
+                return slot
+            if current == 0:
+                if not allocate:
+                    return None
+                ids[slot] = bin_id
+                self.slots['complete_from'][slot] = -np.inf # Nothing appended yet, nothing missed
+                return slot
+        if allocate and not self._full_warned:
+            app.logger.warning(f"Recent readings buffer full around bin {bin_id}: raise RECENT_BUFFER_BINS")
+            self._full_warned = True
+        return None
+
+    def _write(self, record, timestamps, levels):
+        """Appends to a record, skipping points it already holds; caller holds the locks."""
+        head, count = int(record['head'][0]), int(record['count'][0])
+        held = set(zip(record['timestamps'][0, :count].tolist(), record['levels'][0, :count].tolist()))
+        fresh = [i for i, point in enumerate(zip(timestamps.tolist(), levels.tolist())) if point not in held]
+        if not fresh:
+            return
+        timestamps, levels = timestamps[fresh], levels[fresh]
+        # Points pushed out of the ring (oldest first), and any beyond capacity in this append
+        overwritten = max(count + len(levels) - self.capacity, 0)
+        lost = np.concatenate([record['timestamps'][0, (head - count + np.arange(min(overwritten, count))) % self.capacity],
+                               timestamps[:max(len(levels) - self.capacity, 0)]])
+        timestamps, levels = timestamps[-self.capacity:], levels[-self.capacity:]
+        positions = (head + np.arange(len(levels))) % self.capacity
+        record['timestamps'][0, positions] = timestamps
+        record['levels'][0, positions] = levels
+        record['head'] = (head + len(levels)) % self.capacity
+        record['count'] = min(count + len(levels), self.capacity)
+        if len(lost):
+            # Coverage now starts just after the newest point given up
+            record['complete_from'] = max(float(record['complete_from'][0]), float(np.nextafter(lost.max(), np.inf)))
+
+    def append(self, bin_id, timestamps, levels, allocate=True):
+        """Appends points (oldest first) to a bin's ring; without allocate, only to a bin already buffered."""
+        with self._lock, self._file_lock():
+            slot = self._find(bin_id, allocate=allocate)
+            if slot is None:
+                return False
+            record = self.slots[slot:slot + 1] # View, not a copy
+            record['sequence'] += 1 # Odd: readers retry
+            self._write(record, np.asarray(timestamps, dtype=np.float64), np.asarray(levels, dtype=np.uint8))
+            record['sequence'] += 1 # Even again: consistent
+        return True
+
+    def seed(self, bin_id, load):
+        """Fills a bin's slot from load() -> (timestamps oldest first, levels, complete_from) unless it exists.
+
+        load() runs under the file lock, so a writer that found no slot
+        committed before it and its points are in what load() returns.
+        """
+        with self._lock, self._file_lock():
+            if self._find(bin_id) is not None:
+                return True
+            timestamps, levels, complete_from = load()
+            slot = self._find(bin_id, allocate=True)
+            if slot is None:
+                return False
+            record = self.slots[slot:slot + 1]
+            record['sequence'] += 1
+            self._write(record, np.asarray(timestamps, dtype=np.float64), np.asarray(levels, dtype=np.uint8))
+            record['complete_from'] = max(float(record['complete_from'][0]), complete_from)
+            record['sequence'] += 1
+        return True
+
+    def clear(self):
+        """Forgets every bin (after History rows were deleted): slots are seeded again on their next read."""
+        with self._lock, self._file_lock():
+            self.slots['sequence'] += 1
+            for field in ('bin_id', 'head', 'count', 'complete_from'):
+                self.slots[field] = 0
+            self.slots['sequence'] += 1
+
+    def close(self):
+        """Unmaps and closes the file; the buffer can't be used afterwards."""
+        with self._lock:
+            del self.slots
+            self._file.close()
+
+    def _snapshot(self, bin_id):
+        """Consistent copy of a bin's record: (head, count, complete_from, timestamps, levels); None if absent."""
+        slot = self._find(bin_id)
+        if slot is None:
+            return None
+        record = self.slots[slot:slot + 1]
+        for _ in range(100):
+            before = int(record['sequence'][0])
+            if before % 2:
+                time.sleep(0)
+                continue
+            # The seqlock needs a copy: a view could change under the caller
+            snapshot = (int(record['head'][0]), int(record['count'][0]), float(record['complete_from'][0]),
+                        record['timestamps'][0].copy(), record['levels'][0].copy())
+            if int(record['sequence'][0]) == before and int(record['bin_id'][0]) == bin_id:
+                return snapshot
+        return None # Writer stuck mid-update (crashed?): let the caller use History
+
+    def read(self, bin_id, limit=None):
+        """(timestamps, levels) arrays of a bin's buffered points, newest appended first; None if not buffered."""
+        snapshot = self._snapshot(bin_id)
+        if snapshot is None:
+            return None
+        head, count, _, timestamps, levels = snapshot
+        order = (head - 1 - np.arange(min(count, limit or count))) % self.capacity
+        return timestamps[order], levels[order]
+
+    def covered(self, bin_id):
+        """(timestamps, levels, complete) of the points the ring holds all of, newest first; None if not buffered.
+
+        complete means they are all of the bin's points; otherwise older ones
+        may exist outside the buffer.
+        """
+        snapshot = self._snapshot(bin_id)
+        if snapshot is None:
+            return None
+        _, count, complete_from, timestamps, levels = snapshot
+        timestamps, levels = timestamps[:count], levels[:count] # Filled in order until the ring wraps
+        order = np.argsort(-timestamps, kind='stable') # Late readings were appended out of order
+        order = order[timestamps[order] >= complete_from]
+        return timestamps[order], levels[order], complete_from == -np.inf
+
+def open_recent_buffer():
+    path = app.config['RECENT_BUFFER_PATH']
+    if not path:
+        return None
+    try:
+        return RecentReadingsBuffer(path, app.config['RECENT_BUFFER_BINS'], app.config['RECENT_BUFFER_READINGS'])
+    except (OSError, ValueError) as e:
+        app.logger.error(f"Recent readings buffer disabled, cannot open {path}: {e}")
+        return None
+
+recent_buffer = open_recent_buffer()
+
+def buffer_history_rows(history_rows):
+    """Appends committed History rows to the bins already in the ring buffer (write-through)."""
+    if recent_buffer is None:
+        return
+    per_bin = collections.defaultdict(list)
+    for row in history_rows:
+        per_bin[row["bin_id"]].append((utc_epoch(row["timestamp"]), row["level"]))
+    try:
+        for bin_id, points in per_bin.items():
+            recent_buffer.append(bin_id, [t for t, _ in points], [level for _, level in points], allocate=False)
+    except Exception as e:
+        # The rows are committed: the buffer only misses them until it is reset
+        app.logger.error(f"Recent readings buffer append failed: {e}", exc_info=True)
+
+def load_recent_points(bin_id):
+    """A bin's latest History points for seeding its ring, read on a fresh connection.
+
+    Not the request's session: its transaction may predate commits whose
+    rows were not appended because the bin had no slot yet.
+    """
+    capacity = recent_buffer.capacity
+    with db.engine.connect() as connection:
+        rows = connection.execute(db.select(History.timestamp, History.level)
+                                  .where(History.bin_id == bin_id)
+                                  .order_by(History.timestamp.desc())
+                                  .limit(capacity + 1)).all()
+    kept = rows[:capacity][::-1]
+    complete_from = -np.inf if len(rows) <= capacity else float(np.nextafter(utc_epoch(kept[0][0]), np.inf))
+    return [utc_epoch(timestamp) for timestamp, _ in kept], [level for _, level in kept], complete_from
+
+def recent_history(bin_id):
+    """A bin's latest History points from the ring buffer as (timestamps, levels, complete), newest first.
+
+    Seeds the bin's slot on first use. complete means the arrays hold all of
+    the bin's History; otherwise only its newest points. None when the buffer
+    is disabled or full.
+    """
+    if recent_buffer is None:
+        return None
+    buffered = recent_buffer.covered(bin_id)
+    if buffered is None and recent_buffer.seed(bin_id, lambda: load_recent_points(bin_id)):
+        buffered = recent_buffer.covered(bin_id)
+    return buffered
+
+def epoch_points(timestamps, levels):
+    """[(timestamp, level)] from buffered arrays, converting only the points served."""
+    return [(datetime.utcfromtimestamp(timestamp), level) for timestamp, level in zip(timestamps.tolist(), levels.tolist())]
+
+# --- Write-behind Ingestion Queue ---
+
+class IngestQueue:
+    """Bounded in-process queue drained by one background writer with group commit.
+
+    A single writer thread takes readings in FIFO order and hands them to
+    ingest_readings() in groups, flushing every `flush_size` readings or every
+    `flush_interval_ms` milliseconds, whichever comes first. Since there is
+    only one writer, readings of a bin are always applied in arrival order.
+    """
+    stop_poll = 0.1 # Seconds between checks of the stop flag while waiting
+
+    def __init__(self, maxsize, flush_size, flush_interval_ms):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.flushed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.flush_count = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, bin_number, level, timestamp):
+        """Queues a reading; returns False if the queue is full."""
+        self.start()
+        try:
+            self.queue.put_nowait((bin_number, level, timestamp))
+            return True
+        except queue.Full:
+            self.rejected += 1
+            return False
+
+    def stop(self, timeout=10):
+        """Stops the writer after flushing everything still queued."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        # Waits are capped at stop_poll seconds so stop() never waits out a
+        # long flush interval: once stopped, whatever is queued is flushed now.
+        while not (self._stop.is_set() and self.queue.empty()):
+            try:
+                first = self.queue.get(timeout=min(self.flush_interval, self.stop_poll))
+            except queue.Empty:
+                continue
+            group = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(group) < self.flush_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    group.append(self.queue.get(timeout=min(remaining, self.stop_poll)))
+                except queue.Empty:
+                    if self._stop.is_set():
+                        break
+            self._flush(group)
+
+    def _flush(self, group):
+        started = time.perf_counter()
+        with app.app_context():
+            try:
+                outcomes, _ = ingest_readings(group)
+                self.flushed += len(group)
+                for (bin_number, level, _), outcome in zip(group, outcomes):
+                    if outcome["status"] == "error":
+                        app.logger.warning(f"Queued reading dropped (bin {bin_number}, level {level}): {outcome['error']}")
+            except Exception as e:
+                self.failed += len(group)
+                app.logger.error(f"Ingest writer failed to flush {len(group)} readings: {e}")
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        metrics.observe('smarttrash_ingest_flush_duration_seconds', elapsed_ms / 1000)
+        self.flush_count += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize(),
+            "maxsize": self.queue.maxsize,
+            "flushed": self.flushed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "flushes": self.flush_count,
+            "flush_latency_ms_last": round(self.last_flush_ms, 3),
+            "flush_latency_ms_max": round(self.max_flush_ms, 3),
+            "flush_latency_ms_avg": round(self.total_flush_ms / self.flush_count, 3) if self.flush_count else 0.0,
+        }
+
+ingest_queue = IngestQueue(
+    app.config['INGEST_QUEUE_MAXSIZE'],
+    app.config['INGEST_FLUSH_SIZE'],
+    app.config['INGEST_FLUSH_INTERVAL_MS']
+)
+# Flush whatever is still queued when the process exits
+atexit.register(ingest_queue.stop)
+metrics.histogram('smarttrash_ingest_flush_duration_seconds', 'Write-behind group commit duration.')
+metrics.gauge('smarttrash_ingest_queue_depth', 'Readings waiting in the write-behind queue.', ingest_queue.queue.qsize)
+metrics.gauge('smarttrash_sse_subscribers', 'Open Server-Sent Events connections.', lambda: event_broker.subscriber_count)
+metrics.gauge('smarttrash_bin_cache_hits', 'Bin state cache hits since start.', lambda: bin_cache.hits)
+metrics.gauge('smarttrash_bin_cache_misses', 'Bin state cache misses since start.', lambda: bin_cache.misses)
+
+# --- Binary Sensor Protocol ---
+#
+# The frame format and codec live in sensor_protocol.py, shared with
+# sensor_client.py; this section is the listener side.
+
+class SequenceWindow:
+    """Remembers recently applied (device, sequence) pairs to drop retransmissions.
+
+    Entries expire after `window_seconds`, so a device that reboots and
+    restarts its counter at 0 is not mistaken for a replay for long. A frame
+    is claimed before it is applied, so a retransmission arriving meanwhile
+    (UDP handlers run in parallel) cannot be applied a second time.
+    """
+
+    def __init__(self, window_seconds):
+        self.window = window_seconds
+        self._seen = collections.OrderedDict() # (device_id, sequence) -> monotonic time
+        self._pending = set() # Claimed, being applied
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.window:
+                break
+            del self._seen[key]
+
+    def claim(self, device_id, sequence):
+        """Checks and reserves a pair in one step: 'new', 'duplicate' (applied) or 'pending'."""
+        key = (device_id, sequence)
+        with self._lock:
+            self._expire(time.monotonic())
+            if key in self._seen:
+                return 'duplicate'
+            if key in self._pending:
+                return 'pending'
+            self._pending.add(key)
+            return 'new'
+
+    def finish(self, device_id, sequence, applied):
+        """Ends a claim: remembers the pair if the frame was applied, else frees it for a retry."""
+        key = (device_id, sequence)
+        with self._lock:
+            self._pending.discard(key)
+            if applied:
+                self._seen[key] = time.monotonic()
+
+sensor_sequences = SequenceWindow(app.config['SENSOR_DEDUP_SECONDS'])
+metrics.counter('smarttrash_sensor_frames_total', 'Binary sensor frames by transport and ack status.')
+
+def handle_sensor_frame(frame):
+    """Validates and applies one frame; returns the ack to send back, or None.
+
+    Samples go through ingest_readings(), like /update and /update/batch, in
+    one transaction per frame. A frame is applied whole or not at all.
+    """
+    decoded = decode_frame(frame)
+    if decoded is None:
+        return None
+    device_id, sequence, samples = decoded
+    if samples is None:
+        return encode_ack(ACK_INVALID, device_id, sequence)
+
+    claim = sensor_sequences.claim(device_id, sequence)
+    if claim != 'new':
+        # A copy still being applied may yet fail: only ack duplicates once applied
+        return encode_ack(ACK_DUPLICATE if claim == 'duplicate' else ACK_RETRY, device_id, sequence)
+    status = ACK_RETRY
+    try:
+        status = apply_sensor_samples(device_id, samples)
+    finally:
+        sensor_sequences.finish(device_id, sequence, applied=status == ACK_OK)
+    return encode_ack(status, device_id, sequence)
+
+def apply_sensor_samples(device_id, samples):
+    """Validates and ingests the (timestamp, level) samples of one frame; returns the ack status."""
+    now = datetime.utcnow()
+    if any(level > 100 for _, level in samples):
+        return ACK_INVALID
+    samples = [(datetime.utcfromtimestamp(timestamp) if timestamp else now, level) for timestamp, level in samples]
+    if any(is_future_reading(timestamp, now) for timestamp, _ in samples):
+        return ACK_INVALID # Same stamps on every retry: the device clock needs fixing
+    with app.app_context():
+        state = bin_cache.get(device_id)
+        if state is None:
+            return ACK_UNKNOWN_DEVICE
+        readings = [(state.bin_number, level, timestamp) for timestamp, level in samples]
+        try:
+            ingest_readings(readings)
+        except Exception:
+            return ACK_RETRY # Logged by ingest_readings
+    return ACK_OK
+
+def count_sensor_frame(transport, ack):
+    status = decode_ack(ack)[0] if ack else 'dropped'
+    metrics.inc('smarttrash_sensor_frames_total', transport=transport, status=status)
+
+class SensorUDPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        frame, sock = self.request
+        ack = handle_sensor_frame(frame)
+        count_sensor_frame('udp', ack)
+        if ack:
+            sock.sendto(ack, self.client_address)
+
+class SensorTCPHandler(socketserver.StreamRequestHandler):
+    timeout = 120 # GPRS sessions that go quiet are closed
+
+    def handle(self):
+        while True:
+            try:
+                header = self.rfile.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    return # Connection closed between frames
+                rest = self.rfile.read(frame_length(header) - FRAME_HEADER.size)
+            except (OSError, struct.error):
+                return # Timed out (TimeoutError is an OSError), reset, or a header we can't size
+            ack = handle_sensor_frame(header + rest)
+            count_sensor_frame('tcp', ack)
+            if ack is None:
+                return # Lost framing: make the device reconnect
+            try:
+                self.wfile.write(ack)
+            except OSError:
+                return # The device hung up before its ack
+
+class SensorUDPServer(socketserver.ThreadingUDPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class SensorTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# --- Alerts ---
+#
+# Threshold crossings and emptyings detected by ingestion become AlertJob
+# rows (one per recipient), committed with the readings themselves, so
+# nothing is lost on restart and sensors never wait on SMTP or HTTP. A dispatcher delivers them
+# in batches per recipient, retrying failures with exponential backoff.
+# While a job is pending, newer events of the same bin and kind are folded
+# into it; after delivery the bin stays quiet for ALERT_COOLDOWN_MINUTES.
+
+ALERT_CHANNELS = {}
+
+def alert_channel(*schemes):
+    """Registers a channel class for recipients starting with one of `schemes`."""
+    def register(cls):
+        for scheme in schemes:
+            ALERT_CHANNELS[scheme] = cls
+        return cls
+    return register
+
+def channel_for(recipient):
+    scheme = recipient.split(':', 1)[0].lower()
+    if scheme not in ALERT_CHANNELS:
+        raise ValueError(f"Aucun canal d'alerte pour {recipient}")
+    return ALERT_CHANNELS[scheme]()
+
+def describe_alert(job, bin_state):
+    where = f"{bin_state.bin_number} ({bin_state.location})" if bin_state else f"#{job.bin_id}"
+    when = job.event_time.strftime('%Y-%m-%d %H:%M:%S')
+    if job.kind == 'emptied':
+        return f"Poubelle {where} vidée le {when} UTC (niveau {job.level} %)."
+    repeated = f", {job.occurrences} signalements" if job.occurrences > 1 else ""
+    return f"Poubelle {where} au niveau critique : {job.level} % le {when} UTC{repeated}."
+
+@alert_channel('mailto')
+class SmtpChannel:
+    """One e-mail per batch, through the configured SMTP relay."""
+
+    def send(self, recipient, jobs, bins):
+        message = EmailMessage()
+        message['From'] = app.config['ALERT_SMTP_FROM']
+        message['To'] = recipient.split(':', 1)[1]
+        message['Subject'] = f"Smart-Trash : {len(jobs)} alerte(s)"
+        message.set_content("\n".join(describe_alert(job, bins.get(job.bin_id)) for job in jobs) + "\n")
+        with smtplib.SMTP(app.config['ALERT_SMTP_HOST'], app.config['ALERT_SMTP_PORT'], timeout=30) as smtp:
+            if app.config['ALERT_SMTP_STARTTLS']:
+                smtp.starttls()
+            if app.config['ALERT_SMTP_USER']:
+                smtp.login(app.config['ALERT_SMTP_USER'], app.config['ALERT_SMTP_PASSWORD'])
+            smtp.send_message(message)
+
+@alert_channel('http', 'https')
+class WebhookChannel:
+    """One JSON POST per batch; any non-2xx answer counts as a failure."""
+
+    def send(self, recipient, jobs, bins):
+        alerts = []
+        for job in jobs:
+            state = bins.get(job.bin_id)
+            alerts.append({
+                "id": job.id,
+                "kind": job.kind,
+                "bin_id": job.bin_id,
+                "bin_number": state.bin_number if state else None,
+                "location": state.location if state else None,
+                "level": job.level,
+                "event_time": job.event_time.isoformat(),
+                "occurrences": job.occurrences,
+                "message": describe_alert(job, state)
+            })
+        body = json.dumps({"alerts": alerts}).encode('utf-8')
+        webhook_request = urllib.request.Request(recipient, data=body, method='POST', headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(webhook_request, timeout=app.config['ALERT_WEBHOOK_TIMEOUT']) as response:
+            if not 200 <= response.status < 300:
+                raise RuntimeError(f"HTTP {response.status}")
+
+metrics.counter('smarttrash_alerts_total', 'Alert events by kind and outcome (queued, coalesced, suppressed, cancelled).')
+metrics.counter('smarttrash_alert_deliveries_total', 'Alert batch deliveries by channel and result.')
+
+def alert_events(applied):
+    """(bin_id, kind, level, event_time) of the threshold crossings and emptyings among applied readings."""
+    threshold = app.config['ALERT_LEVEL']
+    kinds = app.config['ALERT_KINDS']
+    events = []
+    for reading in applied:
+        if reading.late:
+            continue
+        if reading.emptied and 'emptied' in kinds:
+            events.append((reading.bin_id, 'emptied', reading.level, reading.timestamp))
+        elif 'critical' in kinds and reading.level >= threshold and (reading.previous_level is None or reading.previous_level < threshold):
+            events.append((reading.bin_id, 'critical', reading.level, reading.timestamp))
+    return events
+
+def queue_alerts(applied, now):
+    """Adds the alert jobs raised by applied readings to the session; the caller commits.
+
+    ingest_readings() calls it before its commit, so alerts are stored with
+    the readings that raised them or not at all. One query loads the jobs the
+    events may fold into (or be suppressed by), for every recipient at once.
+    Returns {(kind, outcome): count} for the metrics, to count once committed.
+    """
+    counts = collections.Counter()
+    recipients = app.config['ALERT_RECIPIENTS']
+    events = alert_events(applied) if recipients else []
+    if not events:
+        return counts
+    cooldown_start = now - timedelta(minutes=app.config['ALERT_COOLDOWN_MINUTES'])
+    jobs = collections.defaultdict(list) # (bin_id, kind, recipient) -> jobs
+    for job in AlertJob.query.filter(AlertJob.bin_id.in_({bin_id for bin_id, _, _, _ in events}),
+                                     db.or_(AlertJob.status.in_(('pending', 'sending')), AlertJob.sent_at >= cooldown_start)):
+        jobs[(job.bin_id, job.kind, job.recipient)].append(job)
+
+    for bin_id, kind, level, event_time in events:
+        if kind == 'emptied':
+            # A bin that got emptied no longer needs its pending "critical" alert
+            for recipient in recipients:
+                for job in jobs[(bin_id, 'critical', recipient)]:
+                    if job.status == 'pending':
+                        job.status = 'cancelled'
+                        counts[('critical', 'cancelled')] += 1
+        for recipient in recipients:
+            recipient_jobs = [job for job in jobs[(bin_id, kind, recipient)] if job.status != 'cancelled']
+            pending = next((job for job in recipient_jobs if job.status == 'pending'), None)
+            if pending is not None:
+                pending.level, pending.event_time = level, max(pending.event_time, event_time)
+                pending.occurrences += 1
+                counts[(kind, 'coalesced')] += 1
+            elif recipient_jobs:
+                counts[(kind, 'suppressed')] += 1 # In flight or cooling down
+            else:
+                job = AlertJob(bin_id=bin_id, kind=kind, recipient=recipient, level=level, event_time=event_time,
+                               occurrences=1, status='pending', attempts=0, next_attempt_at=now)
+                db.session.add(job)
+                jobs[(bin_id, kind, recipient)].append(job)
+                counts[(kind, 'queued')] += 1
+    return counts
+
+class AlertDispatcher:
+    """Background deliverer of AlertJob rows, batched per recipient.
+
+    Every `batch_seconds` it claims the due jobs with one UPDATE (so several
+    dispatchers never send the same job), sends one message per recipient
+    and records the outcome. A failed batch is retried after
+    retry_base * 2^attempts seconds, up to max_attempts.
+    """
+
+    CLAIM_TIMEOUT = timedelta(minutes=10) # A claim older than this belonged to a dead dispatcher
+
+    def __init__(self, batch_seconds, max_attempts, retry_base_seconds):
+        self.batch_seconds = batch_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base_seconds
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self.run, name='alert-dispatcher', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        """Dispatches every batch_seconds until stop() (the thread body, or a foreground loop)."""
+        while not self._stop.wait(self.batch_seconds):
+            try:
+                self.dispatch_once()
+            except Exception as e:
+                app.logger.error(f"Alert dispatch failed: {e}", exc_info=True)
+
+    def dispatch_once(self, now=None):
+        """Delivers every due job; returns (sent, failed) job counts."""
+        now = now or datetime.utcnow()
+        claim = secrets.token_hex(8)
+        with app.app_context():
+            def claim_jobs():
+                AlertJob.query.filter(AlertJob.status == 'sending', AlertJob.claimed_at < now - self.CLAIM_TIMEOUT)\
+                              .update({"status": "pending", "claim": None}, synchronize_session=False)
+                AlertJob.query.filter(AlertJob.status == 'pending', AlertJob.next_attempt_at <= now)\
+                              .update({"status": "sending", "claim": claim, "claimed_at": now}, synchronize_session=False)
+                db.session.commit()
+
+            run_with_lock_retry(claim_jobs)
+            jobs = AlertJob.query.filter_by(claim=claim).order_by(AlertJob.event_time).all()
+            if not jobs:
+                return 0, 0
+            by_recipient = collections.defaultdict(list)
+            for job in jobs:
+                by_recipient[job.recipient].append(job)
+            bins = {state.id: state for state in (bin_cache.get(bin_id) for bin_id in {job.bin_id for job in jobs}) if state}
+
+            sent = failed = 0
+            for recipient, recipient_jobs in by_recipient.items():
+                try:
+                    channel = channel_for(recipient)
+                    channel.send(recipient, recipient_jobs, bins)
+                except Exception as e:
+                    failed += len(recipient_jobs)
+                    metrics.inc('smarttrash_alert_deliveries_total', channel=recipient.split(':', 1)[0], result='failed')
+                    app.logger.warning(f"Alert delivery to {recipient} failed ({len(recipient_jobs)} alerts): {e}")
+                    for job in recipient_jobs:
+                        job.attempts += 1
+                        job.last_error = str(e)[:500]
+                        job.claim = None
+                        if job.attempts >= self.max_attempts:
+                            job.status = 'failed'
+                        else:
+                            job.status = 'pending'
+                            job.next_attempt_at = now + timedelta(seconds=min(self.retry_base * 2 ** (job.attempts - 1), 3600))
+                    continue
+                sent += len(recipient_jobs)
+                metrics.inc('smarttrash_alert_deliveries_total', channel=recipient.split(':', 1)[0], result='sent')
+                for job in recipient_jobs:
+                    job.attempts += 1
+                    job.status, job.sent_at, job.claim, job.last_error = 'sent', now, None, None
+            db.session.commit()
+            return sent, failed
+
+alert_dispatcher = AlertDispatcher(app.config['ALERT_BATCH_SECONDS'], app.config['ALERT_MAX_ATTEMPTS'],
+                                   app.config['ALERT_RETRY_BASE_SECONDS'])
+
+# --- Compiled Page Cache ---
+
+class CompiledPage:
+    """A page template compiled once, with its rendered and compressed variants.
+
+    Rendered bodies are cached per value of the variables the template
+    actually uses (jinja2.meta), so a page without placeholders is rendered
+    and compressed exactly once per file version. gzip and Brotli encodings
+    are produced lazily on first request and served by Accept-Encoding, with
+    an ETag per variant for revalidation.
+    """
+
+    MAX_VARIANTS = 64
+
+    def __init__(self, path, mtime, source):
+        self.path = path
+        self.mtime = mtime
+        self.template = app.jinja_env.from_string(source)
+        self.variables = jinja2_meta.find_undeclared_variables(app.jinja_env.parse(source))
+        self._variants = collections.OrderedDict() # context key -> {encoding: (body, etag)}
+        self._lock = threading.Lock()
+
+    def _variant(self, context):
+        key = tuple(sorted((name, value) for name, value in context.items() if name in self.variables))
+        with self._lock:
+            variant = self._variants.get(key)
+            if variant is not None:
+                self._variants.move_to_end(key)
+                return variant
+        body = render_template(self.template, **context).encode('utf-8')
+        variant = {'identity': (body, compute_etag(self.path, self.mtime, key, 'identity'))}
+        with self._lock:
+            self._variants[key] = variant
+            while len(self._variants) > self.MAX_VARIANTS:
+                self._variants.popitem(last=False)
+        return variant
+
+    def _encoded(self, variant, encoding):
+        if encoding not in variant:
+            body = variant['identity'][0]
+            if encoding == 'br':
+                data = brotli.compress(body, quality=app.config['PAGE_BROTLI_QUALITY'])
+            else:
+                data = gzip.compress(body, compresslevel=9)
+            variant[encoding] = (data, compute_etag(variant['identity'][1], encoding))
+        return variant[encoding]
+
+    def response(self, **context):
+        variant = self._variant(context)
+        encoding = 'identity'
+        if brotli is not None and request.accept_encodings['br']:
+            encoding = 'br'
+        elif request.accept_encodings['gzip']:
+            encoding = 'gzip'
+        body, etag = self._encoded(variant, encoding)
+
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(body, mimetype='text/html')
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        # Per-user page behind a login: browsers may cache it but must revalidate
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+class CompiledPageCache:
+    """Keeps CompiledPage objects per file and recompiles when the mtime changes."""
+
+    def __init__(self):
+        self._pages = {} # candidates tuple -> CompiledPage
+        self._lock = threading.Lock()
+
+    def get(self, candidates):
+        page = self._pages.get(candidates)
+        if page is not None:
+            try:
+                # A single stat() per request to detect edits of the file
+                if os.stat(page.path).st_mtime == page.mtime:
+                    return page
+            except OSError:
+                pass
+        for path in candidates:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if path != candidates[0]:
+                app.logger.warning(f"HTML file found in fallback location: {path}")
+            with open(path, 'r', encoding='utf-8') as f:
+                page = CompiledPage(path, mtime, f.read())
+            with self._lock:
+                self._pages[candidates] = page
+            return page
+        raise FileNotFoundError(candidates[0])
+
+dashboard_pages = CompiledPageCache()
+
+# --- History Export ---
+
+EXPORT_COLUMNS = ('id', 'bin_number', 'timestamp', 'level')
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+class ChunkSink:
+    """Write-only file object handing back whatever was written since the last drain()."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def history_export_query(start, end):
+    """History rows of [start, end) with their bin number, unordered (pages add the order)."""
+    query = db.select(History.id, Bin.bin_number, History.timestamp, History.level)\
+              .join(Bin, Bin.id == History.bin_id)
+    if start is not None:
+        query = query.where(History.timestamp >= start)
+    if end is not None:
+        query = query.where(History.timestamp < end)
+    return query
+
+def fetch_export_page(query, limit):
+    """One page, in its own short read transaction on a fresh connection.
+
+    A slow client then never pins a WAL snapshot: checkpoints keep up during
+    the download.
+    """
+    with db.engine.connect() as connection:
+        return connection.execute(query.limit(limit)).all()
+
+def iter_history_chunks(bin_ids, start, end, chunk_size):
+    """Yields lists of (at most chunk_size) History rows, one keyset page at a time.
+
+    Without a bin filter, rows come in id (insertion) order: SQLite walks the
+    rowid from the last id, no sort to materialise. With one, they come bin by
+    bin in (timestamp, id) order, walking ix_history_bin_timestamp from the
+    last (timestamp, id): ordering those by id would make SQLite re-read and
+    sort every remaining row of the bins for each page.
+    """
+    query = history_export_query(start, end)
+    if bin_ids is None:
+        last_id = 0
+        while True:
+            rows = fetch_export_page(query.where(History.id > last_id).order_by(History.id), chunk_size)
+            if rows:
+                yield rows
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1].id
+
+    chunk = []
+    for bin_id in sorted(set(bin_ids)):
+        bin_query = query.where(History.bin_id == bin_id).order_by(History.timestamp, History.id)
+        page_query = bin_query
+        while True:
+            wanted = chunk_size - len(chunk)
+            rows = fetch_export_page(page_query, wanted)
+            chunk.extend(rows)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+            if len(rows) < wanted:
+                break # This bin is done: the next one fills the rest of the chunk
+            page_query = bin_query.where(db.tuple_(History.timestamp, History.id) > (rows[-1].timestamp, rows[-1].id))
+    if chunk:
+        yield chunk
+
+def export_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows((row.id, row.bin_number, row.timestamp.isoformat(), row.level) for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8') # Header only: no rows matched
+
+def export_arrow(chunks, fmt):
+    """Parquet (one row group per chunk) or Arrow IPC stream, written chunk by chunk."""
+    schema = pyarrow.schema([('id', pyarrow.int64()), ('bin_number', pyarrow.string()),
+                             ('timestamp', pyarrow.timestamp('us')), ('level', pyarrow.int16())])
+    sink = ChunkSink()
+    if fmt == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd')
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+    for rows in chunks:
+        columns = list(zip(*rows))
+        writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+# --- Bulk Bin Import ---
+
+IMPORT_FORMATS = {'text/csv': 'csv', 'application/x-ndjson': 'jsonl', 'application/jsonl': 'jsonl'}
+IMPORT_MAX_ERRORS = 20
+
+def import_format_for(name):
+    """'jsonl' for .jsonl/.ndjson files, 'csv' otherwise."""
+    return 'jsonl' if name.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+def iter_import_records(stream, fmt):
+    """Yields (line_number, record, error) from a text stream, one row at a time.
+
+    CSV needs a header row naming the columns; JSONL has one object per line.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        missing = [f for f in ('bin_number', 'location') if f not in (reader.fieldnames or ())]
+        if missing:
+            yield 1, None, f"Colonne(s) manquante(s) dans l'en-tête : {', '.join(missing)}"
+            return
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            yield line_number, None, "JSON invalide"
+            continue
+        yield line_number, record, None if isinstance(record, dict) else "Objet JSON attendu"
+
+def parse_import_record(record):
+    """Validates one record into Bin column values; raises ValueError with the message to report."""
+    def text(field):
+        value = record.get(field)
+        return '' if value is None else str(value).strip()
+
+    bin_number, location = text('bin_number'), text('location')
+    if not bin_number or len(bin_number) > 50:
+        raise ValueError("Le numéro de poubelle doit faire entre 1 et 50 caractères")
+    if not location or len(location) > 200:
+        raise ValueError("L'adresse doit faire entre 1 et 200 caractères")
+    values = {"bin_number": bin_number, "location": location}
+    for field, label, limit in (("latitude", "La latitude", 90), ("longitude", "La longitude", 180)):
+        raw_value = text(field)
+        try:
+            value = float(raw_value) if raw_value else None
+        except ValueError:
+            value = float('nan')
+        if value is not None and not (-limit <= value <= limit):
+            raise ValueError(f"{label} doit être un nombre entre {-limit} et {limit}")
+        values[field] = value
+    return values
+
+def bin_upsert_statement():
+    """INSERT of new bins; existing ones get the new address and coordinates.
+
+    last_updated is only set on insert: it is the time of the last sensor
+    reading, and moving it would hide a stale bin and turn readings taken
+    before the import into late ones.
+    """
+    table = Bin.__table__
+    stmt = sqlite_insert(table)
+    excluded = stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.bin_number],
+        set_={"location": excluded.location, "latitude": excluded.latitude,
+              "longitude": excluded.longitude, "revision": table.c.revision + 1,
+              "config_revision": table.c.config_revision + 1}
+    )
+
+def import_bins(records, chunk_size):
+    """Creates or updates bins from iter_import_records() output, all or nothing.
+
+    Records are validated as they are read; uniqueness is settled against
+    the bin numbers loaded in one query, and the current values of the bins
+    a chunk touches are fetched with it, so rows that change nothing are
+    skipped and missing coordinates keep the stored ones. Chunks are
+    upserted in a single transaction, retried from the validated rows if
+    another worker holds the write lock. If any row is invalid, nothing is
+    written and the summary lists the errors (the first IMPORT_MAX_ERRORS of
+    them).
+    """
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    table = Bin.__table__
+    upsert = bin_upsert_statement()
+
+    def write_chunk(chunk, existing, stats_delta, moved, counts):
+        numbers = [values["bin_number"] for values in chunk if values["bin_number"] in existing]
+        previous_rows = {row.bin_number: row for row in db.session.connection().execute(
+            db.select(table).where(table.c.bin_number.in_(numbers)))} if numbers else {}
+        rows = []
+        for values in chunk:
+            values = dict(values) # The validated row stays as parsed for a retry
+            previous = previous_rows.get(values["bin_number"])
+            if previous is not None:
+                for field in ("latitude", "longitude"):
+                    if values[field] is None:
+                        values[field] = getattr(previous, field)
+                if (values["location"], values["latitude"], values["longitude"]) == \
+                        (previous.location, previous.latitude, previous.longitude):
+                    continue
+                counts["updated"] += 1
+                moved.append((previous.id, values["latitude"], values["longitude"]))
+            else:
+                counts["created"] += 1
+            values["last_updated"] = now # Only used when the row is inserted
+            stats_delta.move(previous, BinState(previous and previous.id, values["bin_number"], values["location"],
+                                                previous.current_level if previous else 0,
+                                                previous.last_updated if previous else now,
+                                                previous and previous.last_emptied_timestamp))
+            rows.append(values)
+        if rows:
+            db.session.execute(upsert, rows)
+
+    def write_all():
+        """One unit of work: a retry starts over from the bins as they are now."""
+        # Plain Core rows: this is the one query that reads every bin
+        existing = dict(db.session.connection().execute(db.select(table.c.bin_number, table.c.id)).all())
+        stats_delta = FleetStatsDelta()
+        moved = [] # (bin_id, latitude, longitude) of updated bins
+        counts = {"created": 0, "updated": 0}
+        for first in range(0, len(valid), chunk_size):
+            write_chunk(valid[first:first + chunk_size], existing, stats_delta, moved, counts)
+        stats_delta.flush()
+        db.session.commit()
+        return max(existing.values(), default=0), stats_delta, moved, counts
+
+    seen = set()
+    valid = []
+    errors = []
+    error_count = rows = 0
+    for line_number, record, error in records:
+        rows += 1
+        if error is None:
+            try:
+                values = parse_import_record(record)
+            except ValueError as e:
+                error = str(e)
+            else:
+                if values["bin_number"] in seen:
+                    error = f"Poubelle {values['bin_number']} en double dans le fichier"
+                seen.add(values["bin_number"])
+        if error is not None:
+            error_count += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_number, "error": error})
+            continue
+        if not error_count:
+            valid.append(values) # Once a row is invalid, only keep validating
+
+    counts = {"created": 0, "updated": 0}
+    if not error_count:
+        try:
+            max_id, stats_delta, moved, counts = run_with_lock_retry(write_all)
+        except Exception:
+            db.session.rollback()
+            raise
+
+    created, updated = counts["created"], counts["updated"]
+    if not error_count:
+        fleet_stats.apply(stats_delta)
+        for bin_id, lat, lon in moved:
+            bin_cache.invalidate(bin_id) # Unknown (new) bins are never cached
+            spatial_index.update(bin_id, lat, lon)
+        if created and (forecaster.loaded or spatial_index.loaded):
+            new_bins = db.session.execute(db.select(Bin.id, Bin.bin_number, Bin.current_level, Bin.latitude, Bin.longitude)
+                                          .where(Bin.id > max_id)).all()
+            forecaster.add_bins((row.id, row.bin_number, row.current_level) for row in new_bins)
+            for row in new_bins:
+                spatial_index.update(row.id, row.latitude, row.longitude)
+        metrics.inc('smarttrash_bins_imported_total', created, status='created')
+        metrics.inc('smarttrash_bins_imported_total', updated, status='updated')
+    else:
+        created = updated = 0
+    seconds = time.perf_counter() - started
+    return {
+        "rows": rows,
+        "created": created,
+        "updated": updated,
+        "unchanged": 0 if error_count else rows - created - updated,
+        "invalid": error_count,
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds) if seconds > 0 else None
+    }
+
+metrics.counter('smarttrash_bins_imported_total', 'Bins created or updated by bulk imports.')
+
+# --- Reports ---
+
+REPORT_FORMATS = {
+    'pdf': ('application/pdf', lambda: pd is not None and SimpleDocTemplate is not None),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', lambda: pd is not None and openpyxl is not None),
+}
+REPORT_COLUMNS = {
+    'bin_number': "Poubelle", 'zone': "Zone", 'bins': "Poubelles", 'day': "Jour",
+    'readings': "Mesures", 'level_mean': "Niveau moyen (%)", 'level_max': "Niveau max (%)",
+    'last_level': "Dernier niveau (%)", 'critical_hours': "Heures au-dessus du seuil",
+    'full_bins': "Poubelles au-dessus du seuil", 'emptyings': "Vidages",
+}
+
+def report_rollup_ranges(start, end):
+    """The (rollup model, from, to) ranges a report over [start, end) reads.
+
+    Whole days come from HistoryDaily, the hours before the first and after
+    the last whole day from HistoryHourly; start and end are on the hour.
+    """
+    first_day = floor_to_day(start)
+    if first_day < start:
+        first_day += timedelta(days=1)
+    last_day = floor_to_day(end)
+    if first_day >= last_day:
+        return [(HistoryHourly, start, end)]
+    ranges = [(HistoryDaily, first_day, last_day)]
+    if start < first_day:
+        ranges.insert(0, (HistoryHourly, start, first_day))
+    if last_day < end:
+        ranges.append((HistoryHourly, last_day, end))
+    return ranges
+
+def report_watermark(start, end):
+    """Changes whenever the data a report over [start, end) is built from changes.
+
+    The rollup rows of the period (late readings included) and the bins:
+    rollups are upserted in place, so their sums are compared, not their
+    ids. Bins carry their renumberings and new addresses (zones), and how
+    many of them hold their last reading at the end of the period.
+    """
+    parts = []
+    for model, range_start, range_end in report_rollup_ranges(start, end):
+        # bin_id IN (...) turns this into one unique-index range per bin, so
+        # the cost follows the period, not the whole rollup table
+        rollups = db.session.query(func.count(model.id), func.sum(model.reading_count), func.sum(model.emptied_count),
+                                   func.round(func.sum(model.seconds_above_threshold), 3))\
+                            .filter(model.bin_id.in_(db.select(Bin.id)),
+                                    model.bucket_start >= range_start, model.bucket_start < range_end).one()
+        parts.extend(rollups)
+    bins = db.session.query(func.count(Bin.id), func.max(Bin.id), func.sum(Bin.config_revision),
+                            func.sum(db.case((Bin.last_updated <= end, 1), else_=0))).one()
+    return ':'.join(str(part) for part in (*parts, *bins))
+
+def report_cache_key(fmt, start, end, watermark):
+    return hashlib.sha256(f"{fmt}|{start.isoformat()}|{end.isoformat()}|{watermark}".encode('utf-8')).hexdigest()
+
+def find_cached_report(cache_key, now):
+    """The finished job for this key (file still on disk), else one still in progress, else None."""
+    alive_since = now - timedelta(minutes=app.config['REPORT_TIMEOUT_MINUTES'])
+    jobs = ReportJob.query.filter(ReportJob.cache_key == cache_key, ReportJob.status.in_(('done', 'queued', 'running')))\
+                          .order_by(ReportJob.id.desc()).all()
+    for job in jobs:
+        if job.status == 'done' and os.path.exists(os.path.join(app.config['REPORT_DIR'], job.file_name)):
+            return job
+    return next((job for job in jobs if job.status != 'done' and job.created_at >= alive_since), None)
+
+def read_report_rollups(first_id, last_id, ranges):
+    """Rollup rows of the bins first_id..last_id over the report ranges, as one frame."""
+    rows = []
+    for model, range_start, range_end in ranges:
+        query = db.select(model.bin_id, model.bucket_start, model.max_level, model.level_sum, model.reading_count,
+                          model.seconds_above_threshold, model.emptied_count)\
+                  .where(model.bin_id.between(first_id, last_id),
+                         model.bucket_start >= range_start, model.bucket_start < range_end)
+        rows.extend(db.session.execute(query).all())
+    frame = pd.DataFrame(rows, columns=['bin_id', 'bucket_start', 'max_level', 'level_sum', 'reading_count',
+                                        'seconds_above_threshold', 'emptied_count'])
+    # max_level is NULL in buckets that only carry time above threshold
+    return frame.astype({'max_level': float, 'seconds_above_threshold': float})
+
+def aggregate_report_chunk(frame):
+    """Per-bin and per-(bin, day) sums of rollup rows.
+
+    Rollups hold every reading received, before History compression, and
+    the time above threshold between consecutive readings, spread over the
+    hours it covers. Means are means of the readings.
+    """
+    frame = frame.assign(day=pd.to_datetime(frame['bucket_start']).dt.floor('D'))
+    per_bin = frame.groupby('bin_id').agg(
+        readings=('reading_count', 'sum'), level_sum=('level_sum', 'sum'), level_max=('max_level', 'max'),
+        critical_seconds=('seconds_above_threshold', 'sum'), emptyings=('emptied_count', 'sum'))
+    per_day = frame.groupby(['bin_id', 'day']).agg(
+        readings=('reading_count', 'sum'), level_sum=('level_sum', 'sum'), emptyings=('emptied_count', 'sum'))
+    return per_bin, per_day
+
+def levels_at(end, first_id, last_id):
+    """Level at `end` of the bins first_id..last_id updated after it, as a float Series by bin id.
+
+    Like reconstruct_level_curve(), from the History points either side of
+    `end` (or the bin's current state when none follows), with four index
+    lookups per bin. NaN when no point precedes `end`.
+    """
+    def nearest(column, after):
+        order = (History.timestamp, History.id) if after else (History.timestamp.desc(), History.id.desc())
+        return db.select(column).where(History.bin_id == Bin.id, History.timestamp > end if after else History.timestamp <= end)\
+                 .order_by(*order).limit(1).scalar_subquery()
+    query = db.select(Bin.id, Bin.current_level, Bin.last_updated,
+                      nearest(History.timestamp, False), nearest(History.level, False),
+                      nearest(History.timestamp, True), nearest(History.level, True))\
+              .where(Bin.id.between(first_id, last_id), Bin.last_updated > end)
+    frame = pd.DataFrame(db.session.execute(query).all(), columns=['bin_id', 'current_level', 'last_updated', 'before_time',
+                                                                   'before_level', 'after_time', 'after_level'])
+    if frame.empty:
+        return pd.Series(dtype=float, index=pd.Index([], name='bin_id'))
+    frame = frame.set_index('bin_id')
+    before_time = pd.to_datetime(frame['before_time'])
+    before_level = frame['before_level'].astype(float)
+    if history_compressor.mode == 'deadband':
+        return before_level
+    next_time = pd.to_datetime(frame['after_time']).fillna(pd.to_datetime(frame['last_updated']))
+    next_level = frame['after_level'].astype(float).fillna(frame['current_level'].astype(float))
+    span = (next_time - before_time).dt.total_seconds()
+    fraction = ((pd.Timestamp(end) - before_time).dt.total_seconds() / span.where(span > 0)).fillna(0.0)
+    return before_level + fraction * (next_level - before_level)
+
+def build_report_frames(start, end, threshold):
+    """The report tables (zones, bins, days) over [start, end), from the history rollups.
+
+    Rollups are read REPORT_CHUNK_BINS bins at a time, each chunk being a
+    range scan of the (bin_id, bucket_start) index, so memory follows the
+    chunk and not the fleet. Every sum is additive, so chunks are simply
+    concatenated. A bin still holding its last reading at `end` adds the
+    time since that reading above threshold, which no rollup has closed yet.
+    """
+    bins = pd.DataFrame(db.session.execute(db.select(Bin.id, Bin.bin_number, Bin.location, Bin.current_level,
+                                                     Bin.last_updated).order_by(Bin.id)).all(),
+                        columns=['bin_id', 'bin_number', 'location', 'current_level', 'last_updated'])
+    bins['zone'] = bins['location'].map(zone_of)
+    bins['last_updated'] = pd.to_datetime(bins['last_updated'])
+    bins = bins.drop(columns='location').set_index('bin_id')
+
+    ranges = report_rollup_ranges(start, end)
+    per_bin_parts, per_day_parts, later_levels = [], [], []
+    chunk_bins = app.config['REPORT_CHUNK_BINS']
+    for first in range(0, len(bins), chunk_bins):
+        ids = bins.index[first:first + chunk_bins]
+        later_levels.append(levels_at(end, int(ids[0]), int(ids[-1])))
+        frame = read_report_rollups(int(ids[0]), int(ids[-1]), ranges)
+        if frame.empty:
+            continue
+        per_bin, per_day = aggregate_report_chunk(frame)
+        per_bin_parts.append(per_bin)
+        per_day_parts.append(per_day)
+
+    sums = ['readings', 'level_sum', 'critical_seconds', 'emptyings']
+    # Numeric columns even without readings, so the fillna() below stays numeric
+    per_bin = pd.concat(per_bin_parts) if per_bin_parts else \
+        pd.DataFrame(columns=sums + ['level_max'], index=pd.Index([], name='bin_id'), dtype=float)
+    bin_table = bins.join(per_bin, how='left')
+    bin_table[sums] = bin_table[sums].fillna(0)
+
+    held = bin_table['last_updated'].notna() & (bin_table['last_updated'] <= pd.Timestamp(end))
+    held_since = bin_table['last_updated'].clip(lower=pd.Timestamp(start))
+    held_seconds = (pd.Timestamp(end) - held_since).dt.total_seconds()
+    bin_table['critical_seconds'] += held_seconds.where(held & (bin_table['current_level'] >= threshold), 0.0)
+    bin_table['last_level'] = bin_table['current_level'].astype(float).where(held)
+    if later_levels:
+        bin_table['last_level'] = bin_table['last_level'].fillna(pd.concat(later_levels).round())
+
+    readings = bin_table['readings'].where(bin_table['readings'] > 0)
+    bin_table['level_mean'] = (bin_table['level_sum'] / readings).round(1)
+    bin_table['critical_hours'] = (bin_table['critical_seconds'] / 3600).round(1)
+    bin_table['full'] = (bin_table['level_max'] >= threshold) | (bin_table['critical_seconds'] > 0)
+    bin_table = bin_table.astype({'readings': int, 'emptyings': int, 'level_max': 'Int64', 'last_level': 'Int64'})
+
+    zones = bin_table.groupby('zone').agg(
+        bins=('bin_number', 'size'), readings=('readings', 'sum'), level_sum=('level_sum', 'sum'),
+        full_bins=('full', 'sum'), critical_hours=('critical_hours', 'sum'), emptyings=('emptyings', 'sum'))
+    zones['level_mean'] = (zones['level_sum'] / zones['readings'].where(zones['readings'] > 0)).round(1)
+    zones = zones.reset_index()[['zone', 'bins', 'readings', 'level_mean', 'full_bins', 'critical_hours', 'emptyings']]
+
+    if per_day_parts:
+        per_day = pd.concat(per_day_parts).reset_index().join(bins['zone'], on='bin_id')
+        days = per_day.groupby(['day', 'zone']).agg(readings=('readings', 'sum'), level_sum=('level_sum', 'sum'),
+                                                    emptyings=('emptyings', 'sum'))
+        days['level_mean'] = (days['level_sum'] / days['readings'].where(days['readings'] > 0)).round(1)
+        days = days.reset_index()
+        days['day'] = days['day'].dt.date
+        days = days[['day', 'zone', 'readings', 'level_mean', 'emptyings']]
+    else:
+        days = pd.DataFrame(columns=['day', 'zone', 'readings', 'level_mean', 'emptyings'])
+
+    bin_table = bin_table.sort_values(['zone', 'bin_number'])[
+        ['bin_number', 'zone', 'readings', 'level_mean', 'level_max', 'last_level', 'critical_hours', 'emptyings']]
+    return {"Zones": zones, "Poubelles": bin_table, "Par jour": days}
+
+def write_report_xlsx(path, tables, start, end):
+    with pd.ExcelWriter(path, engine='openpyxl') as writer:
+        for name, table in tables.items():
+            table.rename(columns=REPORT_COLUMNS).to_excel(writer, sheet_name=name, index=False)
+
+def write_report_pdf(path, tables, start, end):
+    styles = getSampleStyleSheet()
+    story = [Paragraph("Rapport de remplissage et de vidage", styles['Title']),
+             Paragraph(f"Période du {start:%d/%m/%Y %H:%M} au {end:%d/%m/%Y %H:%M} (UTC)", styles['Normal'])]
+    table_style = TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), pdf_colors.HexColor('#2e7d32')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), pdf_colors.white),
+        ('FONTSIZE', (0, 0), (-1, -1), 8),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [pdf_colors.white, pdf_colors.HexColor('#f1f8e9')]),
+        ('GRID', (0, 0), (-1, -1), 0.25, pdf_colors.grey),
+    ])
+    for name, table in tables.items():
+        story += [Spacer(1, 12), Paragraph(name, styles['Heading2'])]
+        if table.empty:
+            story.append(Paragraph("Aucune donnée sur la période.", styles['Normal']))
+            continue
+        rows = table.astype(object).where(table.notna(), '').values.tolist()
+        story.append(LongTable([[REPORT_COLUMNS[c] for c in table.columns]] + rows, repeatRows=1, style=table_style))
+    SimpleDocTemplate(path, pagesize=landscape(A4), title="Rapport Smart-Trash").build(story)
+
+REPORT_WRITERS = {'pdf': write_report_pdf, 'xlsx': write_report_xlsx}
+
+class ReportWorker:
+    """Thread pool building queued ReportJob rows into files under REPORT_DIR.
+
+    Jobs live in the database, so any process can tell their status; each
+    is built by the process that queued it. A job is claimed with one
+    UPDATE, so it is never built twice.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, job_id):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='report')
+        self._executor.submit(self.run, job_id)
+
+    def run(self, job_id):
+        with app.app_context():
+            def claim():
+                claimed = ReportJob.query.filter_by(id=job_id, status='queued')\
+                                         .update({"status": 'running', "started_at": datetime.utcnow()})
+                db.session.commit()
+                return claimed
+            if not run_with_lock_retry(claim):
+                return
+            job = db.session.get(ReportJob, job_id)
+            fmt = job.format
+            started = time.perf_counter()
+            try:
+                file_name = self.build(job.id, job.cache_key, fmt, job.period_start, job.period_end)
+                status, error = 'done', None
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Report {job_id} failed: {e}", exc_info=True)
+                file_name, status, error = None, 'failed', str(e)[:500]
+            def finish():
+                size = os.path.getsize(os.path.join(app.config['REPORT_DIR'], file_name)) if file_name else None
+                ReportJob.query.filter_by(id=job_id).update({"status": status, "file_name": file_name, "size": size,
+                                                             "error": error, "finished_at": datetime.utcnow()})
+                db.session.commit()
+            run_with_lock_retry(finish)
+            metrics.inc('smarttrash_reports_total', status=status)
+            metrics.observe('smarttrash_report_build_duration_seconds', time.perf_counter() - started, format=fmt)
+
+    def build(self, job_id, cache_key, fmt, start, end):
+        """Writes the report file (atomically) and returns its name."""
+        tables = build_report_frames(start, end, app.config['ROLLUP_THRESHOLD'])
+        db.session.rollback() # End the read transaction before the (slow) rendering
+        os.makedirs(app.config['REPORT_DIR'], exist_ok=True)
+        file_name = f"report-{job_id}-{cache_key[:12]}.{fmt}"
+        path = os.path.join(app.config['REPORT_DIR'], file_name)
+        temp_path = os.path.join(app.config['REPORT_DIR'], f"tmp-{os.getpid()}-{file_name}") # Writers need the extension
+        try:
+            REPORT_WRITERS[fmt](temp_path, tables, start, end)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return file_name
+
+report_worker = ReportWorker(app.config['REPORT_WORKERS'])
+metrics.counter('smarttrash_reports_total', 'Reports by outcome (done, failed, cached).')
+metrics.histogram('smarttrash_report_build_duration_seconds', 'Time to build one report file.')
+
+# --- Routes ---
+
+# Middleware for authentication
+def login_required(f):
+    @wraps(f) # Use wraps from functools
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            flash('Veuillez vous connecter pour accéder à cette page.', 'warning')
+            return redirect(url_for('login', next=request.url))
+        return f(*args, **kwargs)
+    return decorated_function
 
-    # Keep the login template as it is (long HTML string)
-    login_template = """
+# Keep the login template as it is (long HTML string)
+LOGIN_TEMPLATE = """
     <!DOCTYPE html>
     <html lang="fr">
     <head>
@@ -316,7 +3845,41 @@ def login():
     </body>
     </html>
     """
-    return render_template_string(login_template, error=error)
+
+_login_template = None
+
+def get_login_template():
+    """Compiles LOGIN_TEMPLATE on first use instead of on every request."""
+    global _login_template
+    if _login_template is None:
+        _login_template = app.jinja_env.from_string(LOGIN_TEMPLATE)
+    return _login_template
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    """Handles the login page."""
+    if 'user_id' in session:
+        return redirect(url_for('index')) # Redirect if already logged in
+
+    error = None
+    if request.method == 'POST':
+        username = request.form.get('username')
+        password = request.form.get('password')
+        # Use case-insensitive query for username
+        user = User.query.filter(User.username.ilike(username)).first()
+
+        if user and user.check_password(password):
+            session.permanent = True
+            session['user_id'] = user.id
+            session['username'] = user.username
+            flash('Connexion réussie !', 'success')
+            next_page = request.args.get('next')
+            return redirect(next_page or url_for('index'))
+        else:
+            error = "Identifiants incorrects. Veuillez réessayer."
+
+    # Compiled once, see get_login_template()
+    return render_template(get_login_template(), error=error)
 
 
 @app.route('/logout')
@@ -327,99 +3890,672 @@ def logout():
     flash('Vous avez été déconnecté.', 'info')
     return redirect(url_for('login'))
 
+def process_level_update(new_level, bin_number_param, now):
+    """Validates and applies (or queues) one /update reading; returns (payload, status).
+
+    Shared by the Flask view and the ASGI entry point (asgi.py) so both keep
+    the same validation and emptying-detection semantics.
+    """
+    if new_level is None or not (0 <= new_level <= 100):
+        return {"error": "Le niveau doit être un entier entre 0 et 100"}, 400
+
+    if app.config['INGEST_MODE'] == 'queued':
+        # Write-behind mode: validate, enqueue and let the writer commit in groups
+        target_state = bin_cache.get_by_number(bin_number_param) if bin_number_param else get_default_bin_state()
+        if target_state is None:
+            error = f"Poubelle {bin_number_param} non trouvée" if bin_number_param else "Aucune poubelle par défaut trouvée (ID=1)"
+            return {"error": error}, 404
+        if not ingest_queue.submit(bin_number_param or None, new_level, now):
+            return {"error": "File d'ingestion pleine, réessayez plus tard"}, 503
+        return {
+            "success": True,
+            "queued": True,
+            "level": new_level,
+            "bin_number": target_state.bin_number,
+            "last_emptied_detected": None # Not known until the writer flushes
+        }, 202
+
+    try:
+        outcomes, _ = ingest_readings([(bin_number_param or None, new_level, now)])
+    except Exception:
+        return {"error": "Erreur lors de la mise à jour de la base de données"}, 500
+
+    outcome = outcomes[0]
+    if outcome["status"] == "error":
+        return {"error": outcome["error"]}, 404
+    payload = {
+        "success": True,
+        "level": new_level,
+        "bin_number": outcome["bin_number"],
+        "last_emptied_detected": outcome["last_emptied_detected"] # Indicate if emptying was detected in this update
+    }
+    if outcome["status"] == "filtered":
+        payload["filtered"] = True # Dropped by the bin's reading filters
+    elif "applied_level" in outcome:
+        payload["applied_level"] = outcome["applied_level"] # Smoothed or held by the filters
+    return payload, 200
+
 @app.route('/update', methods=['GET'])
 def update_level():
     """Updates the fill level of a specific or default bin and checks for emptying event."""
     new_level = request.args.get('level', type=int)
     bin_number_param = request.args.get('bin_number')
     now = datetime.utcnow() # Get current time once
+    payload, status = process_level_update(new_level, bin_number_param, now)
+    return jsonify(payload), status
 
-    if new_level is None or not (0 <= new_level <= 100):
-        return jsonify({"error": "Le niveau doit être un entier entre 0 et 100"}), 400
-
-    target_bin = None
-    if bin_number_param:
-        target_bin = Bin.query.filter_by(bin_number=bin_number_param).first()
-        if not target_bin:
-            return jsonify({"error": f"Poubelle {bin_number_param} non trouvée"}), 404
-    else:
-        target_bin = get_default_bin()
-        if not target_bin:
-            return jsonify({"error": "Aucune poubelle par défaut trouvée (ID=1)"}), 404
 
-    # Get the level *before* updating
-    old_level = target_bin.current_level
+@app.route('/update/batch', methods=['POST'])
+def update_level_batch():
+    """Applies many readings (several bins and/or time points) in one transaction.
 
-    # Update bin level and last updated time
-    target_bin.current_level = new_level
-    target_bin.last_updated = now
+    Body: a JSON list of {"bin_number", "level", "timestamp"} objects, or an
+    object with a "readings" key holding that list. `bin_number` defaults to
+    the default bin and `timestamp` (ISO 8601 or UNIX epoch) to now.
+    """
+    payload = request.get_json(silent=True)
+    readings = payload.get('readings') if isinstance(payload, dict) else payload
+    if not isinstance(readings, list) or not readings:
+        return jsonify({"error": "Le corps doit contenir une liste de mesures non vide"}), 400
+    if len(readings) > app.config['BATCH_MAX_READINGS']:
+        return jsonify({"error": f"Trop de mesures (maximum {app.config['BATCH_MAX_READINGS']})"}), 413
 
-    # Check for emptying condition: old level >= 80 and new level <= 20
-    if old_level >= 80 and new_level <= 20:
-        target_bin.last_emptied_timestamp = now
-        app.logger.info(f"Bin {target_bin.bin_number} emptied detected at {now}. Old level: {old_level}, New level: {new_level}")
+    now = datetime.utcnow()
+    results = [None] * len(readings)
+    valid = [] # (index, bin_number or None, level, timestamp)
 
-    # Add to history only if level is critical (>= 80%)
-    # Note: This adds an entry even if the level *stays* above 80%
-    if new_level >= 80:
-        history_entry = History(bin_id=target_bin.id, level=new_level, timestamp=now)
-        db.session.add(history_entry)
+    for index, item in enumerate(readings):
+        if not isinstance(item, dict):
+            results[index] = {"index": index, "status": "error", "error": "Mesure invalide"}
+            continue
+        bin_number = item.get('bin_number')
+        level = item.get('level')
+        result = {"index": index, "bin_number": bin_number, "level": level}
+        results[index] = result
+        if isinstance(level, bool) or not isinstance(level, int) or not (0 <= level <= 100):
+            result.update(status="error", error="Le niveau doit être un entier entre 0 et 100")
+            continue
+        try:
+            timestamp = parse_reading_timestamp(item.get('timestamp'), now)
+        except (ValueError, TypeError, OverflowError, OSError):
+            result.update(status="error", error="Horodatage invalide")
+            continue
+        if is_future_reading(timestamp, now):
+            result.update(status="error", error="Horodatage dans le futur")
+            continue
+        valid.append((index, str(bin_number) if bin_number is not None else None, level, timestamp))
 
     try:
-        db.session.commit()
-        return jsonify({
-            "success": True,
-            "level": new_level,
-            "bin_number": target_bin.bin_number,
-            "last_emptied_detected": (old_level >= 80 and new_level <= 20) # Indicate if emptying was detected in this update
-        })
-    except Exception as e:
-        db.session.rollback()
-        app.logger.error(f"Error updating bin level: {e}")
+        outcomes, history_written = ingest_readings([(bin_number, level, timestamp) for _, bin_number, level, timestamp in valid])
+    except Exception:
         return jsonify({"error": "Erreur lors de la mise à jour de la base de données"}), 500
 
+    for (index, _, _, _), outcome in zip(valid, outcomes):
+        results[index].update(outcome)
 
-@app.route('/level', methods=['GET'])
-def get_level():
-    """Returns the current information for the default bin (ID=1), including last emptied time."""
-    target_bin = get_default_bin()
+    accepted = sum(1 for r in results if r["status"] != "error")
+    return jsonify({
+        "success": True,
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+        "emptied": sum(1 for r in results if r.get("last_emptied_detected")),
+        "history_written": history_written,
+        "results": results
+    })
+
+
+@app.route('/update/queue', methods=['GET'])
+def ingest_queue_stats():
+    """Returns the write-behind queue depth and flush latency."""
+    return jsonify(dict(ingest_queue.stats(), mode=app.config['INGEST_MODE']))
+
+
+def level_view(authenticated):
+    """Builds /level for the default bin: (status, etag, last_modified, build_payload).
+
+    Shared by the Flask view and asgi.py. The ETag comes from the cached bin
+    state and the History high-water id, so revalidations cost one index
+    lookup; the History list query only runs when build_payload() is called.
+    """
+    target_bin = get_default_bin_state()
     if not target_bin:
-        return jsonify({
+        return 404, None, None, lambda: {
             "level": 0,
             "numero": "N/A",
             "adresse": "N/A",
             "historique": [],
-            "authenticated": 'user_id' in session,
+            "authenticated": authenticated,
             "last_updated": None,
             "last_emptied": None, # <-- NOUVELLE CLE
             "error": "Poubelle par défaut (ID=1) non trouvée"
-        }), 404
+        }
+
+    # Every write to the bin goes through the cache, so its state identifies
+    # the response, except for late readings from /update/batch: they leave
+    # the state alone but go to History, and may enter the "historique" list.
+    # max(History.id) is a single lookup at the end of the rowid B-tree.
+    history_high_water = db.session.query(func.max(History.id)).scalar()
+    etag = compute_etag('level', target_bin.id, target_bin.bin_number, target_bin.location, target_bin.current_level,
+                        target_bin.last_updated, target_bin.last_emptied_timestamp, history_high_water, authenticated)
+
+    def build_payload():
+        # Recent critical History points: from the ring buffer when it holds
+        # ten of them or all of the bin's points, else from History
+        critical_history = None
+        buffered = recent_history(target_bin.id)
+        if buffered is not None:
+            timestamps, levels, complete = buffered
+            critical = np.flatnonzero(levels >= 80)[:10]
+            if complete or len(critical) == 10:
+                critical_history = epoch_points(timestamps[critical], levels[critical])
+        if critical_history is None:
+            critical_history = History.query.with_entities(History.timestamp, History.level)\
+                                            .filter(History.bin_id == target_bin.id, History.level >= 80)\
+                                            .order_by(History.timestamp.desc())\
+                                            .limit(10).all()
+
+        history_data = [{
+            "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+            "niveau": level
+            # "numero": target_bin.bin_number # Removed, redundant as it's for the target_bin
+        } for timestamp, level in critical_history]
+
+        # Format timestamps for JSON response
+        last_updated_iso = target_bin.last_updated.isoformat() if target_bin.last_updated else None
+        last_emptied_iso = target_bin.last_emptied_timestamp.isoformat() if target_bin.last_emptied_timestamp else None
+
+        return {
+            "level": target_bin.current_level,
+            "numero": target_bin.bin_number,
+            "adresse": target_bin.location,
+            "historique": history_data,
+            "authenticated": authenticated,
+            "last_updated": last_updated_iso,
+            "last_emptied": last_emptied_iso # <-- NOUVELLE CLE
+        }
+
+    return 200, etag, target_bin.last_updated, build_payload
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Exposes the process metrics in Prometheus text format."""
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/level', methods=['GET'])
+def get_level():
+    """Returns the current information for the default bin (ID=1), including last emptied time."""
+    status, etag, last_modified, build_payload = level_view('user_id' in session)
+    if status != 200:
+        return jsonify(build_payload()), status
+    return conditional_json(build_payload, etag, last_modified)
+
+@app.route('/bins', methods=['GET'])
+def list_bins():
+    """Fleet snapshot: current state of every bin, filterable by level band and staleness.
+
+    Query parameters: min_level / max_level (inclusive band on the current
+    level) and stale_hours (only bins without an update for that many hours).
+    """
+    min_level = request.args.get('min_level', type=int)
+    max_level = request.args.get('max_level', type=int)
+    stale_hours = request.args.get('stale_hours', type=float)
+    now = datetime.utcnow()
+    stale_after = timedelta(hours=app.config['BIN_STALE_HOURS'])
+
+    # One aggregate query decides between 304 and a full snapshot: every
+    # write bumps a revision, inserts move the count and max id. Time only
+    # matters when a bin crosses a staleness boundary: the oldest update
+    # still on the fresh side of each cutoff changes exactly then.
+    stale_cutoffs = [now - stale_after] + ([now - timedelta(hours=stale_hours)] if stale_hours is not None else [])
+    revisions, bin_count, max_id, last_modified, *next_stale = db.session.query(
+        func.sum(Bin.revision), func.count(Bin.id), func.max(Bin.id), func.max(Bin.last_updated),
+        *(func.min(db.case((Bin.last_updated >= cutoff, Bin.last_updated))) for cutoff in stale_cutoffs)).one()
+    etag = compute_etag('bins', revisions, bin_count, max_id, min_level, max_level, stale_hours, next_stale)
+
+    def build_payload():
+        query = db.session.query(Bin.id, Bin.bin_number, Bin.location, Bin.current_level,
+                                 Bin.last_updated, Bin.last_emptied_timestamp)
+        if min_level is not None:
+            query = query.filter(Bin.current_level >= min_level)
+        if max_level is not None:
+            query = query.filter(Bin.current_level <= max_level)
+        if stale_hours is not None:
+            cutoff = now - timedelta(hours=stale_hours)
+            query = query.filter(db.or_(Bin.last_updated == None, Bin.last_updated < cutoff)) # noqa: E711
+        bins = [{
+            "id": row.id,
+            "numero": row.bin_number,
+            "adresse": row.location,
+            "level": row.current_level,
+            "last_updated": row.last_updated.isoformat() if row.last_updated else None,
+            "last_emptied": row.last_emptied_timestamp.isoformat() if row.last_emptied_timestamp else None,
+            "stale": row.last_updated is None or now - row.last_updated > stale_after
+        } for row in query.order_by(Bin.bin_number).all()]
+        return {"count": len(bins), "generated_at": now.isoformat(), "bins": bins}
+
+    # Last-Modified is the newest reading; If-None-Match, checked first, also
+    # catches backdated readings and bins turning stale
+    return conditional_json(build_payload, etag, last_modified)
+
+@app.route('/stats', methods=['GET'])
+def get_fleet_stats():
+    """Fleet summary (fill bands, zones, stale bins, emptyings per day) from the incremental aggregates."""
+    stale_hours = request.args.get('stale_hours', app.config['BIN_STALE_HOURS'], type=float)
+    days = min(max(request.args.get('days', 14, type=int), 1), 366)
+    now = datetime.utcnow()
+    fleet_stats.ensure_loaded()
+    # The hour is enough for staleness, which is counted per hour bucket
+    etag = compute_etag('stats', fleet_stats.version, stale_hours, days, hour_key(now), now.date())
+    return conditional_json(lambda: fleet_stats.snapshot(now, stale_hours, days), etag)
+
+@app.route('/forecast', methods=['GET'])
+def get_forecast():
+    """Estimated time-to-full for every bin, from its learned fill rate.
+
+    Optional query parameters: bin_number (one bin) and max_hours (only bins
+    expected to be full within that many hours). Bins without enough data
+    have null estimates.
+    """
+    started = time.perf_counter()
+    forecaster.ensure_loaded()
+    now = datetime.utcnow()
+    bin_ids, numbers, levels, rates, hours_to_full = forecaster.forecast(now)
+
+    selected = np.ones(len(bin_ids), dtype=bool)
+    bin_number = request.args.get('bin_number')
+    if bin_number:
+        selected &= np.array([n == bin_number for n in numbers], dtype=bool)
+    max_hours = request.args.get('max_hours', type=float)
+    if max_hours is not None:
+        selected &= hours_to_full <= max_hours # NaN compares False
+
+    order = np.argsort(np.where(np.isnan(hours_to_full), np.inf, hours_to_full)[selected], kind='stable')
+    indices = np.flatnonzero(selected)[order]
+    forecasts = []
+    for i in indices.tolist():
+        hours = hours_to_full[i]
+        known = not np.isnan(hours)
+        forecasts.append({
+            "id": int(bin_ids[i]),
+            "numero": numbers[i],
+            "level": int(levels[i]),
+            "fill_rate_per_hour": None if np.isnan(rates[i]) else round(float(rates[i]), 3),
+            "hours_to_full": round(float(hours), 2) if known else None,
+            "estimated_full_at": (now + timedelta(hours=float(hours))).isoformat() if known else None
+        })
+    return jsonify({
+        "generated_at": now.isoformat(),
+        "computation_ms": round((time.perf_counter() - started) * 1000, 2),
+        "count": len(forecasts),
+        "bins": forecasts
+    })
+
+@app.route('/bins/nearby', methods=['GET'])
+def nearby_bins():
+    """Bins within radius_km of (lat, lon), optionally only those at or above min_level."""
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    radius_km = request.args.get('radius_km', default=1.0, type=float)
+    min_level = request.args.get('min_level', default=0, type=int)
+    if lat is None or lon is None or radius_km <= 0:
+        return jsonify({"error": "Paramètres lat, lon et radius_km requis"}), 400
+
+    distances = spatial_index.within(lat, lon, radius_km)
+    bins = []
+    if distances:
+        rows = db.session.query(Bin.id, Bin.bin_number, Bin.current_level, Bin.latitude, Bin.longitude)\
+                         .filter(Bin.id.in_(distances), Bin.current_level >= min_level).all()
+        bins = sorted(({
+            "id": row.id,
+            "numero": row.bin_number,
+            "level": row.current_level,
+            "latitude": row.latitude,
+            "longitude": row.longitude,
+            "distance_km": round(distances[row.id], 3)
+        } for row in rows), key=lambda b: b["distance_km"])
+    return jsonify({"count": len(bins), "bins": bins})
+
+@app.route('/route', methods=['GET'])
+def plan_collection_route():
+    """Orders the pickup of bins above a fill threshold into a tour from a depot.
+
+    Query parameters: depot_lat, depot_lon (required), min_level (default 80)
+    and radius_km (only bins that close to the depot).
+    """
+    started = time.perf_counter()
+    depot_lat = request.args.get('depot_lat', type=float)
+    depot_lon = request.args.get('depot_lon', type=float)
+    min_level = request.args.get('min_level', default=app.config['ROLLUP_THRESHOLD'], type=int)
+    radius_km = request.args.get('radius_km', type=float)
+    if depot_lat is None or depot_lon is None:
+        return jsonify({"error": "Paramètres depot_lat et depot_lon requis"}), 400
+
+    query = db.session.query(Bin.id, Bin.bin_number, Bin.current_level, Bin.latitude, Bin.longitude)\
+                      .filter(Bin.current_level >= min_level, Bin.latitude != None, Bin.longitude != None) # noqa: E711
+    if radius_km is not None:
+        in_radius = spatial_index.within(depot_lat, depot_lon, radius_km)
+        stops = [row for row in query.all() if row.id in in_radius]
+    else:
+        stops = query.all()
+
+    points = [project_km(depot_lat, depot_lon, depot_lat)] + [project_km(row.latitude, row.longitude, depot_lat) for row in stops]
+    tour, nn_length, length, moves = plan_route(points, app.config['ROUTE_NEIGHBOURS'],
+                                                app.config['ROUTE_TIME_BUDGET_MS'] / 1000.0)
+
+    ordered = []
+    for order, index in enumerate(tour[1:], start=1):
+        row = stops[index - 1]
+        previous = points[tour[order - 1]]
+        ordered.append({
+            "order": order,
+            "id": row.id,
+            "numero": row.bin_number,
+            "level": row.current_level,
+            "latitude": row.latitude,
+            "longitude": row.longitude,
+            "leg_km": round(math.hypot(points[index][0] - previous[0], points[index][1] - previous[1]), 3)
+        })
+    return jsonify({
+        "depot": {"latitude": depot_lat, "longitude": depot_lon},
+        "min_level": min_level,
+        "stop_count": len(ordered),
+        "stops": ordered,
+        "total_km": round(length, 3), # Including the return to the depot
+        "nearest_neighbour_km": round(nn_length, 3),
+        "two_opt_moves": moves,
+        "computation_ms": round((time.perf_counter() - started) * 1000, 2)
+    })
+
+@app.route('/stream', methods=['GET'])
+def stream_events():
+    """SSE stream of level changes and emptyings for every bin."""
+    return sse_response()
+
+@app.route('/bins/<bin_number>/stream', methods=['GET'])
+def stream_bin_events(bin_number):
+    """SSE stream of level changes and emptyings for one bin."""
+    target_bin = bin_cache.get_by_number(bin_number)
+    if not target_bin:
+        return jsonify({"error": f"Poubelle {bin_number} non trouvée"}), 404
+    return sse_response(target_bin.id)
+
+@app.route('/bins/<bin_number>/rollups', methods=['GET'])
+def get_bin_rollups(bin_number):
+    """Returns hourly or daily aggregates of a bin for historical charts."""
+    granularity = request.args.get('granularity', 'hour')
+    if granularity not in ROLLUP_GRANULARITIES:
+        return jsonify({"error": "granularity doit valoir 'hour' ou 'day'"}), 400
+    target_bin = bin_cache.get_by_number(bin_number)
+    if not target_bin:
+        return jsonify({"error": f"Poubelle {bin_number} non trouvée"}), 404
+    model, _, length = ROLLUP_GRANULARITIES[granularity]
+
+    now = datetime.utcnow()
+    try:
+        end = parse_reading_timestamp(request.args.get('end'), now)
+        start = parse_reading_timestamp(request.args.get('start'), end - (timedelta(days=2) if granularity == 'hour' else timedelta(days=60)))
+    except (ValueError, TypeError, OverflowError, OSError):
+        return jsonify({"error": "Horodatage invalide"}), 400
 
-    # Fetch recent critical history entries
-    critical_history = History.query.filter_by(bin_id=target_bin.id)\
-                                    .order_by(History.timestamp.desc())\
-                                    .limit(10).all()
+    buckets = model.query.filter(model.bin_id == target_bin.id,
+                                 model.bucket_start >= ROLLUP_GRANULARITIES[granularity][1](start),
+                                 model.bucket_start < end)\
+                         .order_by(model.bucket_start).all()
+    return jsonify({
+        "bin_number": target_bin.bin_number,
+        "granularity": granularity,
+        "bucket_seconds": int(length.total_seconds()),
+        "threshold": app.config['ROLLUP_THRESHOLD'],
+        "buckets": [b.to_dict() for b in buckets]
+    })
+
+def encode_history_cursor(timestamp, row_id):
+    return base64.urlsafe_b64encode(json.dumps([timestamp.isoformat(), row_id]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_history_cursor(cursor):
+    """(timestamp, id) of the last row of the previous page; ValueError if malformed."""
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (TypeError, ValueError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError("curseur invalide") from e
+
+@app.route('/bins/<bin_number>/history', methods=['GET'])
+def get_bin_history(bin_number):
+    """Pages through a bin's History rows with a keyset cursor on (timestamp, id).
+
+    Query parameters: start / end (time range), order ('desc', the default,
+    or 'asc'), limit (up to 1000) and cursor (next_cursor of the previous
+    page). Each page is one range scan of ix_history_bin_timestamp, so it
+    costs the same for yesterday as for two years ago.
+    """
+    target_bin = bin_cache.get_by_number(bin_number)
+    if not target_bin:
+        return jsonify({"error": f"Poubelle {bin_number} non trouvée"}), 404
+    order = request.args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        return jsonify({"error": "order doit valoir 'asc' ou 'desc'"}), 400
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    try:
+        start = parse_reading_timestamp(request.args.get('start'), None)
+        end = parse_reading_timestamp(request.args.get('end'), None)
+        cursor = decode_history_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except (ValueError, TypeError, OverflowError, OSError):
+        return jsonify({"error": "Horodatage ou curseur invalide"}), 400
+
+    key = db.tuple_(History.timestamp, History.id)
+    query = db.select(History.id, History.timestamp, History.level).where(History.bin_id == target_bin.id)
+    if start is not None:
+        query = query.where(History.timestamp >= start)
+    if end is not None:
+        query = query.where(History.timestamp < end)
+    if cursor is not None:
+        query = query.where(key < cursor if order == 'desc' else key > cursor)
+    if order == 'desc':
+        query = query.order_by(History.timestamp.desc(), History.id.desc())
+    else:
+        query = query.order_by(History.timestamp, History.id)
+    rows = db.session.execute(query.limit(limit + 1)).all() # One extra row tells whether there is a next page
 
-    history_data = [{
-        "timestamp": h.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-        "niveau": h.level
-        # "numero": target_bin.bin_number # Removed, redundant as it's for the target_bin
-    } for h in critical_history]
+    page = rows[:limit]
+    return jsonify({
+        "bin_number": target_bin.bin_number,
+        "order": order,
+        "readings": [{"id": row.id, "timestamp": row.timestamp.isoformat(), "level": row.level} for row in page],
+        "next_cursor": encode_history_cursor(page[-1].timestamp, page[-1].id) if len(rows) > limit else None
+    })
+
+@app.route('/bins/<bin_number>/recent', methods=['GET'])
+def get_recent_readings(bin_number):
+    """Latest History points of a bin (newest first) for sparklines, from the ring buffer when enabled."""
+    target_bin = bin_cache.get_by_number(bin_number)
+    if not target_bin:
+        return jsonify({"error": f"Poubelle {bin_number} non trouvée"}), 404
+    limit = min(max(request.args.get('limit', 32, type=int), 1), max(app.config['RECENT_BUFFER_READINGS'], 100))
+    buffered = recent_history(target_bin.id)
+    if buffered is not None and (buffered[2] or len(buffered[0]) >= limit):
+        readings = epoch_points(buffered[0][:limit], buffered[1][:limit])
+        source = 'buffer'
+    else:
+        # Tier disabled or full, or older points than it holds: read History
+        readings = History.query.with_entities(History.timestamp, History.level)\
+                                .filter(History.bin_id == target_bin.id)\
+                                .order_by(History.timestamp.desc()).limit(limit).all()
+        source = 'history'
+    return jsonify({
+        "bin_number": target_bin.bin_number,
+        "source": source,
+        "readings": [{"timestamp": timestamp.isoformat(), "level": level} for timestamp, level in readings]
+    })
 
-    # Format timestamps for JSON response
-    last_updated_iso = target_bin.last_updated.isoformat() if target_bin.last_updated else None
-    last_emptied_iso = target_bin.last_emptied_timestamp.isoformat() if target_bin.last_emptied_timestamp else None
+@app.route('/bins/<bin_number>/curve', methods=['GET'])
+def get_bin_curve(bin_number):
+    """Returns a bin's fill curve resampled every step_minutes, rebuilt from compressed History."""
+    target_bin = bin_cache.get_by_number(bin_number)
+    if not target_bin:
+        return jsonify({"error": f"Poubelle {bin_number} non trouvée"}), 404
+    now = datetime.utcnow()
+    try:
+        end = parse_reading_timestamp(request.args.get('end'), now)
+        start = parse_reading_timestamp(request.args.get('start'), end - timedelta(days=1))
+        step = timedelta(minutes=float(request.args.get('step_minutes', 15)))
+    except (ValueError, TypeError, OverflowError, OSError):
+        return jsonify({"error": "Paramètre invalide"}), 400
+    if step <= timedelta(0) or end < start or (end - start) / step > 10000:
+        return jsonify({"error": "Intervalle invalide (10000 points maximum)"}), 400
 
+    times = [start + i * step for i in range(int((end - start) / step) + 1)]
+    levels = reconstruct_level_curve(target_bin, times)
     return jsonify({
-        "level": target_bin.current_level,
-        "numero": target_bin.bin_number,
-        "adresse": target_bin.location,
-        "historique": history_data,
-        "authenticated": 'user_id' in session,
-        "last_updated": last_updated_iso,
-        "last_emptied": last_emptied_iso # <-- NOUVELLE CLE
+        "bin_number": target_bin.bin_number,
+        "compression": history_compressor.mode,
+        "max_error": history_compressor.deviation if history_compressor.mode != 'off' else 0,
+        "points": [{"timestamp": t.isoformat(), "level": None if np.isnan(level) else round(float(level), 2)}
+                   for t, level in zip(times, levels)]
     })
 
+@app.route('/export/history', methods=['GET'])
+@login_required
+def export_history():
+    """Streams History rows as CSV, Parquet or Arrow, optionally filtered by bins and time range.
+
+    Rows come in id order, or bin by bin in timestamp order when filtered by bin_number.
+    """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "format doit valoir 'csv', 'parquet' ou 'arrow'"}), 400
+    if fmt != 'csv' and pyarrow is None:
+        return jsonify({"error": "Export Parquet/Arrow indisponible : pyarrow n'est pas installé"}), 501
+    try:
+        start = parse_reading_timestamp(request.args.get('start'), None)
+        end = parse_reading_timestamp(request.args.get('end'), None)
+    except (ValueError, TypeError, OverflowError, OSError):
+        return jsonify({"error": "Horodatage invalide"}), 400
+
+    bin_ids = None
+    bin_numbers = [n for value in request.args.getlist('bin_number') for n in value.split(',') if n]
+    if bin_numbers:
+        found = bin_cache.get_many_by_number(bin_numbers)
+        missing = [n for n in bin_numbers if n not in found]
+        if missing:
+            return jsonify({"error": f"Poubelle {missing[0]} non trouvée"}), 404
+        bin_ids = [state.id for state in found.values()]
+
+    chunks = iter_history_chunks(bin_ids, start, end, app.config['EXPORT_CHUNK_SIZE'])
+    body = export_csv(chunks) if fmt == 'csv' else export_arrow(chunks, fmt)
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    filename = f"history-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.{extension}"
+    return app.response_class(stream_with_context(body), mimetype=mimetype,
+                              headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.route('/bins/import', methods=['POST'])
+@login_required
+def import_bins_endpoint():
+    """Creates or updates bins in bulk from a CSV or JSONL request body.
+
+    Columns / keys: bin_number, location, and optional latitude / longitude.
+    The format comes from ?format= (csv or jsonl) or the Content-Type. The
+    body is parsed as it is read; any invalid row cancels the whole import.
+    """
+    fmt = request.args.get('format') or IMPORT_FORMATS.get(request.mimetype, 'csv')
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({"error": "format doit valoir 'csv' ou 'jsonl'"}), 400
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+    try:
+        summary = import_bins(iter_import_records(stream, fmt), app.config['IMPORT_CHUNK_SIZE'])
+    except UnicodeDecodeError:
+        return jsonify({"error": "Le fichier doit être encodé en UTF-8"}), 400
+    except Exception as e:
+        app.logger.error(f"Bin import failed: {e}", exc_info=True)
+        return jsonify({"error": "Erreur lors de l'import des poubelles"}), 500
+    if summary["invalid"]:
+        return jsonify({"error": f"{summary['invalid']} ligne(s) invalide(s), aucune poubelle importée", **summary}), 400
+    return jsonify({"success": True, **summary})
+
+@app.route('/alerts', methods=['GET'])
+@login_required
+def list_alerts():
+    """Recent alert jobs, optionally filtered by status, with counts per status."""
+    status = request.args.get('status')
+    query = AlertJob.query
+    if status:
+        query = query.filter_by(status=status)
+    jobs = query.order_by(AlertJob.id.desc()).limit(min(request.args.get('limit', 100, type=int), 1000)).all()
+    counts = dict(db.session.query(AlertJob.status, func.count(AlertJob.id)).group_by(AlertJob.status).all())
+    return jsonify({"counts": counts, "alerts": [job.to_dict() for job in jobs]})
+
+@app.route('/reports', methods=['POST'])
+@login_required
+def request_report():
+    """Queues a fill and emptying report, or returns the stored one for unchanged data.
+
+    Parameters (JSON body or form): format ('pdf', the default, or 'xlsx'),
+    start / end (default: the last 7 full days), in whole hours, up to the
+    last ended hour. Answers 202 with the job
+    while it is being built, 200 when an up-to-date file already exists.
+    """
+    params = request.get_json(silent=True) or request.form
+    fmt = params.get('format', 'pdf')
+    if fmt not in REPORT_FORMATS:
+        return jsonify({"error": "format doit valoir 'pdf' ou 'xlsx'"}), 400
+    if not REPORT_FORMATS[fmt][1]():
+        return jsonify({"error": f"Rapports {fmt.upper()} indisponibles : pandas, reportlab ou openpyxl n'est pas installé"}), 501
+    now = datetime.utcnow()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    try:
+        end = parse_reading_timestamp(params.get('end'), today)
+        start = parse_reading_timestamp(params.get('start'), end - timedelta(days=7))
+    except (ValueError, TypeError, OverflowError, OSError):
+        return jsonify({"error": "Horodatage invalide"}), 400
+    # Rollups are hourly, and the current hour is still filling: the period
+    # is cut to whole hours, up to the last one ended
+    start, end = floor_to_hour(start), min(floor_to_hour(end), floor_to_hour(now))
+    if not start < end or end - start > timedelta(days=app.config['REPORT_MAX_DAYS']):
+        return jsonify({"error": f"La période doit être non vide et d'au plus {app.config['REPORT_MAX_DAYS']} jours"}), 400
+
+    cache_key = report_cache_key(fmt, start, end, report_watermark(start, end))
+    job = find_cached_report(cache_key, now)
+    if job is not None:
+        metrics.inc('smarttrash_reports_total', status='cached')
+        return jsonify({"cached": True, **job.to_dict()}), 200 if job.status == 'done' else 202
+
+    job = ReportJob(cache_key=cache_key, format=fmt, period_start=start, period_end=end, created_at=now)
+    def queue_job():
+        db.session.add(job)
+        db.session.commit()
+    try:
+        run_with_lock_retry(queue_job)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Could not queue report: {e}")
+        return jsonify({"error": "Erreur lors de la création du rapport"}), 500
+    report_worker.submit(job.id)
+    return jsonify({"cached": False, **job.to_dict()}), 202, {'Location': url_for('get_report', report_id=job.id)}
+
+@app.route('/reports/<int:report_id>', methods=['GET'])
+@login_required
+def get_report(report_id):
+    """Status of a report job, with its download link once done."""
+    job = db.session.get(ReportJob, report_id)
+    if job is None:
+        return jsonify({"error": f"Rapport {report_id} non trouvé"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/reports/<int:report_id>/download', methods=['GET'])
+@login_required
+def download_report(report_id):
+    job = db.session.get(ReportJob, report_id)
+    if job is None:
+        return jsonify({"error": f"Rapport {report_id} non trouvé"}), 404
+    if job.status != 'done':
+        return jsonify({"error": "Le rapport n'est pas encore prêt", **job.to_dict()}), 409
+    path = os.path.join(app.config['REPORT_DIR'], job.file_name)
+    if not os.path.exists(path):
+        return jsonify({"error": "Fichier du rapport introuvable, relancez la demande"}), 410
+    download_name = f"rapport-{job.period_start:%Y%m%d}-{job.period_end:%Y%m%d}.{job.format}"
+    return send_file(path, mimetype=REPORT_FORMATS[job.format][0], as_attachment=True,
+                     download_name=download_name, etag=job.cache_key)
+
 @app.route('/config', methods=['POST'])
 @login_required
 def update_config():
@@ -434,8 +4570,7 @@ def update_config():
     if not data:
         flash('Aucune donnée de configuration fournie.', 'warning')
         return redirect(url_for('index'))
-
-    updated = False
+    changes = {} # Applied in one unit of work, retried if another worker holds the write lock
     error_occurred = False
 
     if "numero" in data:
@@ -450,8 +4585,7 @@ def update_config():
                 flash(f"Le numéro de poubelle '{new_bin_number}' est déjà utilisé.", 'danger')
                 error_occurred = True
             else:
-                target_bin.bin_number = new_bin_number
-                updated = True
+                changes["bin_number"] = new_bin_number
 
     if "adresse" in data:
         new_location = data["adresse"].strip()
@@ -459,18 +4593,52 @@ def update_config():
             flash("L'adresse ne peut pas être vide.", 'danger')
             error_occurred = True
         else:
-            target_bin.location = new_location
-            updated = True
+            changes["location"] = new_location
+
+    for field, label, limit in (("latitude", "La latitude", 90), ("longitude", "La longitude", 180)):
+        if field in data:
+            raw_value = data[field].strip()
+            if not raw_value:
+                new_value = None # Clearing the coordinates is allowed
+            else:
+                try:
+                    new_value = float(raw_value)
+                except ValueError:
+                    new_value = float('nan')
+                if not (-limit <= new_value <= limit):
+                    flash(f"{label} doit être un nombre entre {-limit} et {limit}.", 'danger')
+                    error_occurred = True
+                    continue
+            changes[field] = new_value
+
+    def save_config():
+        # A retry starts over from the committed row (the rollback expired ours)
+        target_bin = db.session.get(Bin, 1, populate_existing=True)
+        previous_state = BinState.from_bin(target_bin)
+        for field, value in changes.items():
+            setattr(target_bin, field, value)
+        target_bin.revision = Bin.revision + 1
+        target_bin.config_revision = Bin.config_revision + 1
+        stats_delta = FleetStatsDelta() # A new address may move the bin to another zone
+        stats_delta.move(previous_state, BinState.from_bin(target_bin))
+        stats_delta.flush()
+        db.session.commit()
+        return target_bin, stats_delta
 
-    if updated and not error_occurred:
+    if changes and not error_occurred:
         try:
-            db.session.commit()
+            target_bin, stats_delta = run_with_lock_retry(save_config)
+            fleet_stats.apply(stats_delta)
+            # The bin may have been renumbered or relocated
+            bin_cache.invalidate(target_bin.id)
+            if "latitude" in changes or "longitude" in changes:
+                spatial_index.update(target_bin.id, target_bin.latitude, target_bin.longitude)
             flash('Configuration de la poubelle mise à jour avec succès.', 'success')
         except Exception as e:
             db.session.rollback()
             app.logger.error(f"Error updating bin config: {e}")
             flash('Erreur lors de la mise à jour de la configuration.', 'danger')
-    elif not updated and not error_occurred:
+    elif not changes and not error_occurred:
         flash('Aucune modification détectée dans la configuration.', 'info')
 
     # Always redirect back to the main page after processing
@@ -483,74 +4651,195 @@ def index():
     """Serves the main dashboard page using the specific HTML file."""
     # Define the expected HTML file name within the static folder
     html_file_name = 'index(1).html'
-    # Construct the full path relative to the application's static folder
-    # Use app.static_folder which is configured during Flask app initialization
-    html_file_path = os.path.join(app.static_folder, html_file_name)
-
-    # Check if the file exists in the static folder
-    if not os.path.exists(html_file_path):
-        # If not found in static, maybe try the upload directory as a fallback?
-        # Or log an error and return a proper 404
-        fallback_path = os.path.join(basedir, 'upload', html_file_name) # Example fallback
-        if os.path.exists(fallback_path):
-             html_file_path = fallback_path
-             app.logger.warning(f"HTML file found in fallback location: {fallback_path}")
-        else:
-            app.logger.error(f"HTML file not found in static folder ({app.static_folder}) or fallback.")
-            # Return a user-friendly error page or message
-            return f"Erreur: Fichier d'interface {html_file_name} introuvable.", 404
+    # Candidate locations: the application's static folder, then the upload
+    # directory as a fallback
+    candidates = (os.path.join(app.static_folder, html_file_name),
+                  os.path.join(basedir, 'upload', html_file_name))
+
+    try:
+        page = dashboard_pages.get(candidates)
+    except FileNotFoundError:
+        app.logger.error(f"HTML file not found in static folder ({app.static_folder}) or fallback.")
+        # Return a user-friendly error page or message
+        return f"Erreur: Fichier d'interface {html_file_name} introuvable.", 404
+    except Exception as e:
+        app.logger.error(f"Error reading or compiling index file {html_file_name}: {e}")
+        return "Erreur interne lors du chargement de la page principale.", 500
 
     try:
-        with open(html_file_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
         # Pass necessary data to the template if needed (like username)
-        return render_template_string(html_content, username=session.get('username'))
+        return page.response(username=session.get('username'))
     except Exception as e:
-        app.logger.error(f"Error reading or rendering index file {html_file_path}: {e}")
+        app.logger.error(f"Error rendering index file {page.path}: {e}")
         return "Erreur interne lors du chargement de la page principale.", 500
 
+# --- Schema Migrations ---
+#
+# create_all() creates missing tables but never alters existing ones, so
+# column and index changes go through MIGRATIONS, applied in order and
+# recorded in schema_version. Databases created before schema_version
+# existed start at version 0, which is why every migration checks what is
+# already there instead of assuming. Append new migrations; never edit or
+# renumber applied ones.
+
+def add_column_if_missing(table, column, ddl_type):
+    existing_columns = {c['name'] for c in db.inspect(db.session.connection()).get_columns(table)}
+    if column not in existing_columns:
+        db.session.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+        print(f"Column {table}.{column} added.")
+
+def seed_default_data():
+    """Creates the admin user and the default bin (ID=1) when they are missing."""
+    # Check and create admin user
+    if User.query.filter_by(username='admin').first() is None:
+        admin_user = User(username='admin')
+        default_password = 'adminpassword' # CHANGE THIS IN PRODUCTION
+        admin_user.set_password(default_password)
+        db.session.add(admin_user)
+        print(f"Admin user 'admin' created with default password: {default_password}")
+    else:
+        print("Admin user 'admin' already exists.")
+
+    # Check and create default bin (ID=1). Column queries only: this runs as
+    # migration 3, before later migrations add columns to the Bin model.
+    if db.session.query(Bin.id).filter_by(id=1).first() is None:
+        default_bin_number = "P-001"
+        # Ensure the default bin number isn't already taken by another ID
+        existing_bin_by_number = db.session.query(Bin.id).filter_by(bin_number=default_bin_number).first()
+        if not existing_bin_by_number:
+            default_bin = Bin(
+                id=1,
+                bin_number=default_bin_number,
+                location="123 Rue de l'Exemple, 75000 Paris",
+                current_level=10,
+                last_emptied_timestamp=None # Initialize new field
+            )
+            db.session.add(default_bin)
+            print(f"Default bin '{default_bin_number}' (ID=1) created.")
+        else:
+            # This case should ideally not happen if ID=1 is reserved, but good to handle
+            print(f"Bin with number '{default_bin_number}' already exists (ID={existing_bin_by_number.id}). Cannot create default bin with ID 1 using this number.")
+    else:
+        print("Default bin (ID=1) already exists.")
+
+def backfill_rollups_from_history():
+    """Fills history_hourly (and, through its trigger, history_daily) from History.
+
+    For databases that stored History before the rollups existed. One
+    INSERT ... SELECT ... GROUP BY, following RollupAccumulator: each row
+    counts as a reading, a row at <= 20 right after one at >= 80 is an
+    emptying, and the time from a row at or above ROLLUP_THRESHOLD to the
+    next one is spread over the hours it covers. Hours that already have a
+    rollup row (written by ingestion) are left alone, so it can run again.
+    """
+    db.session.execute(db.text("""
+        WITH RECURSIVE readings AS (
+            SELECT bin_id, timestamp, level, substr(timestamp, 1, 13) || ':00:00.000000' AS bucket_start,
+                   lag(timestamp) OVER by_bin AS previous_timestamp, lag(level) OVER by_bin AS previous_level
+            FROM history
+            WINDOW by_bin AS (PARTITION BY bin_id ORDER BY timestamp, id)
+        ),
+        above (bin_id, piece_start, stop) AS (
+            SELECT bin_id, previous_timestamp, timestamp FROM readings
+            WHERE previous_level >= :threshold AND previous_timestamp < timestamp
+            UNION ALL
+            SELECT bin_id, strftime('%Y-%m-%d %H:00:00.000000', piece_start, '+1 hour'), stop FROM above
+            WHERE strftime('%Y-%m-%d %H:00:00.000000', piece_start, '+1 hour') < stop
+        ),
+        deltas AS (
+            SELECT bin_id, bucket_start, min(level) AS min_level, max(level) AS max_level, sum(level) AS level_sum,
+                   count(*) AS reading_count, 0.0 AS seconds_above_threshold,
+                   sum(CASE WHEN previous_level >= 80 AND level <= 20 THEN 1 ELSE 0 END) AS emptied_count
+            FROM readings GROUP BY bin_id, bucket_start
+            UNION ALL
+            SELECT bin_id, substr(piece_start, 1, 13) || ':00:00.000000', NULL, NULL, 0, 0,
+                   round((julianday(min(stop, strftime('%Y-%m-%d %H:00:00.000000', piece_start, '+1 hour')))
+                          - julianday(piece_start)) * 86400, 3), 0
+            FROM above
+        )
+        INSERT INTO history_hourly (bin_id, bucket_start, min_level, max_level, level_sum, reading_count,
+                                    seconds_above_threshold, emptied_count)
+        SELECT bin_id, bucket_start, min(min_level), max(max_level), sum(level_sum), sum(reading_count),
+               sum(seconds_above_threshold), sum(emptied_count)
+        FROM deltas
+        WHERE NOT EXISTS (SELECT 1 FROM history_hourly AS existing
+                          WHERE existing.bin_id = deltas.bin_id AND existing.bucket_start = deltas.bucket_start)
+        GROUP BY bin_id, bucket_start
+    """), {"threshold": app.config['ROLLUP_THRESHOLD']})
+
+MIGRATIONS = [
+    (1, 'bin.last_emptied_timestamp', lambda: add_column_if_missing('bin', 'last_emptied_timestamp', 'DATETIME')),
+    (2, 'bin.latitude and bin.longitude', lambda: (add_column_if_missing('bin', 'latitude', 'FLOAT'),
+                                                   add_column_if_missing('bin', 'longitude', 'FLOAT'))),
+    (3, 'default admin user and bin', seed_default_data),
+    (4, 'alert_job table', lambda: AlertJob.__table__.create(db.session.connection(), checkfirst=True)),
+    (5, 'fleet_stat table', lambda: (FleetStat.__table__.create(db.session.connection(), checkfirst=True),
+                                     rebuild_fleet_stats())),
+    (6, 'history (bin_id, timestamp, id, level) index',
+     lambda: next(i for i in History.__table__.indexes if i.name == 'ix_history_bin_timestamp').create(db.session.connection(), checkfirst=True)),
+    (7, 'report_job table', lambda: ReportJob.__table__.create(db.session.connection(), checkfirst=True)),
+    (8, 'bin.revision', lambda: add_column_if_missing('bin', 'revision', "INTEGER NOT NULL DEFAULT 0")),
+    (9, 'bin.config_revision', lambda: add_column_if_missing('bin', 'config_revision', "INTEGER NOT NULL DEFAULT 0")),
+    (10, 'history_hourly triggers maintaining history_daily',
+     lambda: [db.session.execute(db.text(rollup_daily_trigger(event))) for event in ('INSERT', 'UPDATE')]),
+    (11, 'history_hourly and history_daily backfilled from history', backfill_rollups_from_history),
+    # Migration 5 counted emptyings from history_daily before migration 11 filled it
+    (12, 'fleet_stat rebuilt from the backfilled rollups', rebuild_fleet_stats),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def current_schema_version():
+    """The database's schema version, 0 when schema_version doesn't exist yet."""
+    try:
+        return db.session.execute(db.select(func.max(SchemaVersion.version))).scalar() or 0
+    except OperationalError:
+        db.session.rollback()
+        return 0
+
+def ensure_schema():
+    """Brings the database to SCHEMA_VERSION; a warm start costs one query.
+
+    Returns (version_before, version_after). Safe to run from several
+    processes at once: migrations are idempotent and a version recorded
+    concurrently by another process is skipped.
+    """
+    started = time.perf_counter()
+    with app.app_context():
+        before = current_schema_version()
+        if before < SCHEMA_VERSION:
+            db.create_all() # New tables (including schema_version itself)
+            for version, name, migrate in MIGRATIONS:
+                if version <= current_schema_version():
+                    continue
+                try:
+                    migrate()
+                    db.session.add(SchemaVersion(version=version, name=name))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    if current_schema_version() >= version:
+                        continue # Applied by another process meanwhile
+                    raise
+                print(f"Schema migration {version} applied: {name}")
+        after = current_schema_version()
+        db.session.remove()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    kind = 'warm' if before == after else f'cold, migrated from {before}'
+    message = f"Database schema at version {after} ({kind}) in {elapsed_ms:.1f} ms"
+    print(message)
+    app.logger.info(message)
+    return before, after
+
 # --- Database Initialization Command ---
-@app.cli.command('init-db')
-def init_db_command():
-    """Creates database tables and initializes default data."""
-    global db
+def initialize_database():
+    """Creates database tables and initializes default data (callable outside the CLI)."""
     try:
         with app.app_context():
             print("Attempting to create database tables...")
+            ensure_schema()
             db.create_all() # This creates tables based on models if they don't exist
             print("Database tables checked/created.")
-
-            # Check and create admin user
-            if User.query.filter_by(username='admin').first() is None:
-                admin_user = User(username='admin')
-                default_password = 'adminpassword' # CHANGE THIS IN PRODUCTION
-                admin_user.set_password(default_password)
-                db.session.add(admin_user)
-                print(f"Admin user 'admin' created with default password: {default_password}")
-            else:
-                print("Admin user 'admin' already exists.")
-
-            # Check and create default bin (ID=1)
-            if db.session.get(Bin, 1) is None: # Use session.get for primary key check
-                default_bin_number = "P-001"
-                # Ensure the default bin number isn't already taken by another ID
-                existing_bin_by_number = Bin.query.filter_by(bin_number=default_bin_number).first()
-                if not existing_bin_by_number:
-                    default_bin = Bin(
-                        id=1,
-                        bin_number=default_bin_number,
-                        location="123 Rue de l'Exemple, 75000 Paris",
-                        current_level=10,
-                        last_emptied_timestamp=None # Initialize new field
-                    )
-                    db.session.add(default_bin)
-                    print(f"Default bin '{default_bin_number}' (ID=1) created.")
-                else:
-                    # This case should ideally not happen if ID=1 is reserved, but good to handle
-                    print(f"Bin with number '{default_bin_number}' already exists (ID={existing_bin_by_number.id}). Cannot create default bin with ID 1 using this number.")
-            else:
-                print("Default bin (ID=1) already exists.")
-
+            seed_default_data()
             db.session.commit()
             print("Database initialization/check complete.")
     except Exception as e:
@@ -558,6 +4847,142 @@ def init_db_command():
         print(f"Error during database initialization: {e}")
         app.logger.error(f"Database initialization failed: {e}", exc_info=True)
 
+@app.cli.command('init-db')
+def init_db_command():
+    """Creates database tables and initializes default data."""
+    initialize_database()
+
+@app.cli.command('sensor-listener')
+@click.option('--host', default=None, help='Address to bind (default: SENSOR_LISTENER_HOST).')
+@click.option('--port', type=int, default=None, help='UDP and TCP port (default: SENSOR_LISTENER_PORT).')
+def sensor_listener_command(host, port):
+    """Accepts binary sensor frames over UDP and TCP until interrupted.
+
+    The listener is a second writer next to the web process. Its readings
+    are always applied to the committed bin rows, but the web workers only
+    see them on /level and /stats once their cached copy expires: run them
+    with SMART_TRASH_BIN_CACHE_TTL_SECONDS set (wsgi.py sets 1 second).
+    """
+    if app.config['BIN_CACHE_TTL_SECONDS'] is None:
+        app.logger.warning("SMART_TRASH_BIN_CACHE_TTL_SECONDS is not set: web workers started with this "
+                           "environment will serve stale /level and /stats for bins fed by the listener")
+    host = host or app.config['SENSOR_LISTENER_HOST']
+    port = port or app.config['SENSOR_LISTENER_PORT']
+    servers = {'udp': SensorUDPServer((host, port), SensorUDPHandler),
+               'tcp': SensorTCPServer((host, port), SensorTCPHandler)}
+    for transport, server in servers.items():
+        threading.Thread(target=server.serve_forever, name=f'sensor-{transport}', daemon=True).start()
+    print(f"Sensor listener on {host}:{port} (UDP and TCP). Press Ctrl+C to stop.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers.values():
+            server.shutdown()
+            server.server_close()
+
+@app.cli.command('alert-dispatcher')
+@click.option('--once', is_flag=True, help='Deliver the due alerts and exit.')
+def alert_dispatcher_command(once):
+    """Delivers queued alerts (use with ALERT_DISPATCHER=off in the web workers)."""
+    if once:
+        sent, failed = alert_dispatcher.dispatch_once()
+        print(f"{sent} alert(s) sent, {failed} failed.")
+        return
+    print(f"Alert dispatcher running every {alert_dispatcher.batch_seconds:g}s. Press Ctrl+C to stop.")
+    try:
+        alert_dispatcher.run()
+    except KeyboardInterrupt:
+        pass
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recomputes the fleet aggregates served by /stats from the bins and daily rollups.
+
+    Running web workers keep their in-memory copy until they restart (or,
+    with a bin cache TTL, until it expires).
+    """
+    started = time.perf_counter()
+    try:
+        delta = rebuild_fleet_stats()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error during stats rebuild: {e}")
+        app.logger.error(f"Fleet stats rebuild failed: {e}", exc_info=True)
+        return
+    bins = sum(c[0] for (dimension, _), c in delta.changes.items() if dimension == 'band')
+    print(f"Fleet stats rebuilt for {bins} bins in {(time.perf_counter() - started) * 1000:.0f} ms.")
+
+@app.cli.command('import-bins')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='Input format (default: from the file extension, else csv).')
+def import_bins_command(path, fmt):
+    """Creates or updates bins from a CSV or JSONL file ('-' for stdin).
+
+    Each row holds bin_number, location and optional latitude / longitude.
+    Running web workers pick up the new bins once their caches expire or
+    they restart.
+    """
+    fmt = fmt or import_format_for(path)
+    try:
+        with (open(path, encoding='utf-8-sig', newline='') if path != '-' else
+              io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')) as stream:
+            summary = import_bins(iter_import_records(stream, fmt), app.config['IMPORT_CHUNK_SIZE'])
+    except Exception as e:
+        print(f"Error during bin import: {e}")
+        app.logger.error(f"Bin import failed: {e}", exc_info=True)
+        return
+    if summary["invalid"]:
+        for error in summary["errors"]:
+            print(f"Line {error['line']}: {error['error']}")
+        print(f"{summary['invalid']} invalid row(s) out of {summary['rows']}; nothing was imported.")
+        return
+    print(f"Imported {summary['rows']} rows ({summary['created']} created, {summary['updated']} updated, "
+          f"{summary['unchanged']} unchanged) in {summary['seconds']:.2f} s ({summary['rows_per_second']} rows/s).")
+
+@app.cli.command('compact-history')
+@click.option('--days', type=int, default=None, help='Keep raw History rows newer than this many days.')
+@click.option('--vacuum', is_flag=True, help='Run VACUUM afterwards to shrink the database file.')
+def compact_history_command(days, vacuum):
+    """Deletes raw History rows, old hourly rollups and empty fleet stat hours past the retention window."""
+    days = days if days is not None else app.config['HISTORY_RETENTION_DAYS']
+    now = datetime.utcnow()
+    history_cutoff = now - timedelta(days=days)
+    hourly_cutoff = now - timedelta(days=max(days, app.config['ROLLUP_HOURLY_RETENTION_DAYS']))
+    chunk_size = 10000
+    try:
+        deleted = 0
+        # Delete in chunks so the write lock is released between transactions
+        def delete_chunk():
+            ids = db.session.query(History.id).filter(History.timestamp < history_cutoff).limit(chunk_size).subquery()
+            result = db.session.execute(db.delete(History).where(History.id.in_(db.select(ids.c.id))))
+            db.session.commit()
+            return result
+
+        while True:
+            result = run_with_lock_retry(delete_chunk)
+            deleted += result.rowcount
+            if result.rowcount < chunk_size:
+                break
+        if deleted and recent_buffer is not None:
+            recent_buffer.clear() # Its points may include deleted rows
+        hourly_deleted = db.session.execute(db.delete(HistoryHourly).where(HistoryHourly.bucket_start < hourly_cutoff)).rowcount
+        # Last-update hours nobody is left in (ingestion leaves them at zero)
+        db.session.execute(db.delete(FleetStat).where(FleetStat.dimension == 'updated_hour', FleetStat.bin_count == 0))
+        db.session.commit()
+        print(f"Deleted {deleted} History rows older than {history_cutoff:%Y-%m-%d} and {hourly_deleted} hourly rollups older than {hourly_cutoff:%Y-%m-%d}.")
+        if vacuum:
+            with db.engine.connect() as conn:
+                conn.execution_options(isolation_level='AUTOCOMMIT').exec_driver_sql('VACUUM')
+            print("Database vacuumed.")
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error during history compaction: {e}")
+        app.logger.error(f"History compaction failed: {e}", exc_info=True)
+
 # --- Utility function to copy HTML (ensure it copies to the correct static folder) ---
 def ensure_static_files():
     static_dir = app.static_folder # Use the configured static folder path
@@ -613,35 +5038,23 @@ def ensure_static_files():
 
 # --- Main Execution ---
 if __name__ == '__main__':
+    startup_started = time.perf_counter()
     # Ensure static files are in place *before* initializing DB or running app
     ensure_static_files()
+    log_storage_settings()
 
-    # Initialize DB within app context
-    with app.app_context():
-        try:
-            # Check if DB file exists. If not, init-db will create it.
-            db_file_path = os.path.join(basedir, 'database.db')
-            if not os.path.exists(db_file_path):
-                 print("Database file not found. Running init-db...")
-                 init_db_command()
-            else:
-                # If DB file exists, check if tables are present
-                inspector = db.inspect(db.engine)
-                if not inspector.has_table("bin"): # Check for a key table like 'bin'
-                    print("Database tables seem missing. Running init-db...")
-                    init_db_command()
-                else:
-                    print("Database tables exist. Checking default data...")
-                    # Run init-db anyway to ensure default data consistency and add new column if needed
-                    init_db_command()
-
-        except Exception as e:
-            app.logger.error(f"Error during DB check/initialization in main: {e}. Attempting init-db as fallback.")
-            try:
-                 init_db_command()
-            except Exception as init_e:
-                 app.logger.error(f"Fallback init-db also failed: {init_e}")
-                 print("CRITICAL: Database initialization failed. The application might not work correctly.")
+    # Cold start (new or outdated database): create tables and run the
+    # pending migrations. Warm start: a single schema version check.
+    try:
+        ensure_schema()
+    except Exception as e:
+        app.logger.error(f"Error during database schema check/migration: {e}", exc_info=True)
+        print("CRITICAL: Database initialization failed. The application might not work correctly.")
+    if app.config['ALERT_RECIPIENTS'] and app.config['ALERT_DISPATCHER'] == 'thread':
+        alert_dispatcher.start() # Deliver alerts left pending by the previous run
+    message = f"Startup completed in {(time.perf_counter() - startup_started) * 1000:.1f} ms"
+    print(message)
+    app.logger.info(message)
 
     # Run the Flask development server
     # Use debug=False for production generally, True for development
@@ -0,0 +1,209 @@
+# ASGI entry point for Smart-Trash
+#
+# Serves the sensor endpoint (/update), the dashboard poll (/level) and the
+# Server-Sent Events streams (/stream, /bins/<bin_number>/stream) on an
+# asyncio event loop, so thousands of slow GSM clients and open dashboards
+# only cost an idle connection each instead of a blocked thread. Everything
+# else (login, dashboard, config, ...) is forwarded to the Flask app unchanged.
+#
+# Run with:
+#     uvicorn asgi:application --host 0.0.0.0 --port 5000
+# For several worker processes, see wsgi.py (same settings, plus --workers N).
+#
+# The models, validation and emptying detection are the ones of app.py
+# (process_level_update() / level_view()). SQLite has no asyncio driver in
+# our requirements, so database work is awaited in a bounded thread pool: a
+# thread is only held for the few milliseconds of the query, never while the
+# client is sending or reading.
+#
+# Thread pools: the Flask mount (WSGIMiddleware) holds a thread of anyio's
+# default limiter (40 threads) for the whole life of each request it serves,
+# a slow export or report download included. The native routes draw on their
+# own limiter (SMART_TRASH_ASGI_THREADS, default 40), so a busy Flask mount
+# never stalls /update and /level. The SSE streams hold no thread at all:
+# they wait on the event broker from the event loop.
+#
+# These two routes never reach Flask's request hooks, so they record the
+# same per-route metrics (requests, latency, SQL per request) themselves.
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import queue
+import time
+import warnings
+from datetime import datetime, timezone
+
+import anyio.to_thread
+from anyio import CapacityLimiter
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+
+with warnings.catch_warnings():
+    # Starlette recommends a2wsgi, which is not in our requirements
+    warnings.simplefilter('ignore', DeprecationWarning)
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+from app import (app as flask_app, bin_cache, ensure_schema, event_broker, format_sse, is_not_modified, level_view,
+                 log_storage_settings, parse_last_event_id, process_level_update, record_request_metrics,
+                 request_sql_usage, RequestSqlUsage, sse_preamble)
+
+# Startup settings, emptyings and dispatcher errors go to stderr (Flask's handler)
+flask_app.logger.setLevel(logging.INFO)
+
+# Threads for the database work of the native routes, apart from the Flask mount's
+database_threads = CapacityLimiter(int(os.environ.get('SMART_TRASH_ASGI_THREADS', 40)))
+
+
+def run_with_app_context(function, *args):
+    with flask_app.app_context():
+        return function(*args)
+
+
+async def run_in_database_thread(function, *args):
+    """Runs function(*args) in an app context on a thread of database_threads."""
+    return await anyio.to_thread.run_sync(run_with_app_context, function, *args, limiter=database_threads)
+
+
+def is_authenticated(request):
+    """Reads the Flask session cookie to tell whether the client is logged in."""
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return False
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        data = serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return False
+    return 'user_id' in data
+
+
+def with_request_metrics(route):
+    """Records the Flask per-route metrics for an ASGI route, under the same route label."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            started = time.perf_counter()
+            # The thread pool runs each call in a copy of this context, so the
+            # statements of every call are added to this usage object
+            usage = RequestSqlUsage()
+            token = request_sql_usage.set(usage)
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            finally:
+                request_sql_usage.reset(token)
+                record_request_metrics(route, request.method, status, time.perf_counter() - started, usage)
+        return wrapper
+    return decorator
+
+
+@with_request_metrics('/update')
+async def update_level(request):
+    """Async /update: same parameters and responses as the Flask view."""
+    try:
+        new_level = int(request.query_params['level'])
+    except (KeyError, ValueError):
+        new_level = None
+    bin_number_param = request.query_params.get('bin_number')
+    now = datetime.utcnow() # Get current time once
+    payload, status = await run_in_database_thread(process_level_update, new_level, bin_number_param, now)
+    return JSONResponse(payload, status_code=status)
+
+
+@with_request_metrics('/level')
+async def get_level(request):
+    """Async /level with the same ETag / 304 behaviour as the Flask view."""
+    authenticated = is_authenticated(request)
+    status, etag, last_modified, build_payload = await run_in_database_thread(level_view, authenticated)
+    if status != 200:
+        payload = await run_in_database_thread(build_payload)
+        return JSONResponse(payload, status_code=status)
+
+    headers = {'ETag': quote_etag(etag), 'Cache-Control': 'no-cache'}
+    if last_modified:
+        headers['Last-Modified'] = http_date(last_modified.replace(tzinfo=timezone.utc))
+    if_none_match = parse_etags(request.headers.get('if-none-match'))
+    if_modified_since = parse_date(request.headers.get('if-modified-since'))
+    if is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+        return Response(status_code=304, headers=headers)
+    payload = await run_in_database_thread(build_payload)
+    return JSONResponse(payload, headers=headers)
+
+
+async def sse_events(bin_id, last_event_id):
+    """Async twin of app.sse_response(): the same chunks, awaited on the event loop."""
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+
+    def wakeup():
+        # Called by the publishing thread (a database thread or Flask worker)
+        try:
+            loop.call_soon_threadsafe(ready.set)
+        except RuntimeError:
+            pass # Loop already closed: the stream is gone
+
+    subscriber, backlog, gap = event_broker.subscribe(bin_id, last_event_id, wakeup)
+    heartbeat = flask_app.config['SSE_HEARTBEAT_SECONDS']
+    try:
+        for chunk in sse_preamble(backlog, gap):
+            yield chunk
+        while not subscriber.dropped:
+            try:
+                pending = subscriber.events.get_nowait()
+            except queue.Empty:
+                ready.clear()
+                if not subscriber.events.empty() or subscriber.dropped:
+                    continue # Published between get_nowait() and clear()
+                try:
+                    await asyncio.wait_for(ready.wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                continue
+            yield format_sse(*pending)
+    finally:
+        event_broker.unsubscribe(subscriber)
+
+
+def sse_streaming_response(request, bin_id=None):
+    last_event_id = parse_last_event_id(request.headers.get('last-event-id') or request.query_params.get('lastEventId'))
+    return StreamingResponse(sse_events(bin_id, last_event_id), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@with_request_metrics('/stream')
+async def stream_events(request):
+    """Async /stream: every bin's level changes and emptyings, without holding a thread."""
+    return sse_streaming_response(request)
+
+
+@with_request_metrics('/bins/<bin_number>/stream')
+async def stream_bin_events(request):
+    """Async /bins/<bin_number>/stream, with the same 404 as the Flask view."""
+    bin_number = request.path_params['bin_number']
+    target_bin = await run_in_database_thread(bin_cache.get_by_number, bin_number)
+    if target_bin is None:
+        return JSONResponse({"error": f"Poubelle {bin_number} non trouvée"}, status_code=404)
+    return sse_streaming_response(request, target_bin.id)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    ensure_schema()
+    log_storage_settings()
+    yield
+
+
+application = Starlette(routes=[
+    Route('/update', update_level, methods=['GET']),
+    Route('/level', get_level, methods=['GET']),
+    Route('/stream', stream_events, methods=['GET']),
+    Route('/bins/{bin_number}/stream', stream_bin_events, methods=['GET']),
+    Mount('/', app=WSGIMiddleware(flask_app)),
+], lifespan=lifespan)
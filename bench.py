@@ -0,0 +1,257 @@
+# Fleet simulator and load benchmark for Smart-Trash
+#
+# Simulates N bins with realistic fill curves and emptyings, drives /update,
+# /level and / at fixed request rates against a temporary database, and
+# reports throughput and p50/p95/p99 latency per endpoint. Requests go
+# through the real `app` object (Flask test client, in-process), so the
+# numbers measure our code and SQLite, not the network.
+#
+# Usage:
+#     python bench.py --bins 500 --duration 20 --update-rate 300 --level-rate 100 --index-rate 5
+#     python bench.py --profile production --output bench-wal.json --compare bench-default.json
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+
+class SimulatedBin:
+    """A bin that fills at its own rate, with daily rhythm and noise, and gets emptied."""
+
+    def __init__(self, bin_number, rng):
+        self.bin_number = bin_number
+        self.rng = rng
+        self.level = rng.uniform(0, 60)
+        self.rate = rng.uniform(0.5, 6.0) # Level points per simulated hour
+        self.empty_at = rng.uniform(85, 100) # Collectors pass at a different level each time
+
+    def next_reading(self, hour_of_day, hours=1 / 60):
+        """Advances the bin by one sensor period (a minute by default) and returns its level."""
+        # Busier during the day, quiet at night
+        rhythm = 0.3 + 1.4 * max(0.0, np.sin((hour_of_day - 6) / 24 * 2 * np.pi))
+        self.level += self.rate * rhythm * hours * 60 # Compress an hour of filling into a minute of benchmark
+        if self.level >= self.empty_at:
+            self.level = self.rng.uniform(0, 10)
+            self.empty_at = self.rng.uniform(85, 100)
+        noisy = self.level + self.rng.gauss(0, 1.5)
+        return int(min(100, max(0, round(noisy))))
+
+
+class EndpointDriver:
+    """Issues requests to one endpoint at a fixed rate and records their latency."""
+
+    def __init__(self, name, rate, make_request, workers):
+        self.name = name
+        self.rate = rate
+        self.make_request = make_request
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'bench-{name}')
+        self.latencies = []
+        self.statuses = {}
+        self.lagging = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        started = time.perf_counter()
+        status = self.make_request()
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies.append(elapsed)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def run(self, duration):
+        """Open-loop schedule: request i is due at start + i / rate."""
+        if self.rate <= 0:
+            return
+        start = time.perf_counter()
+        i = 0
+        while True:
+            due = start + i / self.rate
+            if due - start >= duration:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.1:
+                self.lagging += 1 # The server can't keep up with the requested rate
+            self.pool.submit(self._call)
+            i += 1
+        self.pool.shutdown(wait=True)
+
+    def report(self, wall_time):
+        latencies = np.array(self.latencies) * 1000
+        errors = sum(count for status, count in self.statuses.items() if status >= 400 and status != 404)
+        if not len(latencies):
+            return {"requests": 0}
+        return {
+            "requests": int(len(latencies)),
+            "target_rate": self.rate,
+            "throughput_rps": round(len(latencies) / wall_time, 2),
+            "errors": errors,
+            "statuses": {str(k): v for k, v in sorted(self.statuses.items())},
+            "late_dispatches": self.lagging,
+            "latency_ms": {
+                "mean": round(float(latencies.mean()), 3),
+                "p50": round(float(np.percentile(latencies, 50)), 3),
+                "p95": round(float(np.percentile(latencies, 95)), 3),
+                "p99": round(float(np.percentile(latencies, 99)), 3),
+                "max": round(float(latencies.max()), 3),
+            },
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Smart-Trash fleet simulator and load benchmark")
+    parser.add_argument('--bins', type=int, default=200, help='Number of simulated bins')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of load per run')
+    parser.add_argument('--update-rate', type=float, default=200.0, help='/update requests per second')
+    parser.add_argument('--level-rate', type=float, default=50.0, help='/level requests per second')
+    parser.add_argument('--index-rate', type=float, default=2.0, help='/ (dashboard) requests per second')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent client threads per endpoint')
+    parser.add_argument('--profile', default='default', help='Storage profile (see SQLITE_PROFILES in app.py)')
+    parser.add_argument('--ingest-mode', default='sync', choices=('sync', 'queued'), help='/update ingestion mode')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Previous JSON results to compare against')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='smart-trash-bench-')
+    # Configure the app for a throwaway database *before* importing it
+    os.environ['SMART_TRASH_DATABASE_URI'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['SMART_TRASH_STORAGE_PROFILE'] = args.profile
+    os.environ['SMART_TRASH_INGEST_MODE'] = args.ingest_mode
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as smart_trash
+
+    flask_app, db, Bin = smart_trash.app, smart_trash.db, smart_trash.Bin
+    try:
+        smart_trash.initialize_database()
+
+        # The dashboard route serves index(1).html from the static folder
+        static_dir = os.path.join(workdir, 'static')
+        os.makedirs(static_dir)
+        source_html = os.path.join(smart_trash.basedir, 'index(1).html')
+        if os.path.exists(source_html):
+            shutil.copy(source_html, static_dir)
+        flask_app.static_folder = static_dir
+
+        rng = random.Random(args.seed)
+        bins = [SimulatedBin(f"SIM-{i:05d}", rng) for i in range(args.bins)]
+        with flask_app.app_context():
+            db.session.execute(db.insert(Bin), [{"bin_number": b.bin_number, "location": f"{i} Rue du Test, {75000 + i % 20} Paris",
+                                                 "current_level": int(b.level)} for i, b in enumerate(bins)])
+            db.session.commit()
+
+        local = threading.local()
+
+        def client(logged_in=False):
+            attr = 'logged_in_client' if logged_in else 'client'
+            test_client = getattr(local, attr, None)
+            if test_client is None:
+                test_client = flask_app.test_client()
+                if logged_in:
+                    with test_client.session_transaction() as session:
+                        session['user_id'] = 1
+                        session['username'] = 'admin'
+                setattr(local, attr, test_client)
+            return test_client
+
+        next_bin = iter(range(10 ** 12))
+        bin_lock = threading.Lock()
+
+        def update_request():
+            with bin_lock:
+                sim = bins[next(next_bin) % len(bins)]
+                level = sim.next_reading(datetime.utcnow().hour)
+            return client().get(f'/update?level={level}&bin_number={sim.bin_number}').status_code
+
+        def level_request():
+            return client().get('/level').status_code
+
+        def index_request():
+            return client(logged_in=True).get('/', headers={'Accept-Encoding': 'gzip, br'}).status_code
+
+        drivers = [
+            EndpointDriver('/update', args.update_rate, update_request, args.workers),
+            EndpointDriver('/level', args.level_rate, level_request, args.workers),
+            EndpointDriver('/', args.index_rate, index_request, max(1, args.workers // 4)),
+        ]
+        print(f"Benchmarking {args.bins} bins for {args.duration:.0f}s "
+              f"(profile={args.profile}, ingest={args.ingest_mode}) in {workdir}")
+        started = time.perf_counter()
+        threads = [threading.Thread(target=d.run, args=(args.duration,)) for d in drivers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_time = time.perf_counter() - started
+        if args.ingest_mode == 'queued':
+            smart_trash.ingest_queue.stop()
+
+        results = {
+            "timestamp": datetime.utcnow().isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "parameters": vars(args),
+            "wall_time_s": round(wall_time, 3),
+            "endpoints": {d.name: d.report(wall_time) for d in drivers},
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(json.load(f), results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+def print_report(results):
+    print(f"{'endpoint':<10} {'requests':>9} {'rps':>9} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, report in results["endpoints"].items():
+        if not report["requests"]:
+            continue
+        latency = report["latency_ms"]
+        print(f"{name:<10} {report['requests']:>9} {report['throughput_rps']:>9} {report['errors']:>7} "
+              f"{latency['p50']:>9} {latency['p95']:>9} {latency['p99']:>9}")
+
+
+def print_comparison(before, after):
+    print(f"\nCompared with {before.get('git_revision')} ({before.get('timestamp')}):")
+    for name, report in after["endpoints"].items():
+        previous = before.get("endpoints", {}).get(name)
+        if not report.get("requests") or not previous or not previous.get("requests"):
+            continue
+        changes = []
+        for key in ('p50', 'p95', 'p99'):
+            old, new = previous["latency_ms"][key], report["latency_ms"][key]
+            changes.append(f"{key} {old} -> {new} ms ({(new - old) / old * 100 if old else 0:+.1f}%)")
+        print(f"{name:<10} " + ", ".join(changes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Test client for the binary sensor listener (`flask sensor-listener`)
+#
+# Sends readings the way a GSM sensor would: one compact frame per send over
+# UDP or TCP, waits for the ack and retransmits on timeout. The wire format
+# is documented in sensor_protocol.py.
+#
+# Usage:
+#     python sensor_client.py --device 1 --level 42
+#     python sensor_client.py --device 1 --transport tcp --level 10 --level 20 --level 30
+#     python sensor_client.py --device 1 --count 100 --interval 0.1 --samples 5
+import argparse
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sensor_protocol import ACK_OK, ACK_DUPLICATE, FRAME_ACK, decode_ack, encode_frame
+
+ACK_NAMES = {0: 'ok', 1: 'duplicate', 2: 'unknown device', 3: 'invalid', 4: 'retry'}
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the listener")
+        data += chunk
+    return data
+
+
+def send_frame(args, sock, frame):
+    """Sends a frame until it is acknowledged; returns (status, attempts, seconds)."""
+    started = time.perf_counter()
+    for attempt in range(1, args.retries + 1):
+        try:
+            if args.transport == 'udp':
+                sock.sendto(frame, (args.host, args.port))
+                ack = sock.recvfrom(FRAME_ACK.size)[0]
+            else:
+                sock.sendall(frame)
+                ack = recv_exact(sock, FRAME_ACK.size)
+        except socket.timeout:
+            continue
+        return decode_ack(ack)[0], attempt, time.perf_counter() - started
+    return None, args.retries, time.perf_counter() - started
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Smart-Trash binary sensor test client")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--transport', default='udp', choices=('udp', 'tcp'))
+    parser.add_argument('--device', type=int, required=True, help='Bin id of the simulated sensor')
+    parser.add_argument('--sequence', type=int, default=None, help='First sequence number (default: random)')
+    parser.add_argument('--level', type=int, action='append', help='Level(s) to send in one frame (repeatable)')
+    parser.add_argument('--count', type=int, default=1, help='Number of frames to send')
+    parser.add_argument('--samples', type=int, default=1, help='Random samples per frame when --level is not given')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between frames')
+    parser.add_argument('--repeat', action='store_true', help='Send every frame twice to check deduplication')
+    parser.add_argument('--timeout', type=float, default=2.0, help='Seconds to wait for an ack')
+    parser.add_argument('--retries', type=int, default=3)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sequence = args.sequence if args.sequence is not None else random.randrange(2 ** 32)
+    if args.transport == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    else:
+        sock = socket.create_connection((args.host, args.port), timeout=args.timeout)
+    sock.settimeout(args.timeout)
+    failures = 0
+    with sock:
+        for i in range(args.count):
+            now = int(time.time())
+            if args.level:
+                samples = [(now, level) for level in args.level]
+            else:
+                # Oldest first, one simulated minute apart
+                samples = [(now - 60 * (args.samples - 1 - k), random.randint(0, 100)) for k in range(args.samples)]
+            frame = encode_frame(args.device, sequence, samples)
+            for _ in range(2 if args.repeat else 1):
+                status, attempts, elapsed = send_frame(args, sock, frame)
+                name = ACK_NAMES.get(status, 'no ack')
+                print(f"seq={sequence} samples={len(samples)} bytes={len(frame)} ack={name} "
+                      f"attempts={attempts} rtt={elapsed * 1000:.1f} ms")
+                if status not in (ACK_OK, ACK_DUPLICATE):
+                    failures += 1
+            sequence = (sequence + 1) % 2 ** 32
+            if i + 1 < args.count:
+                time.sleep(args.interval)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
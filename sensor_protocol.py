@@ -0,0 +1,83 @@
+# Binary sensor protocol for Smart-Trash
+#
+# Compact frame for GSM sensors, sent over UDP (one frame per datagram) or
+# TCP (frames back to back on one connection). All integers are big-endian:
+#
+#   magic 'ST' | version u8 | device_id u32 | sequence u32 | count u8
+#   count x (timestamp u32 UNIX epoch, 0 = "now" for clockless devices | level u8)
+#   crc32 u32 of everything before it
+#
+# One sample is 21 bytes instead of a ~150-byte HTTP request. device_id is
+# the Bin id. The server answers every frame with a 12-byte ack:
+#
+#   magic 'ST' | version u8 | status u8 | device_id u32 | sequence u32
+#
+# Frames that fail the CRC are dropped without an ack (the device id can't
+# be trusted), so the device simply retries them.
+#
+# Only the standard library: imported by the listener in app.py and by
+# sensor_client.py, which must not load the application (database engine,
+# secret key) just to build frames.
+import struct
+import zlib
+
+FRAME_MAGIC = b'ST'
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct('>2sBIIB')
+FRAME_SAMPLE = struct.Struct('>IB')
+FRAME_CRC = struct.Struct('>I')
+FRAME_ACK = struct.Struct('>2sBBII')
+FRAME_MAX_SAMPLES = 255
+
+ACK_OK = 0
+ACK_DUPLICATE = 1 # Already applied: the device can forget it too
+ACK_UNKNOWN_DEVICE = 2
+ACK_INVALID = 3 # Bad version, length, level or future timestamp: retrying won't help
+ACK_RETRY = 4 # Server-side error, or the same frame is being applied: send it again later
+
+
+def encode_frame(device_id, sequence, samples):
+    """Builds a frame from (timestamp, level) samples; timestamp 0 means "now"."""
+    if not 1 <= len(samples) <= FRAME_MAX_SAMPLES:
+        raise ValueError(f"Une trame contient entre 1 et {FRAME_MAX_SAMPLES} mesures")
+    body = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, device_id, sequence, len(samples))
+    body += b''.join(FRAME_SAMPLE.pack(int(timestamp), level) for timestamp, level in samples)
+    return body + FRAME_CRC.pack(zlib.crc32(body))
+
+
+def frame_length(header):
+    """Total length of the frame starting with this header."""
+    return FRAME_HEADER.size + FRAME_HEADER.unpack(header)[4] * FRAME_SAMPLE.size + FRAME_CRC.size
+
+
+def decode_frame(frame):
+    """Returns (device_id, sequence, samples), or None for a frame to drop without an ack.
+
+    Frames are dropped when too short, when the CRC fails or on a wrong
+    magic. samples is the list of (timestamp, level) pairs, or None when the
+    frame is intact but unusable (unknown version, no sample, wrong length).
+    """
+    if len(frame) < FRAME_HEADER.size + FRAME_CRC.size:
+        return None
+    body, (crc,) = frame[:-FRAME_CRC.size], FRAME_CRC.unpack(frame[-FRAME_CRC.size:])
+    if zlib.crc32(body) != crc:
+        return None
+    magic, version, device_id, sequence, count = FRAME_HEADER.unpack_from(body)
+    if magic != FRAME_MAGIC:
+        return None
+    if version != FRAME_VERSION or count == 0 or len(frame) != frame_length(body[:FRAME_HEADER.size]):
+        return device_id, sequence, None
+    samples = [FRAME_SAMPLE.unpack_from(body, FRAME_HEADER.size + i * FRAME_SAMPLE.size) for i in range(count)]
+    return device_id, sequence, samples
+
+
+def encode_ack(status, device_id, sequence):
+    return FRAME_ACK.pack(FRAME_MAGIC, FRAME_VERSION, status, device_id, sequence)
+
+
+def decode_ack(data):
+    """Returns (status, device_id, sequence) from an ack."""
+    magic, _, status, device_id, sequence = FRAME_ACK.unpack(data)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Accusé de réception invalide")
+    return status, device_id, sequence
@@ -0,0 +1,95 @@
+import email
+import http.server
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+
+import pytest
+
+# Configure the app for a throwaway database *before* importing it
+workdir = tempfile.mkdtemp(prefix='smart-trash-tests-')
+os.environ.setdefault('SMART_TRASH_DATABASE_URI', 'sqlite:///' + os.path.join(workdir, 'test.db'))
+os.environ.setdefault('SMART_TRASH_SECRET_KEY', 'test-secret-key')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as smart_trash # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def database():
+    smart_trash.initialize_database()
+    return smart_trash.db
+
+
+@pytest.fixture
+def app_context(database):
+    with smart_trash.app.app_context():
+        yield smart_trash.app
+        smart_trash.db.session.rollback()
+
+
+@pytest.fixture
+def client(app_context):
+    return smart_trash.app.test_client()
+
+
+class SmtpStandIn(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: every message is kept in server.messages."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 stand-in')
+        while True:
+            line = self.rfile.readline().decode('ascii').rstrip('\r\n')
+            command = line.split(' ', 1)[0].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                return
+            if command == 'DATA':
+                self.reply('354 go on')
+                data = []
+                while (data_line := self.rfile.readline()) not in (b'.\r\n', b''):
+                    data.append(data_line)
+                self.server.messages.append(email.message_from_bytes(b''.join(data)))
+            self.reply('250 ok')
+
+
+class WebhookStandIn(http.server.BaseHTTPRequestHandler):
+    """Records POSTed JSON bodies in server.requests and answers server.status."""
+
+    def do_POST(self):
+        self.server.requests.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def smtp_server():
+    server = serve(socketserver.ThreadingTCPServer(('127.0.0.1', 0), SmtpStandIn))
+    server.messages = []
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def webhook_server():
+    server = serve(http.server.ThreadingHTTPServer(('127.0.0.1', 0), WebhookStandIn))
+    server.requests, server.status = [], 200
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/hook"
+    yield server
+    server.shutdown()
+    server.server_close()
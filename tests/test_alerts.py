@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+import app as smart_trash
+from app import AlertDispatcher, AlertJob, Bin, db, ingest_readings
+
+
+@pytest.fixture
+def alerts(app_context, monkeypatch):
+    monkeypatch.setitem(smart_trash.app.config, 'ALERT_DISPATCHER', 'off')
+    monkeypatch.setitem(smart_trash.app.config, 'ALERT_KINDS', ['critical', 'emptied'])
+
+    def configure(*recipients):
+        monkeypatch.setitem(smart_trash.app.config, 'ALERT_RECIPIENTS', list(recipients))
+
+    yield configure
+    db.session.rollback()
+    db.session.execute(db.delete(AlertJob))
+    db.session.commit()
+
+
+def make_bin(bin_number, level=10):
+    bin_id = db.session.execute(db.insert(Bin).returning(Bin.id), [
+        {"bin_number": bin_number, "location": "1 Rue des Alertes, 75001 Paris", "current_level": level,
+         "last_updated": datetime.utcnow() - timedelta(hours=1)}]).scalar_one()
+    db.session.commit()
+    return bin_id
+
+
+def jobs_of(bin_id):
+    db.session.expire_all()
+    return AlertJob.query.filter_by(bin_id=bin_id).order_by(AlertJob.id).all()
+
+
+def readings(bin_number, *levels):
+    now = datetime.utcnow() # Always after the previous batch: none of these is a late reading
+    return [(bin_number, level, now + timedelta(microseconds=i)) for i, level in enumerate(levels)]
+
+
+def test_crossings_are_queued_coalesced_and_cancelled(alerts):
+    alerts('mailto:ops@example.org', 'http://127.0.0.1:9/hook')
+    bin_id = make_bin("ALERT-1")
+
+    ingest_readings(readings("ALERT-1", 90))
+    queued = jobs_of(bin_id)
+    assert [(job.kind, job.status, job.recipient) for job in queued] == [
+        ('critical', 'pending', 'mailto:ops@example.org'), ('critical', 'pending', 'http://127.0.0.1:9/hook')]
+
+    # Back under the threshold and over it again: folded into the pending jobs
+    ingest_readings(readings("ALERT-1", 50, 95))
+    assert [(job.occurrences, job.level) for job in jobs_of(bin_id)] == [(2, 95), (2, 95)]
+
+    ingest_readings(readings("ALERT-1", 5))
+    assert sorted((job.kind, job.status) for job in jobs_of(bin_id)) == [
+        ('critical', 'cancelled'), ('critical', 'cancelled'), ('emptied', 'pending'), ('emptied', 'pending')]
+
+
+def test_alerts_roll_back_with_the_readings(alerts, monkeypatch):
+    alerts('mailto:ops@example.org')
+    bin_id = make_bin("ALERT-2")
+
+    def fail(rows):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(smart_trash, 'save_history_rows', fail)
+    with pytest.raises(RuntimeError):
+        ingest_readings(readings("ALERT-2", 90))
+    assert jobs_of(bin_id) == []
+    assert db.session.get(Bin, bin_id).current_level == 10
+
+
+def test_alerts_share_the_readings_transaction(alerts):
+    alerts('mailto:ops@example.org')
+    bin_id = make_bin("ALERT-5")
+    commits = []
+
+    def count_commit(connection):
+        commits.append(connection)
+
+    event.listen(db.engine, 'commit', count_commit)
+    try:
+        ingest_readings(readings("ALERT-5", 92))
+    finally:
+        event.remove(db.engine, 'commit', count_commit)
+    assert len(commits) == 1 and len(jobs_of(bin_id)) == 1
+
+
+def test_dispatcher_sends_by_smtp_and_webhook(alerts, monkeypatch, smtp_server, webhook_server):
+    monkeypatch.setitem(smart_trash.app.config, 'ALERT_SMTP_HOST', '127.0.0.1')
+    monkeypatch.setitem(smart_trash.app.config, 'ALERT_SMTP_PORT', smtp_server.server_address[1])
+    alerts('mailto:ops@example.org', webhook_server.url)
+    bin_id = make_bin("ALERT-3")
+    ingest_readings(readings("ALERT-3", 85))
+
+    dispatcher = AlertDispatcher(batch_seconds=1, max_attempts=3, retry_base_seconds=30)
+    assert dispatcher.dispatch_once(datetime.utcnow() + timedelta(seconds=1)) == (2, 0)
+
+    message, = smtp_server.messages
+    assert message['To'] == 'ops@example.org'
+    assert "ALERT-3" in message.get_payload() and "85 %" in message.get_payload()
+    body, = webhook_server.requests
+    assert [(alert["bin_number"], alert["kind"], alert["level"]) for alert in body["alerts"]] == [("ALERT-3", "critical", 85)]
+    assert {job.status for job in jobs_of(bin_id)} == {'sent'}
+
+
+def test_failed_deliveries_back_off_then_give_up(alerts, webhook_server):
+    webhook_server.status = 500
+    alerts(webhook_server.url)
+    bin_id = make_bin("ALERT-4")
+    ingest_readings(readings("ALERT-4", 99))
+    dispatcher = AlertDispatcher(batch_seconds=1, max_attempts=3, retry_base_seconds=30)
+    now = datetime.utcnow() + timedelta(seconds=1)
+
+    assert dispatcher.dispatch_once(now) == (0, 1)
+    job, = jobs_of(bin_id)
+    assert (job.status, job.attempts, job.next_attempt_at) == ('pending', 1, now + timedelta(seconds=30))
+    assert dispatcher.dispatch_once(now + timedelta(seconds=29)) == (0, 0) # Not due yet
+
+    assert dispatcher.dispatch_once(now + timedelta(seconds=30)) == (0, 1)
+    job, = jobs_of(bin_id)
+    assert (job.status, job.attempts, job.next_attempt_at) == ('pending', 2, now + timedelta(seconds=90))
+
+    assert dispatcher.dispatch_once(now + timedelta(seconds=90)) == (0, 1)
+    job, = jobs_of(bin_id)
+    assert (job.status, job.attempts) == ('failed', 3)
+    assert len(webhook_server.requests) == 3
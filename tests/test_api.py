@@ -0,0 +1,196 @@
+import io
+from datetime import datetime, timedelta, timezone
+
+from werkzeug.http import http_date
+
+import app as smart_trash
+from app import Bin, db
+
+
+def test_bins_etag_changes_on_backdated_reading(client):
+    now = datetime.utcnow()
+    db.session.execute(db.insert(Bin), [
+        {"bin_number": "ETAG-NEW", "location": "1 Rue du Test, 75001 Paris", "current_level": 10, "last_updated": now},
+        {"bin_number": "ETAG-OLD", "location": "2 Rue du Test, 75001 Paris", "current_level": 0,
+         "last_updated": now - timedelta(days=1)},
+    ])
+    db.session.commit()
+    first = client.get('/bins')
+    etag = first.headers['ETag']
+    assert client.get('/bins', headers={'If-None-Match': etag}).status_code == 304
+
+    # Older than the newest bin's last_updated: max(last_updated) does not move
+    reading = {"bin_number": "ETAG-OLD", "level": 95, "timestamp": (now - timedelta(hours=1)).isoformat()}
+    assert client.post('/update/batch', json=[reading]).get_json()["results"][0]["status"] == "ok"
+
+    second = client.get('/bins', headers={'If-None-Match': etag})
+    assert second.status_code == 200
+    assert {b["numero"]: b["level"] for b in second.get_json()["bins"]}["ETAG-OLD"] == 95
+
+
+def test_bins_etag_only_follows_time_when_a_bin_turns_stale(client, monkeypatch):
+    class Clock(datetime):
+        current = datetime(2100, 1, 1) # Every other test bin is long stale by then
+
+        @classmethod
+        def utcnow(cls):
+            return cls.current
+
+    monkeypatch.setattr(smart_trash, 'datetime', Clock)
+    stale_after = timedelta(hours=smart_trash.app.config['BIN_STALE_HOURS'])
+    last_updated = Clock.current - stale_after + timedelta(minutes=3)
+    bin_id = db.session.execute(db.insert(Bin).returning(Bin.id), [
+        {"bin_number": "ETAG-STALE", "location": "3 Rue du Test, 75001 Paris", "current_level": 30,
+         "last_updated": last_updated}]).scalar_one()
+    db.session.commit()
+    try:
+        first = client.get('/bins')
+        etag = first.headers['ETag']
+        assert first.headers['Last-Modified'] == http_date(last_updated.replace(tzinfo=timezone.utc))
+
+        Clock.current += timedelta(minutes=2) # A minute boundary, but no bin crosses the cutoff
+        assert client.get('/bins', headers={'If-None-Match': etag}).status_code == 304
+
+        Clock.current += timedelta(minutes=2)
+        turned_stale = client.get('/bins', headers={'If-None-Match': etag})
+        assert turned_stale.status_code == 200
+        assert {b["numero"]: b["stale"] for b in turned_stale.get_json()["bins"]}["ETAG-STALE"] is True
+    finally:
+        db.session.execute(db.delete(Bin).where(Bin.id == bin_id))
+        db.session.commit()
+
+
+def test_level_etag_changes_on_late_reading(client):
+    now = datetime.utcnow()
+    assert client.post('/update/batch', json=[{"level": 10, "timestamp": now.isoformat()}]).status_code == 200
+    first = client.get('/level')
+    assert client.get('/level', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+    late = {"level": 95, "timestamp": (now - timedelta(hours=1)).isoformat()}
+    assert client.post('/update/batch', json=[late]).get_json()["results"][0]["status"] == "late"
+    second = client.get('/level', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    assert second.get_json()["level"] == 10
+    assert any(entry["niveau"] == 95 for entry in second.get_json()["historique"])
+
+
+def test_import_keeps_last_updated_of_existing_bins(app_context):
+    from app import fleet_stats, import_bins, iter_import_records, rebuild_fleet_stats
+
+    last_reading = datetime(2025, 1, 1, 8)
+    db.session.execute(db.insert(Bin), [{"bin_number": "IMPORT-1", "location": "1 Rue A, 75001 Paris",
+                                         "current_level": 40, "last_updated": last_reading}])
+    db.session.commit()
+    rebuild_fleet_stats()
+    db.session.commit()
+    fleet_stats.ensure_loaded()
+
+    csv_text = 'bin_number,location\nIMPORT-1,"2 Rue B, 75002 Paris"\nIMPORT-2,"3 Rue C, 75003 Paris"\n'
+    summary = import_bins(iter_import_records(io.StringIO(csv_text), 'csv'), 100)
+    assert (summary["created"], summary["updated"]) == (1, 1)
+
+    rows = dict(db.session.execute(db.select(Bin.bin_number, Bin.last_updated)
+                                   .where(Bin.bin_number.in_(['IMPORT-1', 'IMPORT-2']))).all())
+    assert rows['IMPORT-1'] == last_reading
+    assert rows['IMPORT-2'] is not None
+
+    # The incremental fleet stats still agree with a full rebuild
+    now = datetime.utcnow()
+    incremental = fleet_stats.snapshot(now, 24, 7)
+    rebuild_fleet_stats()
+    db.session.commit()
+    assert fleet_stats.snapshot(now, 24, 7) == incremental
+
+
+def test_batch_rejects_readings_from_the_future(client):
+    db.session.execute(db.insert(Bin), [{"bin_number": "FUTURE-1", "location": "1 Rue du Futur, 75001 Paris",
+                                         "current_level": 10, "last_updated": datetime.utcnow() - timedelta(hours=1)}])
+    db.session.commit()
+    ahead = datetime.utcnow() + timedelta(days=1)
+
+    response = client.post('/update/batch', json=[
+        {"bin_number": "FUTURE-1", "level": 90, "timestamp": ahead.isoformat() + 'Z'},
+        {"bin_number": "FUTURE-1", "level": 20},
+    ])
+    results = response.get_json()["results"]
+    assert results[0]["error"] == "Horodatage dans le futur"
+    assert results[1]["status"] != "error"
+    level, last_updated = db.session.execute(db.select(Bin.current_level, Bin.last_updated)
+                                             .where(Bin.bin_number == "FUTURE-1")).one()
+    assert level == 20 and last_updated < ahead
+
+
+
+def test_batch_applies_each_bin_in_timestamp_order(client):
+    start = datetime.utcnow().replace(microsecond=0) - timedelta(hours=2)
+    db.session.execute(db.insert(Bin), [
+        {"bin_number": "BATCH-1", "location": "1 Rue du Lot, 75001 Paris", "current_level": 50, "last_updated": start},
+        {"bin_number": "BATCH-2", "location": "2 Rue du Lot, 75001 Paris", "current_level": 0, "last_updated": start},
+    ])
+    db.session.commit()
+    at = lambda minutes: (start + timedelta(minutes=minutes)).isoformat()
+
+    # Sent out of order and interleaved: 85 -> 10 is an emptying only once sorted
+    response = client.post('/update/batch', json={"readings": [
+        {"bin_number": "BATCH-1", "level": 30, "timestamp": at(30)},
+        {"bin_number": "BATCH-2", "level": 60, "timestamp": at(20)},
+        {"bin_number": "BATCH-1", "level": 85, "timestamp": at(10)},
+        {"bin_number": "BATCH-1", "level": 10, "timestamp": at(20)},
+        {"bin_number": "BATCH-2", "level": 40, "timestamp": at(10)},
+    ]})
+    payload = response.get_json()
+    assert payload["accepted"] == 5 and payload["rejected"] == 0 and payload["emptied"] == 1
+    assert [r["last_emptied_detected"] for r in payload["results"]] == [False, False, False, True, False]
+
+    rows = {b.bin_number: b for b in Bin.query.filter(Bin.bin_number.in_(["BATCH-1", "BATCH-2"]))}
+    assert rows["BATCH-1"].current_level == 30 and rows["BATCH-1"].last_updated == start + timedelta(minutes=30)
+    assert rows["BATCH-1"].last_emptied_timestamp == start + timedelta(minutes=20)
+    assert rows["BATCH-2"].current_level == 60 and rows["BATCH-2"].last_emptied_timestamp is None
+
+
+def test_batch_reports_errors_per_reading(client):
+    db.session.execute(db.insert(Bin), [{"bin_number": "BATCH-3", "location": "3 Rue du Lot, 75001 Paris",
+                                         "current_level": 10, "last_updated": datetime.utcnow() - timedelta(hours=1)}])
+    db.session.commit()
+    default_level = db.session.get(Bin, 1).current_level
+
+    response = client.post('/update/batch', json=[
+        {"bin_number": "BATCH-3", "level": 70},
+        {"bin_number": "BATCH-3", "level": 150},
+        "pas une mesure",
+        {"bin_number": "BATCH-3", "level": 20, "timestamp": "hier"},
+        {"bin_number": "BATCH-NONE", "level": 20},
+        {"bin_number": 0, "level": 20},
+        {"bin_number": "", "level": 20},
+    ])
+    payload = response.get_json()
+    assert response.status_code == 200
+    assert [r["status"] for r in payload["results"]] == ["ok"] + ["error"] * 6
+    assert [r["index"] for r in payload["results"]] == list(range(7))
+    assert payload["accepted"] == 1 and payload["rejected"] == 6
+    assert "BATCH-NONE" in payload["results"][4]["error"]
+    db.session.rollback()
+    assert Bin.query.filter_by(bin_number="BATCH-3").one().current_level == 70
+    assert db.session.get(Bin, 1).current_level == default_level # 0 and "" are not the default bin
+
+def test_report_watermark_follows_addresses_not_readings(client):
+    from app import import_bins, iter_import_records, report_watermark
+
+    start, end = datetime(2020, 1, 1), datetime(2020, 1, 8)
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    watermark = report_watermark(start, end)
+
+    client.post('/update/batch', json=[{"level": 55}])
+    db.session.rollback()
+    assert report_watermark(start, end) == watermark
+
+    client.post('/config', data={"adresse": "5 Rue du Rapport, 69001 Lyon"})
+    db.session.rollback()
+    relocated = report_watermark(start, end)
+    assert relocated != watermark
+
+    bin_number = db.session.get(Bin, 1).bin_number
+    import_bins(iter_import_records(io.StringIO(f'bin_number,location\n{bin_number},"6 Rue du Rapport, 13001 Marseille"\n'),
+                                    'csv'), 100)
+    assert report_watermark(start, end) != relocated
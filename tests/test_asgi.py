@@ -0,0 +1,133 @@
+import asyncio
+import json
+import threading
+from urllib.parse import urlencode
+
+import anyio.to_thread
+
+from asgi import application
+import app as smart_trash
+from app import get_default_bin, db
+
+
+def asgi_scope(path, query=None, headers=None):
+    return {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'root_path': '',
+        'query_string': urlencode(query or {}).encode(),
+        'headers': [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+    }
+
+
+def asgi_get(path, query=None, headers=None):
+    """Runs one GET through the ASGI application; returns (status, headers, body)."""
+    scope = asgi_scope(path, query, headers)
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    start = messages[0]
+    body = b''.join(m.get('body', b'') for m in messages[1:])
+    return start['status'], {k.decode(): v.decode() for k, v in start['headers']}, body
+
+
+def session_cookie(user_id):
+    serializer = smart_trash.app.session_interface.get_signing_serializer(smart_trash.app)
+    return f"{smart_trash.app.config['SESSION_COOKIE_NAME']}={serializer.dumps({'user_id': user_id})}"
+
+
+def test_asgi_update_applies_and_validates_like_flask(app_context):
+    default_bin = get_default_bin()
+    db.session.rollback()
+
+    status, _, body = asgi_get('/update', {'level': 42})
+    assert status == 200
+    payload = json.loads(body)
+    assert payload["success"] is True and payload["level"] == 42 and payload["bin_number"] == default_bin.bin_number
+    assert "last_emptied_detected" in payload
+    assert db.session.get(type(default_bin), default_bin.id).current_level == 42
+
+    assert asgi_get('/update', {'level': 150})[0] == 400
+    assert asgi_get('/update', {'level': 'plein'})[0] == 400
+    status, _, body = asgi_get('/update', {'level': 10, 'bin_number': 'ASGI-NONE'})
+    assert status == 404 and 'ASGI-NONE' in json.loads(body)["error"]
+
+
+def test_asgi_level_matches_flask_and_revalidates(client):
+    assert asgi_get('/update', {'level': 37})[0] == 200
+    flask_response = client.get('/level')
+
+    status, headers, body = asgi_get('/level')
+    assert status == 200
+    assert json.loads(body) == flask_response.get_json()
+    assert headers['etag'] == flask_response.headers['ETag']
+    assert headers['last-modified'] == flask_response.headers['Last-Modified']
+
+    assert asgi_get('/level', headers={'If-None-Match': headers['etag']})[0] == 304
+    assert asgi_get('/level', headers={'If-Modified-Since': headers['last-modified']})[0] == 304
+
+    # A logged-in session changes the payload, so it gets its own ETag
+    status, logged_in, body = asgi_get('/level', headers={'Cookie': session_cookie(1),
+                                                          'If-None-Match': headers['etag']})
+    assert status == 200 and json.loads(body)["authenticated"] is True
+    assert logged_in['etag'] != headers['etag']
+
+    # Forwarded to Flask unchanged
+    status, _, body = asgi_get('/bins')
+    assert status == 200 and "bins" in json.loads(body)
+
+
+def test_asgi_stream_waits_for_events_without_a_thread(app_context):
+    default_bin = get_default_bin()
+    db.session.rollback()
+    broker = smart_trash.event_broker
+    broker.publish("level", {"id": default_bin.id, "level": 11})
+    resume_from = broker._next_id - 1 # Replayed: published after this id
+
+    async def stream():
+        disconnected = asyncio.Event()
+        bodies = []
+        received = asyncio.Condition()
+
+        async def receive():
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            async with received:
+                bodies.append(message.get('body', b'').decode())
+                received.notify_all()
+
+        async def wait_for(text):
+            async with received:
+                await asyncio.wait_for(received.wait_for(lambda: text in ''.join(bodies)), 5)
+
+        scope = asgi_scope(f'/bins/{default_bin.bin_number}/stream', headers={'Last-Event-ID': str(resume_from - 1)})
+        task = asyncio.create_task(application(scope, receive, send))
+        await wait_for('"level":11')
+        # Open and idle: no thread of either pool is held by the stream
+        assert anyio.to_thread.current_default_thread_limiter().borrowed_tokens == 0
+        assert broker.subscriber_count >= 1
+
+        # Published from another thread, like a database thread or a Flask worker would
+        publisher = threading.Thread(target=broker.publish, args=("emptied", {"id": default_bin.id, "level": 5}))
+        publisher.start()
+        await wait_for('"level":5')
+        publisher.join()
+        disconnected.set()
+        await asyncio.wait_for(task, 5)
+        return ''.join(bodies)
+
+    subscribers = broker.subscriber_count
+    body = asyncio.run(stream())
+    assert body.startswith('retry: ') and 'event: emptied' in body
+    assert broker.subscriber_count == subscribers # Unsubscribed on disconnect
+
+    status, _, body = asgi_get('/bins/ASGI-NONE/stream')
+    assert status == 404 and 'ASGI-NONE' in json.loads(body)["error"]
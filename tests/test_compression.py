@@ -0,0 +1,80 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import app as smart_trash
+from app import Bin, CompressionState, History, HistoryCompressor, bin_cache, db, ingest_readings, \
+    reconstruct_level_curve
+
+
+def fill_cycles(seed, start, count):
+    """Noisy fill cycles, one reading every 5 minutes, emptied when nearly full."""
+    rng = random.Random(seed)
+    readings, level = [], 5.0
+    for i in range(count):
+        emptied = level > 92
+        level = rng.uniform(0, 6) if emptied else min(100.0, level + rng.uniform(-1.5, 3.5))
+        readings.append((start + timedelta(minutes=5 * i), round(level), emptied))
+    return readings
+
+
+def compress(compressor, readings):
+    """Stored points plus the last reading, which the bin row keeps as its current state."""
+    state, stored = CompressionState(), []
+    for timestamp, level, emptied in readings:
+        stored += compressor.add(state, timestamp, level, emptied)
+    if stored[-1][0] != readings[-1][0]:
+        stored.append(readings[-1][:2])
+    return stored
+
+
+def max_error(points, readings):
+    seconds = lambda ts: (ts - readings[0][0]).total_seconds()
+    curve = np.interp([seconds(t) for t, _, _ in readings], [seconds(t) for t, _ in points], [l for _, l in points])
+    return np.max(np.abs(curve - [level for _, level, _ in readings]))
+
+
+def test_swinging_door_stays_within_the_deviation():
+    readings = fill_cycles(1, datetime(2024, 6, 1), 2000)
+    assert sum(emptied for _, _, emptied in readings) >= 10
+    for deviation in (1.0, 2.0, 5.0):
+        points = compress(HistoryCompressor('swinging-door', deviation), readings)
+        assert max_error(points, readings) <= deviation + 1e-9
+        assert len(points) < len(readings) / 2
+    assert len(compress(HistoryCompressor('off', 2.0), readings)) == len(readings)
+
+
+def test_an_emptying_keeps_the_reading_before_the_drop_and_the_drop():
+    start = datetime(2024, 6, 1)
+    # A perfectly straight fill: only its endpoints are needed
+    readings = [(start + timedelta(minutes=10 * i), 10 + 8 * i, False) for i in range(11)]
+    readings.append((start + timedelta(minutes=110), 3, True))
+    readings.append((start + timedelta(minutes=120), 5, False))
+    points = compress(HistoryCompressor('swinging-door', 2.0), readings)
+    assert points == [(start, 10), (start + timedelta(minutes=100), 90), (start + timedelta(minutes=110), 3),
+                      (start + timedelta(minutes=120), 5)]
+    # Without the pre-drop point the curve would slope down from 10:00 to the emptying
+    assert max_error(points, readings) == 0
+
+
+def test_stored_history_reconstructs_the_ingested_readings(app_context):
+    start = datetime(2024, 6, 2)
+    db.session.execute(db.insert(Bin), [{"bin_number": "SDT-1", "location": "1 Rue de la Porte, 75001 Paris",
+                                         "current_level": 5, "last_updated": start - timedelta(minutes=5)}])
+    db.session.commit()
+    readings = fill_cycles(2, start, 600)
+    assert any(emptied for _, _, emptied in readings)
+    ingest_readings([("SDT-1", level, timestamp) for timestamp, level, _ in readings[:300]])
+    ingest_readings([("SDT-1", level, timestamp) for timestamp, level, _ in readings[300:]])
+
+    target_bin = bin_cache.get_by_number("SDT-1")
+    stored = db.session.query(History.timestamp, History.level).filter(History.bin_id == target_bin.id).all()
+    assert len(stored) < len(readings) / 2
+    curve = reconstruct_level_curve(target_bin, [timestamp for timestamp, _, _ in readings])
+    assert smart_trash.history_compressor.mode == 'swinging-door'
+    deviation = smart_trash.history_compressor.deviation
+    assert np.max(np.abs(curve - [level for _, level, _ in readings])) <= deviation + 1e-9
+    # Every emptying stored its drop
+    stored = set(stored)
+    assert all((timestamp, level) in stored for timestamp, level, emptied in readings if emptied)
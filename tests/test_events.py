@@ -0,0 +1,60 @@
+import json
+
+import app as smart_trash
+from app import EventBroker
+
+
+def read_events(response, count):
+    """Parses the first `count` events (not comments) off an open SSE response."""
+    events, buffer = [], ''
+    chunks = response.response
+    while len(events) < count:
+        buffer += next(chunks).decode('utf-8')
+        while '\n\n' in buffer and len(events) < count:
+            block, buffer = buffer.split('\n\n', 1)
+            fields = dict(line.split(': ', 1) for line in block.split('\n') if not line.startswith(':'))
+            if 'event' in fields:
+                events.append(fields)
+    return events
+
+
+def test_broker_replays_after_last_event_id_and_flags_gaps():
+    broker = EventBroker(replay_size=3, queue_size=10)
+    ids = []
+    for level in range(5):
+        broker.publish("level", {"id": level % 2, "level": level})
+        ids.append(broker._next_id - 1)
+
+    _, backlog, gap = broker.subscribe(last_event_id=ids[2])
+    assert [e[0] for e in backlog] == ids[3:] and not gap
+
+    _, backlog, gap = broker.subscribe(bin_id=1, last_event_id=ids[1])
+    assert [e[2]["level"] for e in backlog] == [3] and not gap
+
+    # ids[0] fell out of the replay buffer: the client must resync
+    _, backlog, gap = broker.subscribe(last_event_id=ids[0] - 1)
+    assert [e[0] for e in backlog] == ids[2:] and gap
+
+
+def test_stream_resumes_from_last_event_id(client):
+    broker = smart_trash.event_broker
+    broker.publish("level", {"id": -1, "level": 10})
+    resume_from = broker._next_id - 1
+    broker.publish("level", {"id": -1, "level": 20})
+    broker.publish("emptied", {"id": -1, "level": 0})
+
+    response = client.get('/stream', headers={'Last-Event-ID': str(resume_from)}, buffered=False)
+    try:
+        assert response.mimetype == 'text/event-stream'
+        events = read_events(response, 2)
+        assert [int(e['id']) for e in events] == [resume_from + 1, resume_from + 2]
+        assert [e['event'] for e in events] == ['level', 'emptied']
+        assert [json.loads(e['data'])['level'] for e in events] == [20, 0]
+        assert broker.subscriber_count >= 1
+
+        # Live events follow the replayed ones on the same connection
+        broker.publish("level", {"id": -1, "level": 30})
+        live, = read_events(response, 1)
+        assert int(live['id']) == resume_from + 3
+    finally:
+        response.close()
@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+from app import Bin, History, db, iter_history_chunks
+
+
+def make_bins(*bin_numbers):
+    return db.session.execute(db.insert(Bin).returning(Bin.id), [
+        {"bin_number": bin_number, "location": "1 Rue de l'Export, 75001 Paris"} for bin_number in bin_numbers]).scalars().all()
+
+
+def test_history_chunks_page_without_holding_a_connection(app_context):
+    bin_id, = make_bins("EXPORT-1")
+    start = datetime(2024, 6, 1)
+    db.session.execute(db.insert(History), [
+        {"bin_id": bin_id, "timestamp": start + timedelta(minutes=i), "level": i} for i in range(5)])
+    db.session.commit()
+
+    chunks = iter_history_chunks(None, start, start + timedelta(hours=1), 2)
+    first = next(chunks)
+    assert db.engine.pool.checkedout() == 0 # Nothing held while the client reads the page
+    pages = [first] + list(chunks)
+    assert [len(rows) for rows in pages] == [2, 2, 1]
+    assert [row.level for rows in pages for row in rows] == [0, 1, 2, 3, 4]
+
+
+def test_bin_filtered_chunks_walk_each_bin_in_time_order(app_context):
+    first_bin, other_bin, skipped_bin = make_bins("EXPORT-2", "EXPORT-3", "EXPORT-4")
+    start = datetime(2024, 7, 1)
+    # Interleaved bins, late readings inserted last and readings sharing a timestamp
+    minutes = [3, 0, 5, 1, 1, 4, 2, 1]
+    rows = [{"bin_id": bin_id, "timestamp": start + timedelta(minutes=minute), "level": 10 * index + offset}
+            for index, minute in enumerate(minutes)
+            for offset, bin_id in enumerate((first_bin, other_bin, skipped_bin))]
+    db.session.execute(db.insert(History), rows)
+    db.session.commit()
+
+    pages = list(iter_history_chunks([other_bin, first_bin], None, None, 3))
+    exported = [row for page in pages for row in page]
+    assert [len(page) for page in pages] == [3, 3, 3, 3, 3, 1]
+    assert [row.bin_number for row in exported] == ["EXPORT-2"] * 8 + ["EXPORT-3"] * 8
+    for bin_rows in (exported[:8], exported[8:]):
+        assert [(row.timestamp, row.id) for row in bin_rows] == sorted((row.timestamp, row.id) for row in bin_rows)
+    assert sorted(row.level for row in exported[:8]) == sorted(10 * index for index in range(8))
+
+    window = list(iter_history_chunks([first_bin], start + timedelta(minutes=1), start + timedelta(minutes=4), 2))
+    assert [row.timestamp.minute for page in window for row in page] == [1, 1, 1, 2, 3]
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as smart_trash
+from app import FILTER_STAGES, Bin, BinState, ReadingFilterPipeline, db, ingest_readings
+
+
+def run_readings(spec, start_level, levels, minutes=1):
+    """Feeds readings through a pipeline the way ingest_readings() applies them."""
+    pipeline = ReadingFilterPipeline(spec, {})
+    now = datetime(2025, 1, 1, 8)
+    target = BinState(1, 'P-001', 'Rue du Test, 75001 Paris', start_level, now, None)
+    state = pipeline.state_for(target)
+    for level in levels:
+        now += timedelta(minutes=minutes)
+        filtered = pipeline.apply(target, state, level, now)
+        if filtered is not None:
+            target.current_level, target.last_updated = filtered, now
+    return target.current_level
+
+
+def test_rate_limit_at_one_minute_cadence():
+    # 30 points/h over 120 one-minute readings: the level climbs by 60
+    assert run_readings('rate', 10, [90] * 120) == 70
+
+
+def test_rate_limit_passes_slow_rises_and_drops():
+    assert run_readings('rate', 10, [11, 12, 13], minutes=5) == 13
+    assert run_readings('rate', 60, [5]) == 5
+
+
+def test_rate_limit_does_not_save_up_while_flat():
+    assert run_readings('rate', 10, [10] * 60 + [90]) == 10
+
+
+
+def test_median_window_starts_from_the_current_level():
+    assert run_readings('median:3', 90, [5]) == 90 # A lone spike after a restart
+    assert run_readings('median:3', 90, [5, 5]) == 5
+
+
+@pytest.fixture
+def filters(app_context, monkeypatch):
+    """Installs a pipeline for the test: filters('default', {bin_number: spec})."""
+    def install(default_spec, bin_specs=None):
+        monkeypatch.setattr(smart_trash, 'reading_filters', ReadingFilterPipeline(default_spec, bin_specs or {}))
+    return install
+
+
+def make_bin(bin_number, level):
+    start = datetime.utcnow() - timedelta(hours=1)
+    db.session.execute(db.insert(Bin), [{"bin_number": bin_number, "location": "1 Rue du Test, 75001 Paris",
+                                         "current_level": level, "last_updated": start}])
+    db.session.commit()
+    return start
+
+
+def bin_row(bin_number):
+    db.session.rollback()
+    return db.session.execute(db.select(Bin).where(Bin.bin_number == bin_number)).scalar_one()
+
+
+def ingest(bin_number, start, levels):
+    outcomes, _ = ingest_readings([(bin_number, level, start + timedelta(minutes=i + 1)) for i, level in enumerate(levels)])
+    return outcomes
+
+
+def test_emptying_is_confirmed_by_the_nth_low_reading(filters):
+    filters('confirm-emptying:3')
+    start = make_bin('FILTER-EMPTY', 90)
+    ingest('FILTER-EMPTY', start, [5])
+    assert (bin_row('FILTER-EMPTY').current_level, bin_row('FILTER-EMPTY').last_emptied_timestamp) == (90, None)
+
+    outcomes = ingest('FILTER-EMPTY', start + timedelta(minutes=1), [5, 5])
+    row = bin_row('FILTER-EMPTY')
+    assert [o["last_emptied_detected"] for o in outcomes] == [False, True]
+    assert row.current_level == 5 and row.last_emptied_timestamp == start + timedelta(minutes=3)
+
+
+def test_median_and_hysteresis_through_ingestion(filters):
+    filters('median:3,hysteresis:2')
+    start = make_bin('FILTER-SMOOTH', 40)
+    outcomes = ingest('FILTER-SMOOTH', start, [100, 41, 42, 60, 61])
+    # 100 is an echo, 41/42 stay within the band, the rise shows once the median has it
+    assert [o.get("applied_level") for o in outcomes] == [40, 40, 40, 40, 60]
+    assert bin_row('FILTER-SMOOTH').current_level == 60
+
+
+def test_per_bin_pipelines_override_the_default(filters):
+    filters('', {'FILTER-OWN': 'confirm-emptying:2'})
+    own, other = make_bin('FILTER-OWN', 90), make_bin('FILTER-OTHER', 90)
+    ingest('FILTER-OWN', own, [5])
+    ingest('FILTER-OTHER', other, [5])
+    assert bin_row('FILTER-OWN').current_level == 90
+    assert bin_row('FILTER-OTHER').current_level == 5
+
+
+class DropZeroFilter:
+    """Test stage: drops 0 readings (no built-in stage drops)."""
+    name = 'drop-zero'
+
+    def initial_state(self):
+        return None
+
+    def process(self, state, level, timestamp, current_level, current_time):
+        return state, None if level == 0 else level
+
+
+def test_update_reports_what_the_filters_did(filters, client, monkeypatch):
+    monkeypatch.setitem(FILTER_STAGES, 'drop-zero', DropZeroFilter)
+    filters('confirm-emptying:2', {'FILTER-DROP': 'drop-zero'})
+    make_bin('FILTER-HELD', 90)
+    make_bin('FILTER-DROP', 30)
+    response = client.get('/update', query_string={'level': 0, 'bin_number': 'FILTER-DROP'})
+    assert response.status_code == 200 and response.get_json()["filtered"] is True
+    assert bin_row('FILTER-DROP').current_level == 30
+
+    response = client.get('/update', query_string={'level': 5, 'bin_number': 'FILTER-HELD'})
+    assert response.status_code == 200
+    assert response.get_json()["applied_level"] == 90 and "filtered" not in response.get_json()
+    response = client.get('/update', query_string={'level': 5, 'bin_number': 'FILTER-HELD'})
+    assert "applied_level" not in response.get_json() and response.get_json()["last_emptied_detected"]
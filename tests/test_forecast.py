@@ -0,0 +1,56 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import app as smart_trash
+from app import Bin, FillRateForecaster, db, ingest_readings
+
+
+def test_forecast_on_a_linear_fill(client):
+    start = datetime(2024, 5, 6, 8, 0)
+    bin_id = db.session.execute(db.insert(Bin).returning(Bin.id), [
+        {"bin_number": "FORECAST-1", "location": "1 Rue des Prévisions, 75001 Paris", "current_level": 15,
+         "last_updated": start - timedelta(hours=1)}]).scalar_one()
+    db.session.commit()
+    # 5 points per hour, from 20% to 70% over ten hours
+    ingest_readings([("FORECAST-1", 20 + 5 * hour, start + timedelta(hours=hour)) for hour in range(11)])
+
+    forecaster = FillRateForecaster(alpha=0.2, horizon_hours=48, min_interval_minutes=15)
+    forecaster.rebuild()
+    last_reading = start + timedelta(hours=10)
+    bin_ids, numbers, levels, rates, hours_to_full = forecaster.forecast(last_reading + timedelta(hours=1))
+    row = list(bin_ids).index(bin_id)
+    assert numbers[row] == "FORECAST-1" and levels[row] == 70
+    assert np.isclose(rates[row], 5.0)
+    # 30 points left at 5 per hour, one hour already elapsed since the last reading
+    assert np.isclose(hours_to_full[row], 5.0)
+
+    payload = client.get('/forecast', query_string={"bin_number": "FORECAST-1"}).get_json()
+    forecast, = payload["bins"]
+    assert forecast["fill_rate_per_hour"] == 5.0 and forecast["hours_to_full"] == 0.0 # Long overdue by now
+
+
+def test_concurrent_first_requests_build_the_forecaster_once(monkeypatch):
+    forecaster = FillRateForecaster(alpha=0.2, horizon_hours=48, min_interval_minutes=15)
+    builds = []
+
+    def rebuild():
+        builds.append(threading.get_ident())
+        time.sleep(0.05)
+        forecaster.loaded = True
+
+    monkeypatch.setattr(forecaster, 'rebuild', rebuild)
+    threads = [threading.Thread(target=forecaster.ensure_loaded) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1 and forecaster.loaded
+
+
+def test_sql_epoch_matches_utc_epoch(app_context):
+    timestamp = datetime(2024, 5, 6, 8, 30, 15, 250000)
+    seconds = db.session.execute(db.select(smart_trash.sql_epoch(db.literal(timestamp)))).scalar_one()
+    assert abs(seconds - smart_trash.utc_epoch(timestamp)) < 1e-3
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+from app import Bin, History, db
+
+
+def walk(client, bin_number, **params):
+    """Follows next_cursor to the end; returns (ids in page order, page count)."""
+    ids, pages, cursor = [], 0, None
+    while True:
+        query = dict(params, cursor=cursor) if cursor else params
+        payload = client.get(f'/bins/{bin_number}/history', query_string=query).get_json()
+        ids += [reading["id"] for reading in payload["readings"]]
+        pages += 1
+        cursor = payload["next_cursor"]
+        if cursor is None:
+            return ids, pages
+
+
+def test_history_pages_follow_the_cursor_without_gaps_or_repeats(client):
+    start = datetime(2024, 8, 1)
+    bin_id = db.session.execute(db.insert(Bin).returning(Bin.id), [
+        {"bin_number": "PAGES-1", "location": "1 Rue des Pages, 75001 Paris", "current_level": 0,
+         "last_updated": start + timedelta(days=1)}]).scalar_one()
+    # Pairs of rows share a timestamp, so a page boundary falls inside a tie
+    db.session.execute(db.insert(History), [
+        {"bin_id": bin_id, "timestamp": start + timedelta(minutes=10 * (i // 2)), "level": i} for i in range(11)])
+    db.session.commit()
+    rows = db.session.execute(db.select(History.id, History.timestamp).where(History.bin_id == bin_id)
+                              .order_by(History.timestamp, History.id)).all()
+    ascending = [row.id for row in rows]
+
+    assert walk(client, 'PAGES-1', limit=3) == (ascending[::-1], 4)
+    assert walk(client, 'PAGES-1', limit=3, order='asc') == (ascending, 4)
+    assert walk(client, 'PAGES-1', limit=11) == (ascending[::-1], 1)
+
+    window = {"start": (start + timedelta(minutes=10)).isoformat(), "end": (start + timedelta(minutes=40)).isoformat()}
+    in_window = [row.id for row in rows if start + timedelta(minutes=10) <= row.timestamp < start + timedelta(minutes=40)]
+    assert walk(client, 'PAGES-1', limit=4, order='asc', **window) == (in_window, 2)
+
+    first = client.get('/bins/PAGES-1/history', query_string={"limit": 2}).get_json()
+    assert [reading["level"] for reading in first["readings"]] == [10, 9]
+    assert first["readings"][0]["timestamp"] == (start + timedelta(minutes=50)).isoformat()
+
+
+def test_history_rejects_bad_parameters(client):
+    assert client.get('/bins/PAGES-NONE/history').status_code == 404
+    assert client.get('/bins/P-001/history', query_string={"cursor": "pas-un-curseur"}).status_code == 400
+    assert client.get('/bins/P-001/history', query_string={"order": "up"}).status_code == 400
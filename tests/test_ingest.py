@@ -0,0 +1,275 @@
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func
+from sqlalchemy.exc import OperationalError
+
+import app as smart_trash
+from app import (Bin, History, IngestQueue, SensorTCPHandler, SensorTCPServer, SensorUDPHandler, SensorUDPServer, SequenceWindow,
+                 db, handle_sensor_frame, ingest_readings, is_database_locked)
+from sensor_protocol import ACK_DUPLICATE, ACK_INVALID, ACK_OK, ACK_RETRY, decode_ack, encode_frame
+
+
+def make_bin(bin_number, level, last_updated):
+    db.session.execute(db.insert(Bin), [{"bin_number": bin_number, "location": "1 Rue du Test, 75001 Paris",
+                                         "current_level": level, "last_updated": last_updated}])
+    db.session.commit()
+
+
+def locked_error(message='database is locked'):
+    return OperationalError('UPDATE bin', {}, sqlite3.OperationalError(message))
+
+
+def test_is_database_locked_is_narrow():
+    assert is_database_locked(locked_error())
+    assert not is_database_locked(locked_error('disk I/O error: device busy'))
+
+
+def test_lock_retry_recomputes_from_the_other_writers_row(app_context, monkeypatch):
+    start = datetime(2025, 1, 1, 8)
+    make_bin('LOCK-1', 0, start)
+    save_history_rows = smart_trash.save_history_rows
+    calls = []
+
+    def save_after_concurrent_write(rows):
+        calls.append(rows)
+        if len(calls) == 1:
+            # Another process fills the bin and commits first: our write loses the race
+            db.session.rollback()
+            with db.engine.begin() as connection:
+                connection.execute(db.update(Bin).where(Bin.bin_number == 'LOCK-1')
+                                   .values(current_level=95, last_updated=start + timedelta(minutes=1),
+                                           revision=Bin.revision + 1))
+            raise locked_error()
+        save_history_rows(rows)
+
+    monkeypatch.setattr(smart_trash, 'save_history_rows', save_after_concurrent_write)
+    outcomes, _ = ingest_readings([('LOCK-1', 10, start + timedelta(minutes=2))])
+
+    assert len(calls) == 2
+    assert outcomes[0]["last_emptied_detected"] # 95 -> 10 seen on the retry, not 0 -> 10
+    row = db.session.execute(db.select(Bin.current_level, Bin.last_emptied_timestamp).where(Bin.bin_number == 'LOCK-1')).one()
+    assert row.current_level == 10 and row.last_emptied_timestamp == start + timedelta(minutes=2)
+
+
+def test_writers_detect_a_stale_cache_without_ttl(app_context):
+    assert smart_trash.bin_cache.ttl is None
+    start = datetime(2025, 1, 1, 8)
+    make_bin('LISTENER-1', 20, start)
+    assert smart_trash.bin_cache.get_by_number('LISTENER-1').current_level == 20 # Cached by this process
+
+    # The sensor listener (another process) fills the bin, bumping its revision like every writer
+    with db.engine.begin() as connection:
+        connection.execute(db.update(Bin).where(Bin.bin_number == 'LISTENER-1')
+                           .values(current_level=90, last_updated=start + timedelta(minutes=1), revision=Bin.revision + 1))
+
+    outcomes, _ = ingest_readings([('LISTENER-1', 5, start + timedelta(minutes=2))])
+    assert outcomes[0]["last_emptied_detected"] # 90 -> 5 from the committed row, not 20 -> 5 from the cache
+    assert smart_trash.bin_cache.get_by_number('LISTENER-1').revision == 2
+
+
+def test_cached_ingestion_reads_no_bin_row(app_context):
+    start = datetime(2025, 1, 1, 8)
+    make_bin('CACHED-1', 20, start)
+    ingest_readings([('CACHED-1', 25, start + timedelta(minutes=1))]) # Fills the cache
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        ingest_readings([('CACHED-1', 30, start + timedelta(minutes=2))])
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert not any(statement.lstrip().upper().startswith('SELECT') for statement in statements)
+    assert db.session.execute(db.select(Bin.current_level).where(Bin.bin_number == 'CACHED-1')).scalar_one() == 30
+
+
+def test_sensor_frame_with_a_future_sample_is_rejected(app_context):
+    make_bin("FRAME-1", 10, datetime.utcnow() - timedelta(hours=1))
+    bin_id = db.session.execute(db.select(Bin.id).where(Bin.bin_number == "FRAME-1")).scalar_one()
+    ahead = int(time.time()) + 86400
+
+    frame = encode_frame(bin_id, 1, [(0, 30), (ahead, 90)])
+    status, _, _ = decode_ack(handle_sensor_frame(frame))
+    assert status == ACK_INVALID
+    db.session.rollback()
+    assert db.session.get(Bin, bin_id).current_level == 10
+
+
+def test_sequence_window_checks_and_records_in_one_step():
+    window = SequenceWindow(window_seconds=60)
+    assert window.claim(7, 1) == 'new'
+    assert window.claim(7, 1) == 'pending' # A retransmission while the first copy is applied
+    window.finish(7, 1, applied=False)
+    assert window.claim(7, 1) == 'new' # The failed copy does not block the retry
+    window.finish(7, 1, applied=True)
+    assert window.claim(7, 1) == 'duplicate'
+    assert window.claim(7, 2) == 'new'
+
+
+def test_sensor_frame_is_applied_once(app_context, monkeypatch):
+    make_bin("FRAME-2", 10, datetime.utcnow() - timedelta(hours=1))
+    bin_id = db.session.execute(db.select(Bin.id).where(Bin.bin_number == "FRAME-2")).scalar_one()
+    frame = encode_frame(bin_id, 5, [(0, 40)])
+
+    with monkeypatch.context() as patch:
+        patch.setattr(smart_trash, 'ingest_readings', lambda readings: 1 / 0)
+        assert decode_ack(handle_sensor_frame(frame)) == (ACK_RETRY, bin_id, 5)
+    assert decode_ack(handle_sensor_frame(frame))[0] == ACK_OK
+    assert decode_ack(handle_sensor_frame(frame))[0] == ACK_DUPLICATE
+    db.session.rollback()
+    assert db.session.get(Bin, bin_id).current_level == 40
+
+
+def test_sensor_client_does_not_load_the_app():
+    root = smart_trash.basedir
+    code = "import sys, sensor_client; assert 'app' not in sys.modules and 'flask' not in sys.modules"
+    subprocess.run([sys.executable, '-c', code], cwd=root, check=True)
+
+
+def test_ingest_queue_groups_readings_in_arrival_order(app_context, monkeypatch):
+    start = datetime(2025, 1, 1, 8)
+    make_bin('QUEUE-A', 0, start)
+    make_bin('QUEUE-B', 0, start)
+    groups = []
+
+    def record(readings):
+        groups.append(list(readings))
+        return ingest_readings(readings)
+
+    monkeypatch.setattr(smart_trash, 'ingest_readings', record)
+    writer = IngestQueue(maxsize=100, flush_size=3, flush_interval_ms=50)
+    submitted = [('QUEUE-A', 40, start + timedelta(minutes=1)), ('QUEUE-B', 20, start + timedelta(minutes=1)),
+                 ('QUEUE-A', 85, start + timedelta(minutes=2)), ('QUEUE-B', 30, start + timedelta(minutes=2)),
+                 ('QUEUE-A', 5, start + timedelta(minutes=3))]
+    for reading in submitted:
+        assert writer.submit(*reading)
+    writer.stop()
+
+    assert all(len(group) <= 3 for group in groups)
+    assert [reading for group in groups for reading in group] == submitted # One writer: FIFO, no reordering
+    assert writer.stats()["flushed"] == 5 and writer.stats()["failed"] == 0
+    db.session.rollback()
+    rows = {b.bin_number: b for b in Bin.query.filter(Bin.bin_number.in_(['QUEUE-A', 'QUEUE-B']))}
+    assert rows['QUEUE-A'].current_level == 5 and rows['QUEUE-A'].last_emptied_timestamp == start + timedelta(minutes=3)
+    assert rows['QUEUE-B'].current_level == 30 and rows['QUEUE-B'].last_emptied_timestamp is None
+
+
+def test_ingest_queue_stop_flushes_without_waiting_out_the_interval(app_context):
+    start = datetime(2025, 1, 1, 8)
+    make_bin('QUEUE-STOP', 0, start)
+    writer = IngestQueue(maxsize=100, flush_size=100, flush_interval_ms=60000)
+    for minute, level in enumerate([10, 20, 30], start=1):
+        assert writer.submit('QUEUE-STOP', level, start + timedelta(minutes=minute))
+
+    started = time.monotonic()
+    writer.stop()
+    assert time.monotonic() - started < 5
+    assert writer.queue.empty() and writer.stats()["flushed"] == 3
+    db.session.rollback()
+    bin_row = Bin.query.filter_by(bin_number='QUEUE-STOP').one()
+    assert bin_row.current_level == 30
+    assert db.session.execute(db.select(func.count()).select_from(History).where(History.bin_id == bin_row.id)).scalar_one() >= 1
+
+
+def test_queued_update_rejects_unknown_bins_and_a_full_queue(client, monkeypatch):
+    make_bin('QUEUE-FULL', 0, datetime.utcnow() - timedelta(hours=1))
+    writer = IngestQueue(maxsize=1, flush_size=10, flush_interval_ms=50)
+    monkeypatch.setattr(writer, 'start', lambda: None) # No writer: the queue stays full
+    monkeypatch.setattr(smart_trash, 'ingest_queue', writer)
+    monkeypatch.setitem(smart_trash.app.config, 'INGEST_MODE', 'queued')
+
+    response = client.get('/update', query_string={'level': 40, 'bin_number': 'QUEUE-FULL'})
+    assert response.status_code == 202 and response.get_json()["bin_number"] == 'QUEUE-FULL'
+    assert client.get('/update', query_string={'level': 50, 'bin_number': 'QUEUE-FULL'}).status_code == 503
+    assert writer.stats()["rejected"] == 1 and writer.stats()["depth"] == 1
+
+    assert client.get('/update', query_string={'level': 50, 'bin_number': 'QUEUE-NONE'}).status_code == 404
+    monkeypatch.setattr(smart_trash, 'get_default_bin_state', lambda: None)
+    response = client.get('/update', query_string={'level': 50})
+    assert response.status_code == 404 and "par défaut" in response.get_json()["error"]
+    assert writer.stats()["depth"] == 1 # Nothing queued for a bin that does not exist
+
+
+def locked_once(monkeypatch):
+    """Makes the next FleetStatsDelta.flush() (inside a write transaction) hit a lock; returns the call log."""
+    calls = []
+    flush = smart_trash.FleetStatsDelta.flush
+
+    def flush_after_lock(self):
+        calls.append(self)
+        if len(calls) == 1:
+            raise locked_error()
+        flush(self)
+
+    monkeypatch.setattr(smart_trash.FleetStatsDelta, 'flush', flush_after_lock)
+    return calls
+
+
+def test_config_and_import_retry_on_a_locked_database(client, monkeypatch):
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    calls = locked_once(monkeypatch)
+    response = client.post('/config', data={"adresse": "7 Rue du Verrou, 69002 Lyon"})
+    assert response.status_code == 302 and len(calls) == 2
+    db.session.rollback()
+    assert db.session.get(Bin, 1).location == "7 Rue du Verrou, 69002 Lyon"
+
+    calls = locked_once(monkeypatch)
+    body = 'bin_number,location\nLOCK-IMPORT-1,"1 Rue du Verrou, 69002 Lyon"\nLOCK-IMPORT-2,"2 Rue du Verrou, 69002 Lyon"\n'
+    response = client.post('/bins/import?format=csv', data=body, content_type='text/csv')
+    assert response.status_code == 200 and response.get_json()["created"] == 2 and len(calls) == 2
+    assert Bin.query.filter(Bin.bin_number.like('LOCK-IMPORT-%')).count() == 2
+
+
+def start_listener(server_class, handler):
+    server = server_class(('127.0.0.1', 0), handler)
+    server.errors = []
+    server.handle_error = lambda request, client_address: server.errors.append(sys.exc_info()[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_sensor_client(port, *args):
+    result = subprocess.run([sys.executable, 'sensor_client.py', '--port', str(port), '--timeout', '5', *args],
+                            cwd=smart_trash.basedir, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return [line.split(' ack=')[1].split(' attempts=')[0] for line in result.stdout.splitlines()]
+
+
+def test_sensor_client_against_the_udp_and_tcp_listeners(app_context, monkeypatch):
+    make_bin("WIRE-1", 10, datetime.utcnow() - timedelta(hours=1))
+    bin_id = db.session.execute(db.select(Bin.id).where(Bin.bin_number == "WIRE-1")).scalar_one()
+    monkeypatch.setattr(SensorTCPHandler, 'timeout', 0.5)
+    udp, tcp = start_listener(SensorUDPServer, SensorUDPHandler), start_listener(SensorTCPServer, SensorTCPHandler)
+    try:
+        acks = run_sensor_client(udp.server_address[1], '--device', str(bin_id), '--sequence', '7001',
+                                 '--level', '42', '--repeat')
+        assert acks == ['ok', 'duplicate']
+        db.session.rollback()
+        assert db.session.get(Bin, bin_id).current_level == 42
+
+        acks = run_sensor_client(tcp.server_address[1], '--transport', 'tcp', '--device', str(bin_id),
+                                 '--sequence', '7002', '--level', '55', '--count', '2', '--interval', '0')
+        assert acks == ['ok', 'ok'] # Two frames on one connection
+        db.session.rollback()
+        assert db.session.get(Bin, bin_id).current_level == 55
+
+        # An idle session, then one cut in the middle of a header: closed quietly
+        for payload in (b'', b'ST\x01'):
+            with socket.create_connection(tcp.server_address, timeout=5) as idle:
+                idle.sendall(payload)
+                assert idle.recv(16) == b'' # Closed by the listener after its timeout
+        time.sleep(0.1)
+        assert udp.errors == [] and tcp.errors == []
+    finally:
+        for server in (udp, tcp):
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,116 @@
+import re
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import app as smart_trash
+from app import MetricsRegistry, db
+from test_asgi import asgi_get
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*",?)*\})? (\S+)$')
+
+
+def parse_exposition(text):
+    """Checks the Prometheus text format line by line; returns {(name, labels): value} and {name: type}."""
+    assert text.endswith('\n')
+    samples, types, current = {}, {}, None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            current = line.split(' ')[2]
+        elif line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            assert name == current and name not in types
+            types[name] = kind
+        else:
+            match = SAMPLE.match(line)
+            assert match, line
+            name, labels, value = match.groups()
+            # Every sample belongs to the family declared just above it
+            assert name == current or (types[current] == 'histogram' and name in
+                                       (f'{current}_bucket', f'{current}_sum', f'{current}_count'))
+            samples[(name, labels or '')] = float(value)
+    return samples, types
+
+
+def counter(name, **labels):
+    return smart_trash.metrics._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+
+def histogram(name, **labels):
+    """(count, sum) of a histogram series, read without rendering (gauges may query)."""
+    series = smart_trash.metrics._histograms.get((name, tuple(sorted(labels.items()))))
+    return (series.count, series.sum) if series else (0, 0.0)
+
+
+def test_exposition_format_of_each_metric_type():
+    registry = MetricsRegistry()
+    registry.counter('test_events_total', 'Events.')
+    registry.histogram('test_duration_seconds', 'Durations.', buckets=(0.1, 1.0))
+    registry.gauge('test_depth', 'Depth.', lambda: 3)
+    registry.gauge('test_broken', 'Unreadable.', lambda: 1 / 0)
+    registry.inc('test_events_total', kind='a "quoted"\nvalue\\')
+    registry.inc('test_events_total', 2, kind='b')
+    for value in (0.05, 0.5, 0.5, 7):
+        registry.observe('test_duration_seconds', value, route='/x')
+
+    text = registry.render()
+    samples, types = parse_exposition(text)
+    assert types == {'test_broken': 'gauge', 'test_depth': 'gauge', 'test_duration_seconds': 'histogram',
+                     'test_events_total': 'counter'}
+    assert 'test_events_total{kind="a \\"quoted\\"\\nvalue\\\\"} 1' in text.splitlines()
+    assert samples[('test_events_total', '{kind="b"}')] == 2
+    assert samples[('test_depth', '')] == 3
+    assert not any(name == 'test_broken' for name, _ in samples) # Omitted, HELP and TYPE stay
+
+    buckets = [samples[('test_duration_seconds_bucket', f'{{route="/x",le="{le}"}}')] for le in ('0.1', '1.0', '+Inf')]
+    assert buckets == [1, 3, 4] # Cumulative
+    assert samples[('test_duration_seconds_count', '{route="/x"}')] == 4
+    assert samples[('test_duration_seconds_sum', '{route="/x"}')] == pytest.approx(8.05)
+
+
+def test_counters_keep_every_digit():
+    registry = MetricsRegistry()
+    registry.counter('test_queries_total', 'Queries.')
+    registry.counter('test_seconds_total', 'Seconds.')
+    registry.inc('test_queries_total', 1234567)
+    registry.inc('test_queries_total')
+    registry.inc('test_seconds_total', 1234567.125)
+    lines = registry.render().splitlines()
+    assert 'test_queries_total 1234568' in lines # Not 1.23457e+06
+    assert 'test_seconds_total 1234567.125' in lines
+
+
+def test_metrics_endpoint_serves_the_text_format(client):
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain' and response.mimetype_params['version'] == '0.0.4'
+    _, types = parse_exposition(response.get_data(as_text=True))
+    assert types['smarttrash_http_requests_total'] == 'counter'
+    assert types['smarttrash_http_request_duration_seconds'] == 'histogram'
+
+
+def test_failed_statements_are_timed_and_counted(app_context):
+    before = counter('smarttrash_sql_queries_total')
+    for _ in range(3):
+        with pytest.raises(OperationalError):
+            db.session.execute(db.text('SELECT * FROM no_such_table'))
+        db.session.rollback()
+    db.session.execute(db.text('SELECT 1'))
+    assert counter('smarttrash_sql_queries_total') == before + 4
+
+
+def test_asgi_routes_record_request_metrics(app_context):
+    ok = counter('smarttrash_http_requests_total', route='/update', method='GET', status=200)
+    rejected = counter('smarttrash_http_requests_total', route='/update', method='GET', status=400)
+    requests, statements = histogram('smarttrash_sql_queries_per_request', route='/update')
+    level_requests, _ = histogram('smarttrash_http_request_duration_seconds', route='/level')
+
+    assert asgi_get('/update', {'level': 55})[0] == 200
+    assert asgi_get('/update', {'level': 500})[0] == 400
+    assert asgi_get('/level')[0] == 200
+
+    assert counter('smarttrash_http_requests_total', route='/update', method='GET', status=200) == ok + 1
+    assert counter('smarttrash_http_requests_total', route='/update', method='GET', status=400) == rejected + 1
+    after_requests, after_statements = histogram('smarttrash_sql_queries_per_request', route='/update')
+    # The UPDATE and the History INSERT ran in the thread pool, and were still counted
+    assert after_requests == requests + 2 and after_statements >= statements + 2
+    assert histogram('smarttrash_http_request_duration_seconds', route='/level')[0] == level_requests + 1
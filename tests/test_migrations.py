@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import app as smart_trash
+
+# Runs in its own interpreter: the engine is bound to a database when app is imported
+MIGRATE = """
+import json
+from datetime import datetime
+import app as smart_trash
+from app import db
+
+runs = [smart_trash.ensure_schema(), smart_trash.ensure_schema()]
+with smart_trash.app.app_context():
+    # Every migration also runs cleanly over the schema it already produced
+    for _, _, migrate in smart_trash.MIGRATIONS:
+        migrate()
+    db.session.commit()
+    inspector = db.inspect(db.engine)
+    smart_trash.ingest_readings([("P-001", 85, datetime.utcnow())])
+    report = {
+        "runs": runs,
+        "versions": [v for v, in db.session.execute(db.text("SELECT version FROM schema_version ORDER BY version"))],
+        "bin_columns": sorted(c["name"] for c in inspector.get_columns("bin")),
+        "tables": sorted(inspector.get_table_names()),
+        "history_indexes": sorted(i["name"] for i in inspector.get_indexes("history")),
+        "triggers": sorted(n for n, in db.session.execute(db.text("SELECT name FROM sqlite_master WHERE type = 'trigger'"))),
+        "default_bin": list(db.session.execute(db.text("SELECT bin_number, current_level, revision FROM bin WHERE id = 1")).one()),
+        "users": db.session.execute(db.text("SELECT count(*) FROM user WHERE username = 'admin'")).scalar(),
+        "daily": db.session.execute(db.text("SELECT count(*) FROM history_daily")).scalar(),
+        "daily_rollups": [list(row) for row in db.session.execute(db.text(
+            "SELECT substr(bucket_start, 1, 10), reading_count, round(seconds_above_threshold), emptied_count"
+            " FROM history_daily WHERE bucket_start < '2025-05-30' ORDER BY bucket_start"))],
+        "emptied_days": [list(row) for row in db.session.execute(db.text(
+            "SELECT key, bin_count FROM fleet_stat WHERE dimension = 'emptied_day' ORDER BY key"))],
+    }
+    if smart_trash.pd is not None:
+        bins = smart_trash.build_report_frames(datetime(2025, 5, 20), datetime(2025, 5, 22), 80)["Poubelles"]
+        row = bins.set_index("bin_number").loc["P-001"]
+        report["weekly_report"] = [int(row["readings"]), float(row["critical_hours"]), int(row["emptyings"])]
+print(json.dumps(report))
+"""
+
+
+# Readings of the default bin stored by a v0 install: above the threshold from
+# 08:00 on the 20th until the emptying at 09:00 on the 21st
+V0_HISTORY = [('2025-05-20 08:00:00.000000', 90), ('2025-05-20 10:30:00.000000', 95),
+              ('2025-05-21 09:00:00.000000', 10), ('2025-05-21 12:00:00.000000', 30)]
+
+
+def migrate_copy(tmp_path, history=()):
+    database = tmp_path / 'v0.db'
+    shutil.copy(os.path.join(smart_trash.basedir, 'database.db'), database)
+    with sqlite3.connect(database) as connection:
+        connection.executemany("INSERT INTO history (bin_id, timestamp, level) VALUES (1, ?, ?)", history)
+    env = dict(os.environ, SMART_TRASH_DATABASE_URI=f'sqlite:///{database}')
+    result = subprocess.run([sys.executable, '-c', MIGRATE], cwd=smart_trash.basedir, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_v0_database_migrates_to_the_latest_version_idempotently(tmp_path):
+    # The committed database.db predates schema_version and every migration
+    report = migrate_copy(tmp_path)
+    assert report["runs"] == [[0, smart_trash.SCHEMA_VERSION], [smart_trash.SCHEMA_VERSION] * 2]
+    assert report["versions"] == [version for version, _, _ in smart_trash.MIGRATIONS]
+    assert report["bin_columns"] == sorted(column.name for column in smart_trash.Bin.__table__.columns)
+    assert set(report["tables"]) >= {table.name for table in smart_trash.db.metadata.sorted_tables}
+    assert 'ix_history_bin_timestamp' in report["history_indexes"]
+    assert report["triggers"] == ['history_hourly_insert_daily', 'history_hourly_update_daily']
+    # Existing rows are kept: the default bin only gains the new columns, and moved with the reading
+    assert report["default_bin"] == ['P-001', 85, 1]
+    assert report["users"] == 1
+    assert report["daily"] == 1
+
+
+def test_v0_history_is_rolled_up_by_the_migration(tmp_path):
+    report = migrate_copy(tmp_path, V0_HISTORY)
+    assert report["daily_rollups"] == [['2025-05-20', 2, 16 * 3600, 0], ['2025-05-21', 2, 9 * 3600, 1]]
+    assert report["emptied_days"] == [['2025-05-21', 1]] # /stats counts the emptying from before the upgrade
+
+
+def test_reports_on_an_upgraded_database_include_its_history(tmp_path):
+    pytest.importorskip('pandas')
+    report = migrate_copy(tmp_path, V0_HISTORY)
+    assert report["weekly_report"] == [4, 25.0, 1] # Read from the backfilled rollups
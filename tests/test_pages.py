@@ -0,0 +1,69 @@
+import gzip
+import os
+
+import pytest
+
+import app as smart_trash
+from app import CompiledPageCache
+
+
+def page_response(pages, path, headers, **context):
+    with smart_trash.app.test_request_context('/', headers=headers):
+        return pages.get((path,)).response(**context)
+
+
+def write_page(tmp_path, source):
+    path = str(tmp_path / 'index.html')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(source)
+    return path
+
+
+def test_compiled_page_variants_and_revalidation(tmp_path):
+    path = write_page(tmp_path, '<p>Bonjour {{ username }}</p>')
+    pages = CompiledPageCache()
+
+    plain = page_response(pages, path, {}, username='alice')
+    assert plain.get_data() == b'<p>Bonjour alice</p>'
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.vary
+
+    gzipped = page_response(pages, path, {'Accept-Encoding': 'gzip'}, username='alice')
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(gzipped.get_data()) == b'<p>Bonjour alice</p>'
+    assert gzipped.get_etag() != plain.get_etag()
+
+    # Variables the template does not use do not create new variants
+    page = pages.get((path,))
+    page_response(pages, path, {}, username='alice', unused='x')
+    assert len(page._variants) == 1
+    other_user = page_response(pages, path, {}, username='bob')
+    assert other_user.get_data() == b'<p>Bonjour bob</p>' and other_user.get_etag() != plain.get_etag()
+    assert len(page._variants) == 2
+
+    revalidated = page_response(pages, path, {'Accept-Encoding': 'gzip', 'If-None-Match': gzipped.headers['ETag']},
+                                username='alice')
+    assert revalidated.status_code == 304 and revalidated.get_data() == b''
+    assert revalidated.headers['ETag'] == gzipped.headers['ETag']
+    # The identity ETag does not validate the gzip variant
+    assert page_response(pages, path, {'Accept-Encoding': 'gzip', 'If-None-Match': plain.headers['ETag']},
+                         username='alice').status_code == 200
+
+    # Editing the file recompiles it and changes every ETag
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<p>Salut {{ username }}</p>')
+    os.utime(path, (page.mtime + 10, page.mtime + 10))
+    edited = page_response(pages, path, {'If-None-Match': plain.headers['ETag']}, username='alice')
+    assert edited.status_code == 200 and edited.get_data() == b'<p>Salut alice</p>'
+    assert pages.get((path,)) is not page
+
+
+def test_compiled_page_prefers_brotli(tmp_path):
+    brotli = pytest.importorskip('brotli')
+    path = write_page(tmp_path, '<p>Bonjour</p>')
+    pages = CompiledPageCache()
+    compressed = page_response(pages, path, {'Accept-Encoding': 'br, gzip'})
+    assert compressed.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(compressed.get_data()) == b'<p>Bonjour</p>'
+    gzipped = page_response(pages, path, {'Accept-Encoding': 'gzip'})
+    assert compressed.get_etag() != gzipped.get_etag()
@@ -0,0 +1,55 @@
+import json
+import os
+import subprocess
+import sys
+
+import app as smart_trash
+
+# Each entry point runs in its own interpreter: the storage profile and the
+# engine are set up when app is imported
+WSGI = """
+import json
+import wsgi
+from app import db
+
+with wsgi.application.app_context():
+    with db.engine.connect() as conn:
+        pragmas = {p: conn.exec_driver_sql(f"PRAGMA {p}").scalar() for p in ('journal_mode', 'synchronous', 'busy_timeout')}
+    print(json.dumps({"profile": wsgi.application.config['STORAGE_PROFILE'], "pragmas": pragmas,
+                      "pool": type(db.engine.pool).__name__}))
+"""
+
+ASGI = """
+import asyncio
+import asgi
+
+async def start_and_stop():
+    async with asgi.lifespan(asgi.application):
+        pass
+
+asyncio.run(start_and_stop())
+"""
+
+
+def run_entry_point(code, tmp_path, **settings):
+    env = {name: value for name, value in os.environ.items() if name != 'SMART_TRASH_STORAGE_PROFILE'}
+    env.update(SMART_TRASH_DATABASE_URI=f"sqlite:///{tmp_path / 'production.db'}", **settings)
+    result = subprocess.run([sys.executable, '-c', code], cwd=smart_trash.basedir, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout.strip().splitlines(), result.stderr.splitlines()
+
+
+def test_wsgi_loads_the_production_profile(tmp_path):
+    output, log = run_entry_point(WSGI, tmp_path)
+    assert sum("Storage profile 'production'" in line for line in output + log) == 1 # Logged, not printed too
+    report = json.loads(output[-1])
+    assert report["profile"] == 'production' and report["pool"] == 'QueuePool'
+    assert report["pragmas"] == {"journal_mode": "wal", "synchronous": 1, "busy_timeout": 5000} # 1 is NORMAL
+
+
+def test_asgi_lifespan_logs_the_storage_settings(tmp_path):
+    # As documented in wsgi.py for `uvicorn asgi:application --workers N`
+    output, log = run_entry_point(ASGI, tmp_path, SMART_TRASH_STORAGE_PROFILE='production')
+    settings = [line for line in output + log if "Storage profile 'production'" in line]
+    assert len(settings) == 1 and settings[0] in log
+    assert "'journal_mode': 'wal'" in settings[0] and "QueuePool" in settings[0]
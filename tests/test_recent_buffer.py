@@ -0,0 +1,124 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+import app as smart_trash
+from app import RECENT_BUFFER_HEADER, RECENT_BUFFER_HEADER_SIZE, Bin, History, RecentReadingsBuffer, db, ingest_readings
+
+
+def test_header_written_at_start(tmp_path):
+    path = str(tmp_path / 'recent.bin')
+    buffer = RecentReadingsBuffer(path, 4, 8)
+    assert os.path.getsize(path) == RECENT_BUFFER_HEADER_SIZE + 4 * buffer.dtype.itemsize
+    with open(path, 'rb') as f:
+        assert f.read(RECENT_BUFFER_HEADER.size) != bytes(RECENT_BUFFER_HEADER.size)
+
+
+def test_readings_survive_reopen(tmp_path):
+    path = str(tmp_path / 'recent.bin')
+    now = datetime(2025, 1, 1).timestamp()
+    RecentReadingsBuffer(path, 4, 8).append(7, [now, now + 60], [40, 45])
+
+    reopened = RecentReadingsBuffer(path, 4, 8)
+    timestamps, levels = reopened.read(7)
+    assert list(levels) == [45, 40]
+    assert list(timestamps) == [now + 60, now]
+
+
+def test_other_settings_start_over(tmp_path):
+    path = str(tmp_path / 'recent.bin')
+    RecentReadingsBuffer(path, 4, 8).append(7, [1.0], [40])
+    assert RecentReadingsBuffer(path, 4, 16).read(7) is None
+
+
+@pytest.fixture
+def small_buffer(tmp_path):
+    buffer = RecentReadingsBuffer(str(tmp_path / 'recent.bin'), 4, 4)
+    yield buffer
+    buffer.close()
+
+
+def test_coverage_starts_after_the_points_given_up(small_buffer):
+    buffer = small_buffer
+    buffer.append(7, [1.0, 2.0, 3.0], [10, 20, 30])
+    assert [list(a) for a in buffer.covered(7)[:2]] == [[3.0, 2.0, 1.0], [30, 20, 10]] and buffer.covered(7)[2]
+
+    buffer.append(7, [0.5, 4.0, 5.0], [5, 40, 50]) # A late point, then 1.0 and 2.0 are pushed out
+    timestamps, levels, complete = buffer.covered(7)
+    assert list(timestamps) == [5.0, 4.0, 3.0] and not complete # 0.5 is held, but older than what is covered
+
+    buffer.append(7, [5.0], [50]) # Already held (another process seeded it): not doubled
+    assert list(buffer.covered(7)[0]) == [5.0, 4.0, 3.0]
+
+
+def test_seed_only_fills_missing_slots(small_buffer):
+    buffer = small_buffer
+    assert not buffer.append(7, [1.0], [10], allocate=False)
+    assert buffer.seed(7, lambda: ([1.0, 2.0], [10, 20], 1.5))
+    assert list(buffer.covered(7)[0]) == [2.0] and not buffer.covered(7)[2]
+    assert buffer.seed(7, lambda: pytest.fail('slot already seeded'))
+    buffer.clear()
+    assert buffer.covered(7) is None
+
+
+@pytest.fixture
+def recent_buffer(app_context, tmp_path, monkeypatch):
+    buffer = RecentReadingsBuffer(str(tmp_path / 'recent.bin'), 64, 16)
+    monkeypatch.setattr(smart_trash, 'recent_buffer', buffer)
+    yield buffer
+    buffer.close()
+
+
+def stored_points(bin_id, limit, critical=False):
+    query = History.query.with_entities(History.timestamp, History.level).filter(History.bin_id == bin_id)
+    if critical:
+        query = query.filter(History.level >= 80)
+    return query.order_by(History.timestamp.desc()).limit(limit).all()
+
+
+def recent(client, bin_number, limit):
+    payload = client.get(f'/bins/{bin_number}/recent', query_string={'limit': limit}).get_json()
+    return payload["source"], [(datetime.fromisoformat(r["timestamp"]), r["level"]) for r in payload["readings"]]
+
+
+def test_recent_serves_the_history_points_from_the_buffer(client, recent_buffer):
+    start = datetime.utcnow() - timedelta(hours=2)
+    db.session.execute(db.insert(Bin), [{"bin_number": "RECENT-1", "location": "1 Rue du Test, 75001 Paris",
+                                         "current_level": 0, "last_updated": start}])
+    db.session.commit()
+    bin_id = db.session.execute(db.select(Bin.id).where(Bin.bin_number == "RECENT-1")).scalar_one()
+    ingest_readings([("RECENT-1", level, start + timedelta(minutes=i + 1)) for i, level in enumerate([10, 11, 12, 40, 41, 90])])
+
+    # Seeded from History on first read: every point is held, so even a long list comes from the buffer
+    assert recent(client, "RECENT-1", 50) == ('buffer', stored_points(bin_id, 50))
+    assert recent_buffer.covered(bin_id)[2]
+
+    # Later points reach it with the commit (the compressed ones, a late one, an emptying)
+    later = start + timedelta(minutes=10)
+    ingest_readings([("RECENT-1", level, later + timedelta(minutes=i)) for i, level in enumerate([91, 99] * 5 + [60, 5, 6, 7])]
+                    + [("RECENT-1", 30, start + timedelta(seconds=30))])
+    db.session.rollback()
+    assert recent(client, "RECENT-1", 6) == ('buffer', stored_points(bin_id, 6))
+    # More than the ring holds: points pushed out only exist in History
+    assert recent(client, "RECENT-1", 50) == ('history', stored_points(bin_id, 50))
+
+
+def test_level_reads_critical_points_from_the_buffer(client, recent_buffer):
+    start = datetime.utcnow()
+    # Alternating levels: every reading is a corner the compressor keeps
+    ingest_readings([(None, level, start + timedelta(seconds=i)) for i, level in enumerate([80, 99] * 6)])
+    expected = client.get('/level').get_json()["historique"] # Seeds the slot of bin 1
+
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        payload = client.get('/level').get_json()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    assert payload["historique"] == expected
+    assert expected == [{"timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"), "niveau": level}
+                        for timestamp, level in stored_points(1, 10, critical=True)]
+    assert not any('history.level >=' in statement for statement in statements) # Not from History
@@ -0,0 +1,123 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as smart_trash
+from app import Bin, History, ReportJob, build_report_frames, db, ingest_readings
+
+pd = pytest.importorskip('pandas')
+
+START = datetime(2019, 3, 4)
+END = START + timedelta(days=5)
+
+
+@pytest.fixture(scope='module')
+def report_bins(database):
+    """Bins seeded through ingestion, so History is compressed and the rollups are filled."""
+    with smart_trash.app.app_context():
+        db.session.execute(db.insert(Bin), [
+            {"bin_number": number, "location": f"1 Rue des Rapports, {zone}", "current_level": 0,
+             "last_updated": START - timedelta(days=3)}
+            for number, zone in (("REPORT-1", "75011 Paris"), ("REPORT-2", "75012 Paris"), ("REPORT-3", "75013 Paris"))])
+        db.session.commit()
+        # REPORT-1 fills linearly from 0 to 95% over 96 h, then holds 95% until END;
+        # REPORT-2 is emptied by the first reading of the period;
+        # REPORT-3 was left at 85% the day before and not heard of since
+        readings = [("REPORT-1", round(95 * hour / 96), START + timedelta(hours=hour)) for hour in range(97)]
+        readings += [("REPORT-2", 90, START - timedelta(hours=2)), ("REPORT-2", 10, START),
+                     ("REPORT-3", 85, START - timedelta(days=1))]
+        ingest_readings(readings)
+        bin_ids = dict(db.session.execute(db.select(Bin.bin_number, Bin.id).where(Bin.bin_number.like('REPORT-%'))).all())
+    return bin_ids
+
+
+@pytest.mark.filterwarnings('error')
+def test_report_tables_follow_the_readings_not_the_compressed_history(app_context, report_bins):
+    # Swinging door keeps next to nothing of a linear fill: the report must not depend on it
+    assert db.session.query(History).filter(History.bin_id == report_bins["REPORT-1"]).count() <= 3
+
+    tables = build_report_frames(START, END, threshold=80)
+    rows = tables["Poubelles"].set_index("bin_number")
+    filling = rows.loc["REPORT-1"]
+    assert filling["zone"] == "75011 Paris"
+    assert (filling["readings"], filling["level_max"], filling["last_level"], filling["emptyings"]) == (97, 95, 95, 0)
+    assert filling["level_mean"] == 47.5
+    # From the reading at 80% (hour 81) to the last one at hour 96, then held until END (hour 120)
+    assert filling["critical_hours"] == 39.0
+
+    emptied = rows.loc["REPORT-2"]
+    assert (emptied["readings"], emptied["level_max"], emptied["last_level"], emptied["emptyings"]) == (1, 10, 10, 1)
+    assert emptied["critical_hours"] == 0.0 # Its 2 h above the threshold were before START
+
+    carried = rows.loc["REPORT-3"]
+    assert carried["readings"] == 0 and carried["last_level"] == 85 and pd.isna(carried["level_max"])
+    assert carried["critical_hours"] == 120.0 # Above the threshold for the whole period
+    zones = tables["Zones"].set_index("zone")
+    assert zones.loc["75013 Paris", "full_bins"] == 1 and zones.loc["75012 Paris", "emptyings"] == 1
+
+    days = tables["Par jour"].set_index(["day", "zone"])
+    assert days.loc[(START.date(), "75011 Paris"), "readings"] == 24
+    assert days.loc[((START + timedelta(days=4)).date(), "75011 Paris"), "level_mean"] == 95.0
+    assert days.loc[(START.date(), "75012 Paris"), "emptyings"] == 1
+
+
+@pytest.mark.filterwarnings('error')
+def test_report_level_at_the_end_of_a_past_period(app_context, report_bins):
+    # Day 3 ends halfway through REPORT-1's fill: interpolated along the compressed curve
+    end = START + timedelta(days=2)
+    tables = build_report_frames(START + timedelta(hours=6), end, threshold=80)
+    filling = tables["Poubelles"].set_index("bin_number").loc["REPORT-1"]
+    assert filling["last_level"] == 48 # 47.5, the level read at hour 48
+    assert filling["readings"] == 42 and filling["critical_hours"] == 0.0
+    assert list(tables["Par jour"].query("zone == '75011 Paris'")["readings"]) == [18, 24]
+
+
+@pytest.mark.filterwarnings('error')
+def test_report_tables_without_readings(app_context):
+    tables = build_report_frames(datetime(2001, 1, 1), datetime(2001, 1, 8), threshold=80)
+    bins = tables["Poubelles"]
+    assert len(bins) and (bins["readings"] == 0).all() and (bins["emptyings"] == 0).all()
+    assert bins["level_max"].isna().all() and tables["Par jour"].empty
+
+
+def wait_for_report(client, job_id):
+    for _ in range(200):
+        job = client.get(f'/reports/{job_id}').get_json()
+        if job["status"] in ('done', 'failed'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"Report {job_id} still {job['status']}")
+
+
+def test_report_is_built_once_and_served_from_the_watermark_cache(client, report_bins, tmp_path, monkeypatch):
+    pytest.importorskip('openpyxl')
+    monkeypatch.setitem(smart_trash.app.config, 'REPORT_DIR', str(tmp_path))
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    request = {"format": "xlsx", "start": START.isoformat(), "end": END.isoformat()}
+
+    queued = client.post('/reports', json=request)
+    assert queued.status_code == 202 and queued.get_json()["cached"] is False
+    job = wait_for_report(client, queued.get_json()["id"])
+    assert job["status"] == 'done' and job["size"] > 0
+    download = client.get(job["download"])
+    assert download.status_code == 200 and download.data[:2] == b'PK' # xlsx is a zip file
+    sheets = pd.read_excel(pd.io.common.BytesIO(download.data), sheet_name=None)
+    assert set(sheets) == {"Zones", "Poubelles", "Par jour"}
+
+    cached = client.post('/reports', json=request)
+    assert cached.status_code == 200 and cached.get_json()["cached"] is True
+    assert cached.get_json()["id"] == job["id"]
+
+    # A late reading inside the period only updates a rollup row in place,
+    # which still moves the watermark: a new report is built
+    ingest_readings([("REPORT-1", 60, START + timedelta(hours=6, minutes=30))])
+    rebuilt = client.post('/reports', json=request)
+    assert rebuilt.status_code == 202 and rebuilt.get_json()["id"] != job["id"]
+    assert wait_for_report(client, rebuilt.get_json()["id"])["status"] == 'done'
+    assert db.session.query(ReportJob).filter(ReportJob.period_start == START).count() == 2
+
+    # So does a reading after the period, for a bin that was holding its last level at END
+    ingest_readings([("REPORT-3", 20, END + timedelta(hours=1))])
+    assert client.post('/reports', json=request).get_json()["cached"] is False
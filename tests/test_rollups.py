@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+import app as smart_trash
+from app import (Bin, History, HistoryDaily, HistoryHourly, backfill_rollups_from_history, db, fleet_stats, ingest_readings,
+                 rebuild_fleet_stats)
+
+
+def rollup_rows(model, bin_id):
+    return {row.bucket_start: (row.min_level, row.max_level, row.level_sum, row.reading_count,
+                               row.seconds_above_threshold, row.emptied_count)
+            for row in model.query.filter_by(bin_id=bin_id)}
+
+
+def test_rollups_split_across_hour_and_day_boundaries(app_context):
+    evening = datetime(2024, 3, 1, 23, 30)
+    bin_id = db.session.execute(db.insert(Bin).returning(Bin.id), [
+        {"bin_number": "ROLLUP-1", "location": "1 Rue des Cumuls, 75001 Paris", "current_level": 85,
+         "last_updated": evening}]).scalar_one()
+    db.session.commit()
+
+    ingest_readings([("ROLLUP-1", 90, evening + timedelta(minutes=15)), ("ROLLUP-1", 95, evening + timedelta(minutes=45))])
+    # Second transaction: the 00:00 hour row is updated, not inserted
+    ingest_readings([("ROLLUP-1", 10, evening + timedelta(minutes=80)), ("ROLLUP-1", 20, evening + timedelta(minutes=100))])
+
+    midnight = datetime(2024, 3, 2)
+    assert rollup_rows(HistoryHourly, bin_id) == {
+        # Above the threshold from 23:30 until midnight, then until the emptying at 00:50
+        datetime(2024, 3, 1, 23): (90, 90, 90, 1, 1800.0, 0),
+        midnight: (10, 95, 105, 2, 3000.0, 1),
+        datetime(2024, 3, 2, 1): (20, 20, 20, 1, 0.0, 0),
+    }
+    assert rollup_rows(HistoryDaily, bin_id) == {
+        datetime(2024, 3, 1): (90, 90, 90, 1, 1800.0, 0),
+        midnight: (10, 95, 125, 3, 3000.0, 1),
+    }
+
+
+
+def test_backfill_from_history_matches_the_rollups_of_ingestion(app_context, monkeypatch):
+    monkeypatch.setattr(smart_trash.history_compressor, 'mode', 'off') # Every reading reaches History
+    start = datetime(2024, 4, 1, 23)
+    ingested, upgraded = db.session.execute(db.insert(Bin).returning(Bin.id), [
+        {"bin_number": number, "location": "1 Rue des Cumuls, 75001 Paris", "current_level": 0,
+         "last_updated": start - timedelta(hours=1)}
+        for number in ("BACKFILL-1", "BACKFILL-2")]).scalars().all()
+    db.session.commit()
+    readings = [(90, 15), (95, 45), (10, 80), (20, 100), (85, 130), (88, 270)] # (level, minutes after 23:00)
+    ingest_readings([("BACKFILL-1", level, start + timedelta(minutes=minutes)) for level, minutes in readings])
+
+    # The same History, stored before rollups existed
+    db.session.execute(db.insert(History), [{"bin_id": upgraded, "level": level, "timestamp": start + timedelta(minutes=minutes)}
+                                            for level, minutes in readings])
+    db.session.commit()
+    expected = {model: rollup_rows(model, ingested) for model in (HistoryHourly, HistoryDaily)}
+    for _ in range(2): # Buckets already rolled up are skipped, so a second run changes nothing
+        backfill_rollups_from_history()
+        db.session.commit()
+        for model in (HistoryHourly, HistoryDaily):
+            backfilled = {bucket: values[:4] + (round(values[4], 1),) + values[5:]
+                          for bucket, values in rollup_rows(model, upgraded).items()}
+            assert backfilled == expected[model]
+            assert rollup_rows(model, ingested) == expected[model]
+    assert expected[HistoryDaily][datetime(2024, 4, 2)][5] == 1 # The emptying at 00:20
+
+def test_stats_after_incremental_updates_match_a_rebuild(client):
+    rebuild_fleet_stats()
+    db.session.commit()
+    now = datetime.utcnow()
+    db.session.execute(db.insert(Bin), [
+        {"bin_number": f"STATS-{i}", "location": f"{i} Rue des Stats, 6900{i % 3} Lyon", "current_level": 20 * i,
+         "last_updated": now - timedelta(hours=5 * i)} for i in range(5)])
+    rebuild_fleet_stats()
+    db.session.commit()
+    fleet_stats.invalidate()
+    client.get('/stats')
+
+    # Band changes, an emptying, a late reading, a new address and a new bin
+    ingest_readings([("STATS-0", 55, now), ("STATS-4", 5, now), ("STATS-2", 85, now),
+                     ("STATS-3", 90, now - timedelta(days=1))])
+    client.post('/update/batch', json=[{"bin_number": "STATS-1", "level": 81}])
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    client.post('/config', data={"adresse": "7 Rue des Stats, 13001 Marseille"})
+    smart_trash.import_bins(smart_trash.iter_import_records(
+        iter(['bin_number,location\n', 'STATS-9,"9 Rue des Stats, 69001 Lyon"\n']), 'csv'), 100)
+
+    incremental = client.get('/stats').get_json()
+    db.session.rollback()
+    rebuild_fleet_stats()
+    db.session.commit()
+    rebuilt = client.get('/stats').get_json()
+    incremental.pop("generated_at"), rebuilt.pop("generated_at")
+    assert incremental == rebuilt
+    assert incremental["emptyings_per_day"][now.date().isoformat()] >= 1
@@ -0,0 +1,49 @@
+import itertools
+import math
+import random
+
+from app import Bin, db, plan_route, tour_length
+
+
+def brute_force_length(points):
+    return min(tour_length(points, [0, *order]) for order in itertools.permutations(range(1, len(points))))
+
+
+def test_route_is_a_tour_from_the_depot_close_to_optimal():
+    for seed in range(20):
+        rng = random.Random(seed)
+        points = [(rng.uniform(0, 10), rng.uniform(0, 10)) for _ in range(8)]
+        tour, nn_length, length, _ = plan_route(points, 5, 1.0)
+        assert tour[0] == 0 and sorted(tour) == list(range(len(points)))
+        assert math.isclose(length, tour_length(points, tour))
+        assert length <= nn_length + 1e-9
+        assert length <= 1.2 * brute_force_length(points)
+
+
+def test_route_over_points_in_convex_position_is_optimal():
+    # Any tour without crossing edges is the optimal one here, so 2-opt must reach it
+    rng = random.Random(7)
+    angles = sorted(rng.uniform(0, 2 * math.pi) for _ in range(9))
+    points = [(math.cos(angle), math.sin(angle)) for angle in angles]
+    rng.shuffle(points)
+    tour, _, length, _ = plan_route(points, len(points) - 1, 1.0)
+    assert math.isclose(length, brute_force_length(points))
+
+
+def test_route_endpoint_orders_full_bins(client):
+    depot = (48.85, 2.35)
+    offsets = [(0.01, 0), (0.01, 0.01), (0, 0.01), (-0.01, 0.01), (-0.01, 0)]
+    # A level no real reading reaches keeps the other tests' bins off the route
+    db.session.execute(db.insert(Bin), [
+        {"bin_number": f"ROUTE-{i}", "location": f"{i} Rue des Tournées, 75001 Paris", "current_level": 250,
+         "latitude": depot[0] + dlat, "longitude": depot[1] + dlon}
+        for i, (dlat, dlon) in enumerate(offsets)])
+    db.session.commit()
+
+    payload = client.get('/route', query_string={"depot_lat": depot[0], "depot_lon": depot[1], "min_level": 250}).get_json()
+    numbers = [stop["numero"] for stop in payload["stops"]]
+    assert sorted(numbers) == [f"ROUTE-{i}" for i in range(len(offsets))]
+    # Around the depot, in one direction or the other
+    assert numbers in ([f"ROUTE-{i}" for i in range(5)], [f"ROUTE-{i}" for i in reversed(range(5))])
+    legs = sum(stop["leg_km"] for stop in payload["stops"])
+    assert payload["total_km"] > legs and payload["total_km"] <= payload["nearest_neighbour_km"]
@@ -0,0 +1,42 @@
+# Production WSGI entry point for Smart-Trash (several worker processes)
+#
+# Run with any prefork WSGI server, e.g.:
+#     gunicorn --workers 4 --bind 0.0.0.0:5000 wsgi:application
+# or, with the servers from requirements.txt, the ASGI app (async /update
+# and /level) in several processes:
+#     SMART_TRASH_STORAGE_PROFILE=production SMART_TRASH_BIN_CACHE_TTL_SECONDS=1 \
+#         uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 4
+#
+# What makes several processes safe:
+# - Sessions: every worker signs cookies with the same key, taken from
+#   SMART_TRASH_SECRET_KEY or instance/secret_key (created on first start).
+# - SQLite: the 'production' storage profile (WAL, busy_timeout) lets readers
+#   run alongside the writer, and writes that still hit "database is locked"
+#   are retried with backoff (DB_LOCK_RETRIES).
+# - Caches: bin state is cached per process, so BIN_CACHE_TTL_SECONDS bounds
+#   how long another worker's write can go unseen by /level and /bins, and
+#   ingestion always reads the committed state.
+#
+# Still per process: Server-Sent Events (/stream) only carry the readings
+# ingested by the worker holding the connection, and /forecast learns from
+# the readings its worker sees after a rebuild from History at first use.
+# Serve /stream from a single worker when live updates matter.
+import logging
+import os
+
+os.environ.setdefault('SMART_TRASH_STORAGE_PROFILE', 'production')
+os.environ.setdefault('SMART_TRASH_BIN_CACHE_TTL_SECONDS', '1')
+
+from app import alert_dispatcher, app as application, ensure_schema, log_storage_settings
+
+# Startup settings, emptyings and dispatcher errors go to stderr (Flask's handler)
+application.logger.setLevel(logging.INFO)
+
+# Every worker runs this; migrations are idempotent, so the first one to get
+# the write lock applies them and the others only check the version.
+ensure_schema()
+log_storage_settings()
+# Each worker may run a dispatcher (jobs are claimed atomically), but one
+# `flask alert-dispatcher` with SMART_TRASH_ALERT_DISPATCHER=off is tidier
+if application.config['ALERT_RECIPIENTS'] and application.config['ALERT_DISPATCHER'] == 'thread':
+    alert_dispatcher.start()